@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AccountsConfig(AppConfig):
     name = 'accounts'
+
+    def ready(self):
+        from accounts.models.account.permissions import connect_membership_signals
+        connect_membership_signals()
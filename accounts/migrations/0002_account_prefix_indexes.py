@@ -0,0 +1,30 @@
+from django.db import migrations
+
+INDEXES = (
+    ("account_username_lower_idx", "username"),
+    ("account_email_lower_idx", "email"),
+)
+
+
+def create_indexes(apps, schema_editor):
+    # Case-insensitive prefix search (LOWER(col) LIKE 'prefix%') for the assignee typeahead. On
+    # PostgreSQL the pattern operator class lets such LIKE queries use the index under any collation.
+    opclass = " text_pattern_ops" if schema_editor.connection.vendor == "postgresql" else ""
+    for name, column in INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON accounts_account (LOWER("{column}"){opclass})')
+
+
+def drop_indexes(apps, schema_editor):
+    for name, _ in INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -19,6 +19,7 @@ from common_core.models import IdentityBase, AuditBase, SoftDeleteBase
 from common_core.models.meta import MetaBase
 from .constants import USERNAME_REGEX
 from .managers import AccountManager
+from .permissions import get_permission_codenames
 
 logger = logging.getLogger(__name__)
 
@@ -79,7 +80,8 @@ class Account(IdentityBase, AuditBase, MetaBase, AbstractBaseUser):
     def has_perms(self, perms: str):
         if self.is_admin:
             return True
-        return len(self.shkolamodulemembership_set.filter(module_role__permissions__codename=perms)) > 0
+        # Resolved once per request and cached across requests, see permissions.py
+        return perms in get_permission_codenames(self)
 
     @property
     def is_staff(self):
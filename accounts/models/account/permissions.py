@@ -0,0 +1,181 @@
+"""
+Account permission resolution
+
+An account's effective permission codenames are loaded with one query, then answered from a set:
+- per request, from the Account instance (request.user lives for one request)
+- across requests, from the ACCOUNT_PERMISSIONS_CACHE cache, under a per-account version that
+  invalidate_permissions bumps whenever the account's memberships or their roles change
+
+The cross-request tier is only used with a cache every process shares (Redis, memcached, database,
+file). A local-memory cache would keep answering from a set another process had invalidated, so with
+one the codenames are loaded once per request instead.
+
+The codenames come from the account's module memberships
+(membership.module_role.permissions). Deployments without the membership model
+resolve to no permissions, so only admins pass has_perms.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+
+MEMBERSHIPS_ACCESSOR = "shkolamodulemembership_set"
+MEMBERSHIP_ROLE_FIELD = "module_role"
+ROLE_PERMISSIONS_FIELD = "permissions"
+
+# Backends whose entries live in one process, invisible to the others' invalidations
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
+
+
+def _version_key(account_pk):
+    return f"account-perms-version:{account_pk}"
+
+
+def _permissions_key(account_pk, version):
+    return f"account-perms:{account_pk}:{version}"
+
+
+def shared_cache():
+    """The ACCOUNT_PERMISSIONS_CACHE cache, or None if it is local to this process."""
+    cache = caches[settings.ACCOUNT_PERMISSIONS_CACHE]
+    if isinstance(cache, PROCESS_LOCAL_CACHES):
+        return None
+    return cache
+
+
+def load_permission_codenames(account):
+    """Reads the account's permission codenames from the database, without caching."""
+    memberships = getattr(account, MEMBERSHIPS_ACCESSOR, None)
+    if memberships is None:
+        return frozenset()
+    return frozenset(
+        codename
+        for codename in memberships.values_list("module_role__permissions__codename", flat=True)
+        if codename
+    )
+
+
+def get_permission_codenames(account):
+    """
+    The account's permission codenames as a frozenset, from the instance, the shared cache, or the
+    database, in that order.
+    """
+    cached = getattr(account, "_permission_codenames", None)
+    if cached is not None:
+        return cached
+
+    cache = shared_cache()
+    if cache is None:
+        account._permission_codenames = load_permission_codenames(account)
+        return account._permission_codenames
+
+    version = cache.get_or_set(_version_key(account.pk), 1, timeout=None)
+    key = _permissions_key(account.pk, version)
+    codenames = cache.get(key)
+    if codenames is None:
+        codenames = load_permission_codenames(account)
+        cache.set(key, codenames, timeout=settings.ACCOUNT_PERMISSIONS_CACHE_TIMEOUT)
+
+    account._permission_codenames = codenames
+    return codenames
+
+
+def invalidate_permissions(account_pk):
+    """
+    Makes the next permission check of the account reload its codenames.
+
+    Bumping the version orphans every cached set at once; they expire on their own.
+    """
+    cache = shared_cache()
+    if cache is None:
+        return
+    try:
+        cache.incr(_version_key(account_pk))
+    except ValueError:
+        # No version yet, so nothing is cached under one
+        pass
+
+
+def connect_membership_signals():
+    """
+    Invalidates an account's permissions whenever one of its memberships is saved or deleted, and
+    the permissions of every member of a role whenever the role's permissions change or the role or
+    one of its permissions is deleted.
+    Called from AccountsConfig.ready; does nothing without the membership model.
+    """
+    from .models import Account
+
+    for relation in Account._meta.related_objects:
+        if relation.get_accessor_name() != MEMBERSHIPS_ACCESSOR:
+            continue
+        membership_model = relation.related_model
+        attname = relation.field.attname
+
+        def membership_changed(sender, instance=None, **kwargs):
+            invalidate_permissions(getattr(instance, attname))
+
+        post_save.connect(membership_changed, sender=membership_model, weak=False,
+                          dispatch_uid="account_membership_saved")
+        post_delete.connect(membership_changed, sender=membership_model, weak=False,
+                            dispatch_uid="account_membership_deleted")
+        _connect_role_signals(membership_model, attname)
+
+
+def _connect_role_signals(membership_model, attname):
+    role_field = membership_model._meta.get_field(MEMBERSHIP_ROLE_FIELD)
+    role_model = role_field.related_model
+    permissions_field = role_model._meta.get_field(ROLE_PERMISSIONS_FIELD)
+    through = permissions_field.remote_field.through
+    through_role = through._meta.get_field(permissions_field.m2m_field_name()).attname
+    through_permission = through._meta.get_field(permissions_field.m2m_reverse_field_name()).attname
+
+    def member_ids(role_ids):
+        return set(
+            membership_model._default_manager
+            .filter(**{f"{role_field.name}__in": role_ids})
+            .values_list(attname, flat=True)
+        )
+
+    def role_ids_with_permissions(permission_ids):
+        return through._default_manager.filter(
+            **{f"{through_permission}__in": permission_ids}
+        ).values_list(through_role, flat=True)
+
+    def invalidate_members(account_ids):
+        for account_pk in account_ids:
+            invalidate_permissions(account_pk)
+
+    def role_permissions_changed(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+        if not reverse:
+            role_ids = [instance.pk]
+        elif action == "pre_clear":
+            # The rows are gone by post_clear, so note whose roles lose the permission now
+            instance._role_member_ids = member_ids(role_ids_with_permissions([instance.pk]))
+            return
+        elif action == "post_clear":
+            invalidate_members(instance.__dict__.pop("_role_member_ids", ()))
+            return
+        else:
+            role_ids = pk_set or ()
+        if action in ("post_add", "post_remove", "post_clear"):
+            invalidate_members(member_ids(role_ids))
+
+    def role_deleting(sender, instance=None, **kwargs):
+        instance._role_member_ids = member_ids([instance.pk])
+
+    def permission_deleting(sender, instance=None, **kwargs):
+        # The role links go with the permission without an m2m_changed signal
+        instance._role_member_ids = member_ids(role_ids_with_permissions([instance.pk]))
+
+    def deleted(sender, instance=None, **kwargs):
+        invalidate_members(instance.__dict__.pop("_role_member_ids", ()))
+
+    m2m_changed.connect(role_permissions_changed, sender=through, weak=False,
+                        dispatch_uid="account_role_permissions_changed")
+    pre_delete.connect(role_deleting, sender=role_model, weak=False, dispatch_uid="account_role_deleting")
+    post_delete.connect(deleted, sender=role_model, weak=False, dispatch_uid="account_role_deleted")
+    pre_delete.connect(permission_deleting, sender=permissions_field.related_model, weak=False,
+                       dispatch_uid="account_role_permission_deleting")
+    post_delete.connect(deleted, sender=permissions_field.related_model, weak=False,
+                        dispatch_uid="account_role_permission_deleted")
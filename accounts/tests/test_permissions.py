@@ -0,0 +1,157 @@
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.cache import caches
+from django.db import connection, models
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import isolate_apps
+
+from accounts.models import Account
+from accounts.models.account import permissions
+from accounts.models.account.permissions import get_permission_codenames, invalidate_permissions
+
+
+def loading(codenames):
+    """A load_permission_codenames stand-in that costs one query, like the real one."""
+    def load(account):
+        Account.objects.filter(pk=account.pk).exists()
+        return frozenset(codenames)
+    return load
+
+
+class PermissionCacheTests(TestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        # A file cache stands in for a cache shared between processes
+        shared = override_settings(CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": cache_dir},
+        })
+        shared.enable()
+        self.addCleanup(shared.disable)
+
+        self.account = Account.objects.create_user(username="member", password="pw")
+        patcher = mock.patch.object(permissions, "load_permission_codenames", side_effect=loading({"view_document"}))
+        self.load = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fresh_account(self):
+        # A new request gets a new request.user
+        return Account.objects.get(pk=self.account.pk)
+
+    def test_warm_checks_make_no_queries(self):
+        account = self.fresh_account()
+        with self.assertNumQueries(1):
+            self.assertTrue(account.has_perms("view_document"))
+        with self.assertNumQueries(0):
+            self.assertFalse(account.has_perms("delete_document"))
+
+        account = self.fresh_account()
+        with self.assertNumQueries(0):
+            self.assertTrue(account.has_perms("view_document"))
+        self.assertEqual(self.load.call_count, 1)
+
+    def test_invalidation_reloads(self):
+        self.assertEqual(get_permission_codenames(self.fresh_account()), {"view_document"})
+
+        self.load.side_effect = loading({"view_document", "delete_document"})
+        self.assertEqual(get_permission_codenames(self.fresh_account()), {"view_document"})
+        invalidate_permissions(self.account.pk)
+
+        self.assertEqual(get_permission_codenames(self.fresh_account()), {"view_document", "delete_document"})
+        self.assertEqual(self.load.call_count, 2)
+
+    def test_process_local_cache_is_not_shared_between_requests(self):
+        with self.settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}):
+            for _ in range(2):
+                account = self.fresh_account()
+                with self.assertNumQueries(1):
+                    account.has_perms("view_document")
+                with self.assertNumQueries(0):
+                    account.has_perms("view_document")
+            invalidate_permissions(self.account.pk)
+
+            self.assertEqual(self.load.call_count, 2)
+            self.assertIsNone(caches["default"].get(f"account-perms-version:{self.account.pk}"))
+
+
+@isolate_apps("accounts")
+class RoleSignalTests(TransactionTestCase):
+    available_apps = ["accounts"]
+
+    def setUp(self):
+        class Permission(models.Model):
+            codename = models.CharField(max_length=100)
+
+        class Role(models.Model):
+            permissions = models.ManyToManyField(Permission)
+
+        class Membership(models.Model):
+            account_id = models.IntegerField()
+            module_role = models.ForeignKey(Role, on_delete=models.CASCADE)
+
+        self.Permission, self.Role, self.Membership = Permission, Role, Membership
+        # create_model makes the Role.permissions table too
+        self.models = [Permission, Role, Membership]
+        with connection.schema_editor() as editor:
+            for model in self.models:
+                editor.create_model(model)
+        self.addCleanup(self.drop_tables)
+
+        permissions._connect_role_signals(Membership, "account_id")
+        self.addCleanup(self.disconnect)
+        patcher = mock.patch.object(permissions, "invalidate_permissions")
+        self.invalidate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.view = Permission.objects.create(codename="view")
+        self.delete = Permission.objects.create(codename="delete")
+        self.editor, self.reader = Role.objects.create(), Role.objects.create()
+        for account_id, role in ((1, self.editor), (2, self.editor), (3, self.reader)):
+            Membership.objects.create(account_id=account_id, module_role=role)
+        self.invalidate.reset_mock()
+
+    def drop_tables(self):
+        with connection.schema_editor() as editor:
+            for model in reversed(self.models):
+                editor.delete_model(model)
+
+    def disconnect(self):
+        m2m_changed.disconnect(sender=self.Role.permissions.through, dispatch_uid="account_role_permissions_changed")
+        pre_delete.disconnect(sender=self.Role, dispatch_uid="account_role_deleting")
+        post_delete.disconnect(sender=self.Role, dispatch_uid="account_role_deleted")
+        pre_delete.disconnect(sender=self.Permission, dispatch_uid="account_role_permission_deleting")
+        post_delete.disconnect(sender=self.Permission, dispatch_uid="account_role_permission_deleted")
+
+    def invalidated(self):
+        accounts = {call.args[0] for call in self.invalidate.call_args_list}
+        self.invalidate.reset_mock()
+        return accounts
+
+    def test_role_permission_changes_invalidate_members(self):
+        self.editor.permissions.add(self.view, self.delete)
+        self.assertEqual(self.invalidated(), {1, 2})
+        self.editor.permissions.remove(self.delete)
+        self.assertEqual(self.invalidated(), {1, 2})
+        self.editor.permissions.clear()
+        self.assertEqual(self.invalidated(), {1, 2})
+
+    def test_reverse_changes_invalidate_members(self):
+        self.view.role_set.add(self.editor, self.reader)
+        self.assertEqual(self.invalidated(), {1, 2, 3})
+        self.view.role_set.remove(self.reader)
+        self.assertEqual(self.invalidated(), {3})
+        self.view.role_set.clear()
+        self.assertEqual(self.invalidated(), {1, 2})
+
+    def test_deletes_invalidate_members(self):
+        self.reader.permissions.add(self.view)
+        self.editor.permissions.add(self.delete)
+        self.invalidated()
+
+        self.view.delete()
+        self.assertEqual(self.invalidated(), {3})
+        self.editor.delete()
+        self.assertEqual(self.invalidated(), {1, 2})
@@ -4,6 +4,8 @@ from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from pdfsign.routers import replica_reads
+
 
 class DefaultAPIView(APIView):
     permission_classes = [permissions.AllowAny]
@@ -22,6 +24,11 @@ class DefaultAPIView(APIView):
             raise AttributeError("serializer is required")
 
     def get(self, request, *args, **kwargs):
+        # Read-only: served from the read replica when one is configured
+        with replica_reads():
+            return self.list(request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
         self.required_checks()
 
         permissions_required = "view_" + self.permission_module
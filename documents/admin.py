@@ -1,6 +1,11 @@
 from django.contrib import admin
-from documents.models import Document, SignatureField
+from documents.models import Document, DocumentBlob, DocumentPage, DocumentRevision, SignatureField, DocumentJob, UploadSession
 
 # Register your models here.
 admin.site.register(Document)
 admin.site.register(SignatureField)
+admin.site.register(DocumentJob)
+admin.site.register(UploadSession)
+admin.site.register(DocumentBlob)
+admin.site.register(DocumentPage)
+admin.site.register(DocumentRevision)
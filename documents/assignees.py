@@ -0,0 +1,70 @@
+"""
+Typeahead search for the accounts a document owner can assign signature fields to.
+
+Accounts match on a username or email prefix, case-insensitively; the lower(username) and
+lower(email) expression indexes (accounts migration 0002) answer the prefix scan. The owner's
+recent assignees come first, then everyone else alphabetically, in small pages with a keyset cursor
+on username.
+"""
+from django.conf import settings
+from django.db.models import Max, Q
+from django.db.models.functions import Lower
+
+from accounts.models import Account
+from .models import SignatureField
+
+
+def recent_assignee_ids(owner):
+    """The ids of the accounts owner assigned fields to, most recent document first."""
+    return list(
+        SignatureField.objects.filter(document__owner=owner)
+        .values("assigned_user")
+        .annotate(last_assigned=Max("document__uploaded_at"))
+        # Assignees of the same document tie; every page must agree on which recents led the first
+        .order_by("-last_assigned", "assigned_user")
+        .values_list("assigned_user", flat=True)[:settings.ASSIGNEE_SEARCH_RECENT]
+    )
+
+
+def search_assignees(owner, query="", after=None, limit=None):
+    """
+    One page of active accounts matching query, for owner's assign page.
+
+    Args:
+        query: A username or email prefix; empty matches everyone.
+        after: The next_cursor of the previous page; None for the first page, which starts with
+            owner's recent assignees.
+        limit: Page size, capped at settings.ASSIGNEE_SEARCH_PAGE_SIZE.
+
+    Returns:
+        (accounts, recent_ids, next_cursor): recent_ids are the pks of the recent assignees on the
+        page; next_cursor is None on the last page.
+    """
+    limit = min(limit or settings.ASSIGNEE_SEARCH_PAGE_SIZE, settings.ASSIGNEE_SEARCH_PAGE_SIZE)
+    query = query.strip().lower()
+
+    accounts = Account.objects.filter(is_active=True)
+    if query:
+        accounts = accounts.annotate(username_lower=Lower("username"), email_lower=Lower("email")).filter(
+            Q(username_lower__startswith=query) | Q(email_lower__startswith=query)
+        )
+
+    # The recent assignees matching query lead the first page; later pages skip them
+    recent_ids = recent_assignee_ids(owner)
+    by_id = {account.pk: account for account in accounts.filter(pk__in=recent_ids)}
+    recent = [by_id[pk] for pk in recent_ids if pk in by_id][:limit]
+
+    others = accounts.exclude(pk__in=[account.pk for account in recent]).order_by("username")
+    if after is None:
+        room = limit - len(recent)
+    else:
+        recent = []
+        room = limit
+        others = others.filter(username__gt=after)
+
+    # One extra row tells whether there is a next page, without a COUNT
+    others = list(others[:room + 1])
+    has_more = len(others) > room
+    others = others[:room]
+    next_cursor = (others[-1].username if others else "") if has_more else None
+    return recent + others, {account.pk for account in recent}, next_cursor
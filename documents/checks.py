@@ -0,0 +1,22 @@
+"""
+System checks for the documents settings, run at startup and by `python manage.py check`.
+"""
+from django.conf import settings
+from django.core.checks import Error, register
+
+from .utils import COMPACTION_POLICIES
+
+
+@register()
+def check_compaction_policies(app_configs, **kwargs):
+    """The compaction policies named in settings must exist, or every compact job would fail."""
+    errors = []
+    for name in ("PDF_COMPACTION_ON_COMPLETE", "PDF_COMPACTION_IDLE"):
+        policy = getattr(settings, name)
+        if policy not in COMPACTION_POLICIES:
+            errors.append(Error(
+                f"{name} is '{policy}', which is not a compaction policy.",
+                hint=f"Use one of: {', '.join(COMPACTION_POLICIES)}.",
+                id="documents.E001",
+            ))
+    return errors
@@ -0,0 +1,88 @@
+"""
+A signer's inbox: the documents with signature fields assigned to them, newest upload first.
+
+Pages are cut with a keyset (cursor) on (uploaded_at, pk) rather than an offset, so fetching page 50
+costs the same as page 1 and documents uploaded meanwhile never shift a page. Membership is an
+IN (subquery) over SignatureField answered from the (assigned_user, signed, document) index, and
+the per-document counts are only computed for the rows of the page.
+"""
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Document, SignatureField
+
+
+def encode_cursor(document):
+    """An opaque cursor pointing just past document."""
+    return base64.urlsafe_b64encode(f"{document.uploaded_at.isoformat()}|{document.pk}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (uploaded_at, pk) a cursor points past.
+
+    Raises:
+        ValueError: If cursor was not made by encode_cursor.
+    """
+    try:
+        uploaded_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(uploaded_at), int(pk)
+    except (TypeError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def inbox_queryset(user, signed=False):
+    """
+    Documents holding fields assigned to user that are signed (or pending, the default), each
+    annotated with num_signatures, the number of such fields.
+    """
+    fields = SignatureField.objects.filter(assigned_user=user, signed=signed)
+    num_signatures = (
+        fields.filter(document=OuterRef("pk"))
+        .order_by()
+        .values("document")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+    return (
+        Document.objects.filter(pk__in=fields.values("document"))
+        .annotate(num_signatures=Coalesce(Subquery(num_signatures, output_field=IntegerField()), 0))
+        .order_by("-uploaded_at", "-pk")
+    )
+
+
+def inbox_page(user, signed=False, cursor=None, page_size=None):
+    """
+    One page of inbox_queryset.
+
+    Args:
+        cursor: The next_cursor of the previous page; None for the first page.
+        page_size: Defaults to settings.INBOX_PAGE_SIZE.
+
+    Returns:
+        (documents, next_cursor); next_cursor is None on the last page.
+
+    Raises:
+        ValueError: If cursor is invalid.
+    """
+    page_size = page_size or settings.INBOX_PAGE_SIZE
+    documents = inbox_queryset(user, signed)
+    if cursor:
+        uploaded_at, pk = decode_cursor(cursor)
+        documents = documents.filter(Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, pk__lt=pk))
+
+    # One extra row tells whether there is a next page, without a COUNT
+    documents = list(documents[:page_size + 1])
+    if len(documents) > page_size:
+        documents = documents[:page_size]
+        return documents, encode_cursor(documents[-1])
+    return documents, None
+
+
+def pending_count(user):
+    """How many documents wait on user's signature; an index-only count for the nav badge."""
+    return SignatureField.objects.filter(assigned_user=user, signed=False).values("document").distinct().count()
@@ -0,0 +1,529 @@
+"""
+Database-backed job queue for document post-processing.
+
+Jobs are rows in DocumentJob. Workers (see the process_jobs management command) claim a job by
+atomically flipping it to "running" with a lease; a job whose lease expires (e.g. the worker crashed)
+is claimed again by the next worker. Handlers must therefore be idempotent.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import time, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from accounts.models import Account
+from .models import Document, DocumentBlob, DocumentJob, SignatureField, normalized_blob_path
+from .rendering import purge_document, render_pages
+from .revisions import RevisionWriter
+from .signing import (
+    completion_qr_data,
+    field_boxes,
+    mark_completed,
+    mark_signed,
+    pending_fields,
+    prepare_rendition,
+)
+from .utils import COMPACTION_POLICIES, compact_pdf, normalize_pdf, read_page_geometry, stamp_signature_file
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+# Kinds whose running job may already be past the work a new enqueue asks for: a prewarm renders the
+# revision that was current when it started. These only merge into a job still waiting in the queue.
+QUEUED_DEDUPE_KINDS = {"prewarm_renders"}
+
+
+class JobDeferred(Exception):
+    """Raised by a handler to put its job back in the queue until run_after, without using up an attempt."""
+
+    def __init__(self, run_after, reason=""):
+        super().__init__(reason or f"Deferred until {run_after}")
+        self.run_after = run_after
+
+
+def job_handler(kind):
+    """Registers the decorated function as the handler for jobs of the given kind."""
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(kind, document=None, payload=None, run_after=None):
+    """
+    Queues a job, or returns the already queued/running job of the same kind for the document
+    (only an already queued one for QUEUED_DEDUPE_KINDS).
+
+    When settings.DOCUMENT_JOBS_EAGER is set the job runs immediately in the calling thread.
+    """
+    states = (DocumentJob.STATE_QUEUED,) if kind in QUEUED_DEDUPE_KINDS else DocumentJob.ACTIVE_STATES
+    if document is not None:
+        active = DocumentJob.objects.filter(document=document, kind=kind, state__in=states).first()
+        if active:
+            return active
+
+    try:
+        with transaction.atomic():
+            job = DocumentJob.objects.create(
+                kind=kind,
+                document=document,
+                payload=payload or {},
+                run_after=run_after or timezone.now(),
+            )
+    except IntegrityError:
+        # Lost the race against a concurrent enqueue of the same job
+        return DocumentJob.objects.filter(
+            document=document, kind=kind, state__in=DocumentJob.ACTIVE_STATES
+        ).order_by("-pk").first()
+
+    _run_eagerly(job)
+    return job
+
+
+def _run_eagerly(job):
+    if settings.DOCUMENT_JOBS_EAGER:
+        claimed = _claim(job.pk, "eager", timezone.now())
+        if claimed:
+            run_job(claimed)
+            job.refresh_from_db()
+
+
+def _claimable(now):
+    return Q(state=DocumentJob.STATE_QUEUED, run_after__lte=now) | Q(
+        state=DocumentJob.STATE_RUNNING, locked_until__lt=now
+    )
+
+
+def _claim(pk, worker_id, now):
+    claimed = DocumentJob.objects.filter(_claimable(now), pk=pk).update(
+        state=DocumentJob.STATE_RUNNING,
+        locked_by=worker_id,
+        locked_until=now + timedelta(seconds=settings.DOCUMENT_JOBS_LEASE_SECONDS),
+        attempts=F("attempts") + 1,
+    )
+    if claimed:
+        return DocumentJob.objects.select_related("document").get(pk=pk)
+    return None
+
+
+def claim_next(worker_id, kinds=None):
+    """
+    Claims the next due job for worker_id.
+
+    Returns:
+        The claimed DocumentJob, or None if nothing is due.
+    """
+    now = timezone.now()
+    candidates = DocumentJob.objects.filter(_claimable(now))
+    if kinds:
+        candidates = candidates.filter(kind__in=kinds)
+
+    # Another worker may grab a candidate first; the conditional UPDATE in _claim settles it.
+    for pk in candidates.order_by("run_after", "pk").values_list("pk", flat=True)[:10]:
+        job = _claim(pk, worker_id, now)
+        if job:
+            return job
+    return None
+
+
+def run_job(job):
+    """Runs a claimed job and records its outcome, re-queueing it with a backoff on failure."""
+    handler = HANDLERS.get(job.kind)
+
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for job kind '{job.kind}'")
+        if job.attempts > job.max_attempts:
+            raise RuntimeError(f"Gave up after {job.max_attempts} attempts")
+
+        result = handler(job)
+
+    except JobDeferred as e:
+        job.state = DocumentJob.STATE_QUEUED
+        job.run_after = e.run_after
+        job.attempts -= 1
+        job.locked_by = ""
+        job.locked_until = None
+        _save_requeued(job)
+        return job
+
+    except Exception as e:
+        logger.error(f"Job {job} failed: {e}", exc_info=True)
+        job.last_error = str(e)
+        job.locked_by = ""
+        job.locked_until = None
+        if job.attempts >= job.max_attempts or handler is None:
+            job.state = DocumentJob.STATE_FAILED
+            _on_failure(job)
+        else:
+            job.state = DocumentJob.STATE_QUEUED
+            job.run_after = timezone.now() + timedelta(seconds=2 ** job.attempts)
+        _save_requeued(job)
+        return job
+
+    job.state = DocumentJob.STATE_DONE
+    job.result = result or {}
+    job.last_error = ""
+    job.locked_by = ""
+    job.locked_until = None
+    job.save()
+    return job
+
+
+def _save_requeued(job):
+    try:
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        # Only for QUEUED_DEDUPE_KINDS: a newer job of the same kind was queued for the document
+        # while this one ran, and covers it
+        superseded_by = DocumentJob.objects.get(
+            document_id=job.document_id, kind=job.kind, state=DocumentJob.STATE_QUEUED
+        )
+        job.state = DocumentJob.STATE_DONE
+        job.result = {"superseded_by": superseded_by.pk}
+        job.save()
+
+
+def _on_failure(job):
+    if job.document_id and job.kind == "normalize":
+        Document.objects.filter(pk=job.document_id).update(status=Document.STATUS_FAILED)
+
+
+def normalize_blob(blob):
+    """
+    Normalizes a shared blob once, for every document referencing it.
+
+    The raw upload is never rewritten in place. The normalized output is written to a new file
+    named by its own hash. Under the blob's row lock, the first normalization to finish switches
+    the blob and its documents over to that file; a concurrent one finds the blob already normalized
+    and discards its output. The raw file is removed once the switch is committed: until then only
+    normalize jobs read it, since documents of an unnormalized blob are not ready.
+
+    Returns:
+        The page geometry of the normalized file.
+    """
+    if blob.normalized:
+        return read_page_geometry(blob.file.path)
+
+    fd, output_path = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(blob.file.path))
+    os.close(fd)
+    try:
+        try:
+            geometry = normalize_pdf(blob.file.path, output_path)
+        except FileNotFoundError:
+            # A concurrent normalization finished first and removed the raw file
+            blob.refresh_from_db()
+            if not blob.normalized:
+                raise
+            return read_page_geometry(blob.file.path)
+        hasher = hashlib.sha256()
+        with open(output_path, "rb") as output:
+            for chunk in iter(lambda: output.read(64 * 1024), b""):
+                hasher.update(chunk)
+        sha256 = hasher.hexdigest()
+        name = normalized_blob_path(sha256)
+
+        with transaction.atomic():
+            locked = DocumentBlob.objects.select_for_update().get(pk=blob.pk)
+            if locked.normalized:
+                return read_page_geometry(locked.file.path)
+
+            raw_path = locked.file.path
+            path = locked.file.storage.path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(output_path, path)
+            DocumentBlob.objects.filter(pk=blob.pk).update(
+                file=name, normalized=True, normalized_sha256=sha256, size=os.path.getsize(path)
+            )
+            Document.objects.filter(blob=blob.pk).update(file=name)
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    if raw_path != path and os.path.exists(raw_path):
+        os.remove(raw_path)
+    blob.refresh_from_db()
+    return geometry
+
+
+@job_handler("normalize")
+def normalize_document(job):
+    """Normalizes a freshly uploaded document, indexes its pages and marks it ready for signature assignment."""
+    document = job.document
+    Document.objects.filter(pk=document.pk).update(status=Document.STATUS_PROCESSING)
+
+    # normalize_pdf writes through a temp file, so re-running it after a crash is harmless
+    if document.blob_id:
+        geometry = normalize_blob(document.blob)
+        # Now pointing at the normalized file
+        document.refresh_from_db(fields=["file", "blob"])
+    else:
+        geometry = normalize_pdf(document.file.path)
+
+    document.index_pages(geometry)
+    document.record_revision("upload")
+
+    Document.objects.filter(pk=document.pk).update(status=Document.STATUS_READY)
+    return {"status": Document.STATUS_READY}
+
+
+@job_handler("prewarm_renders")
+def prewarm_renders(job):
+    """Renders the pages holding signature fields, so signers see them without waiting on a render."""
+    document = Document.objects.get(pk=job.document_id)
+    page_count = len(document.get_pages())
+    numbers = sorted(
+        number for number in set(document.signature_fields.values_list("page", flat=True))
+        if 1 <= number <= page_count
+    )
+
+    for scale in settings.PAGE_RENDER_PREWARM_SCALES:
+        render_pages(document, numbers, scale)
+
+    # Renders of earlier revisions can never be requested again
+    purge_document(document, keep_revision=document.revision)
+    return {"revision": document.revision, "pages": numbers}
+
+
+def enqueue_batch_sign(user, documents):
+    """
+    Queues a batch_sign job for user, unless one of theirs is still queued or running.
+
+    Batch jobs have no document, so enqueue cannot deduplicate them. The user's row is locked
+    instead, so a double submit cannot start two batches signing the same documents.
+
+    Args:
+        documents: A list of document ids, or "all".
+
+    Returns:
+        (job, created): the new job, or the user's active one with created False.
+    """
+    with transaction.atomic():
+        Account.objects.select_for_update().get(pk=user.pk)
+        active = DocumentJob.objects.filter(
+            kind="batch_sign", payload__user_id=str(user.pk), state__in=DocumentJob.ACTIVE_STATES
+        ).first()
+        if active:
+            return active, False
+        job = DocumentJob.objects.create(kind="batch_sign", payload={"user_id": str(user.pk), "documents": documents})
+
+    _run_eagerly(job)
+    return job, True
+
+
+def _report_progress(job, result):
+    # Written straight to the row so status polls see progress while the job is still running
+    DocumentJob.objects.filter(pk=job.pk).update(result=result)
+
+
+@job_handler("batch_sign")
+def batch_sign(job):
+    """
+    Signs every pending field of a user on a list of documents (payload "documents", or "all" for
+    everything waiting on them), stamping the documents in parallel worker processes. "all" takes at
+    most settings.BATCH_SIGN_MAX_DOCUMENTS documents, oldest first; result["remaining"] counts the rest.
+
+    The signature rendition is prepared once for the whole batch. Progress and per-document results
+    are kept in job.result as documents finish.
+    """
+    user = Account.objects.get(pk=job.payload["user_id"])
+    requested = job.payload.get("documents", "all")
+
+    fields = SignatureField.objects.filter(assigned_user=user, signed=False).select_related("document")
+    if requested != "all":
+        fields = fields.filter(document_id__in=requested)
+
+    remaining = 0
+    if requested == "all":
+        # Capped like explicit lists; the user runs another batch for the rest
+        pending = sorted(set(fields.values_list("document_id", flat=True)))
+        remaining = max(len(pending) - settings.BATCH_SIGN_MAX_DOCUMENTS, 0)
+        fields = fields.filter(document_id__in=pending[:settings.BATCH_SIGN_MAX_DOCUMENTS])
+
+    documents = {}
+    fields_by_document = {}
+    for field in fields.order_by("document_id", "pk"):
+        documents.setdefault(field.document_id, field.document)
+        fields_by_document.setdefault(field.document_id, []).append(field)
+
+    results = {}
+    if requested != "all":
+        for pk in requested:
+            if pk not in documents:
+                results[str(pk)] = {"status": "skipped", "error": "Nothing to sign"}
+    for pk, document in list(documents.items()):
+        if document.status != Document.STATUS_READY:
+            results[str(pk)] = {"status": "skipped", "error": "Document is still being processed"}
+            del documents[pk]
+
+    result = {"total": len(documents), "done": 0, "signed": 0, "failed": 0, "remaining": remaining, "results": results}
+    _report_progress(job, result)
+    if not documents:
+        return result
+
+    all_fields = [field for pk in documents for field in fields_by_document[pk]]
+    rendition = prepare_rendition(user.signature, all_fields)
+
+    def record(document, entry):
+        results[str(document.pk)] = entry
+        if entry["status"] in result:
+            result[entry["status"]] += 1
+        result["done"] += 1
+        _report_progress(job, result)
+
+    queue = list(documents.values())
+    in_flight = {}
+    # Spawned rather than forked: the job worker runs several threads and holds database connections
+    workers = max(1, min(settings.BATCH_SIGN_WORKERS, len(documents)))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        try:
+            while queue or in_flight:
+                # Only documents being stamped hold their write lock, so a signer of any other document
+                # in the batch never waits on it. Locks are taken in document order, like every batch.
+                while queue and len(in_flight) < workers:
+                    document = queue.pop(0)
+                    writer = RevisionWriter(document, "signature")
+                    try:
+                        writer.open()
+                        pending = pending_fields(fields_by_document[document.pk])
+                        qr_data = completion_qr_data(document, pending) if pending else None
+                    except Exception as e:
+                        writer.abort()
+                        logger.error(f"Batch signing of {document} failed: {e}", exc_info=True)
+                        record(document, {"status": "failed", "error": str(e)})
+                        continue
+
+                    if not pending:
+                        writer.abort()
+                        record(document, {"status": "skipped", "error": "Already signed"})
+                        continue
+
+                    future = pool.submit(
+                        stamp_signature_file, writer.path, field_boxes(pending), *rendition, qr_data=qr_data
+                    )
+                    if qr_data:
+                        writer.with_commit(mark_completed(document))
+                    in_flight[future] = (document, writer, pending)
+
+                if not in_flight:
+                    continue
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    document, writer, pending = in_flight.pop(future)
+                    try:
+                        future.result()
+                        writer.with_commit(mark_signed(pending))
+                        writer.commit()
+                    except Exception as e:
+                        writer.abort()
+                        logger.error(f"Batch signing of {document} failed: {e}", exc_info=True)
+                        record(document, {"status": "failed", "error": str(e)})
+                    else:
+                        enqueue("prewarm_renders", document=document)
+                        if document.signed:
+                            schedule_compaction(document, settings.PDF_COMPACTION_ON_COMPLETE)
+                        record(document, {"status": "signed", "fields": len(pending)})
+        finally:
+            for _, writer, _ in in_flight.values():
+                writer.abort()
+
+    return result
+
+
+def compaction_window(now=None):
+    """
+    Returns the (start, end) of the current or next off-peak window for compaction jobs, in local
+    time, from settings.PDF_COMPACTION_WINDOW ("HH:MM-HH:MM"; may wrap past midnight). With no
+    window configured, compaction may run any time and (now, None) is returned.
+    """
+    now = timezone.localtime(now)
+    if not settings.PDF_COMPACTION_WINDOW:
+        return now, None
+
+    start_time, end_time = (time.fromisoformat(part.strip()) for part in settings.PDF_COMPACTION_WINDOW.split("-"))
+    start = now.replace(hour=start_time.hour, minute=start_time.minute, second=0, microsecond=0)
+    end = now.replace(hour=end_time.hour, minute=end_time.minute, second=0, microsecond=0)
+    if end <= start:
+        end += timedelta(days=1)
+
+    # A window that wraps past midnight may have opened yesterday
+    if start - timedelta(days=1) <= now < end - timedelta(days=1):
+        return start - timedelta(days=1), end - timedelta(days=1)
+    if now >= end:
+        return start + timedelta(days=1), end + timedelta(days=1)
+    return start, end
+
+
+def schedule_compaction(document, policy):
+    """
+    Queues a compaction of document with the named policy (see documents.utils.COMPACTION_POLICIES)
+    for the next off-peak window. Does nothing for the "none" policy.
+
+    Raises:
+        ValueError: If policy is not one of COMPACTION_POLICIES.
+    """
+    if policy not in COMPACTION_POLICIES:
+        raise ValueError(f"Unknown compaction policy '{policy}'")
+    if policy == "none":
+        return None
+    return enqueue("compact", document=document, payload={"policy": policy}, run_after=compaction_window()[0])
+
+
+@job_handler("compact")
+def compact_document(job):
+    """
+    Rewrites a document's file with the job's compaction policy, as a new revision. Earlier revisions
+    are kept in an archive of the file as it was (see RevisionWriter.replace).
+
+    Request-path writes only ever append, so this is where files shrink back. Documents carrying
+    digital signatures are skipped (see documents.utils.compact_pdf), as are files still shared with
+    other uploads and rewrites that would not save anything.
+    """
+    start, _ = compaction_window()
+    if timezone.now() < start:
+        # Claimed outside the window, e.g. by a worker catching up on a backlog
+        raise JobDeferred(start)
+
+    document = Document.objects.get(pk=job.document_id)
+    if document.blob_id:
+        return {"status": "skipped", "reason": "Shared file"}
+
+    policy = job.payload.get("policy", settings.PDF_COMPACTION_IDLE)
+    if policy not in COMPACTION_POLICIES:
+        # Retrying would not help; schedule_compaction and the system checks keep these out
+        return {"status": "skipped", "reason": f"Unknown policy '{policy}'"}
+    if COMPACTION_POLICIES[policy] is None:
+        return {"status": "skipped", "reason": "Policy none"}
+
+    writer = RevisionWriter(document, "compaction").open()
+    # Next to the document, so the rewrite is moved into place rather than copied
+    fd, compacted_path = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(writer.path))
+    os.close(fd)
+    try:
+        if not compact_pdf(writer.path, compacted_path, policy):
+            return {"status": "skipped", "reason": "Digitally signed"}
+
+        before, after = os.path.getsize(writer.path), os.path.getsize(compacted_path)
+        if after >= before:
+            return {"status": "skipped", "reason": "No gain", "size": before}
+
+        revision = writer.replace(compacted_path)
+    finally:
+        writer.abort()
+        if os.path.exists(compacted_path):
+            os.remove(compacted_path)
+
+    # Also drops the renders cached for the replaced revisions
+    enqueue("prewarm_renders", document=document)
+    return {"status": "compacted", "policy": policy, "revision": revision, "before": before, "after": after}
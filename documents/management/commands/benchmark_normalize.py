@@ -0,0 +1,81 @@
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import fitz
+from django.core.management.base import BaseCommand
+from pikepdf import Pdf
+
+from documents.utils import normalize_pdf, remove_hybrid_xrefs
+
+SIZES = {
+    "small": 5,
+    "medium": 50,
+    "large": 300,
+}
+
+
+def build_sample_pdf(path, page_count):
+    """Builds a text-heavy sample PDF with xref streams, similar to what office suites export."""
+    doc = fitz.open()
+    for number in range(page_count):
+        page = doc.new_page()
+        page.insert_textbox(
+            fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50),
+            f"Page {number + 1}\n" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40,
+            fontsize=9,
+        )
+        page.draw_rect(fitz.Rect(40, 40, page.rect.width - 40, page.rect.height - 40), color=(0, 0, 0))
+    doc.save(path, use_objstms=1, deflate=True)
+    doc.close()
+
+
+def legacy_normalize(pdf_path):
+    """The previous upload path: pypdf rewrite followed by a pikepdf rewrite."""
+    remove_hybrid_xrefs(pdf_path, pdf_path)
+    with Pdf.open(pdf_path, allow_overwriting_input=True) as pdf:
+        pdf.save(pdf_path)
+
+
+class Command(BaseCommand):
+    help = "Compares the single-pass normalize_pdf against the legacy pypdf + pikepdf upload path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per sample and strategy")
+        parser.add_argument(
+            "--sizes", nargs="+", choices=list(SIZES), default=list(SIZES), help="Sample sizes to run"
+        )
+
+    def handle(self, *args, **options):
+        strategies = {
+            "legacy": legacy_normalize,
+            "single-pass": normalize_pdf,
+        }
+
+        with tempfile.TemporaryDirectory() as workdir:
+            for size in options["sizes"]:
+                sample_path = os.path.join(workdir, f"{size}.pdf")
+                build_sample_pdf(sample_path, SIZES[size])
+                sample_kb = os.path.getsize(sample_path) / 1024
+
+                results = {}
+                for name, strategy in strategies.items():
+                    timings = []
+                    for _ in range(options["repeat"]):
+                        run_path = os.path.join(workdir, f"{size}-{name}.pdf")
+                        shutil.copyfile(sample_path, run_path)
+
+                        start = time.perf_counter()
+                        strategy(run_path)
+                        timings.append(time.perf_counter() - start)
+
+                    results[name] = statistics.median(timings)
+
+                self.stdout.write(
+                    f"{size:>6} ({SIZES[size]} pages, {sample_kb:,.0f} KB): "
+                    f"legacy {results['legacy'] * 1000:,.1f} ms, "
+                    f"single-pass {results['single-pass'] * 1000:,.1f} ms, "
+                    f"speedup x{results['legacy'] / results['single-pass']:.2f}"
+                )
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from documents.jobs import schedule_compaction
+from documents.models import Document, DocumentRevision
+from documents.utils import COMPACTION_POLICIES
+
+
+class Command(BaseCommand):
+    help = "Queues compaction, in the next off-peak window, of documents left unchanged for a while (run daily from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--policy", choices=COMPACTION_POLICIES, default=settings.PDF_COMPACTION_IDLE)
+        parser.add_argument(
+            "--idle-days", type=int, default=settings.PDF_COMPACTION_IDLE_DAYS,
+            help="Only documents whose latest revision is at least this old",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["idle_days"])
+        latest = DocumentRevision.objects.filter(document=OuterRef("pk")).order_by("-number")
+
+        documents = (
+            Document.objects.filter(status=Document.STATUS_READY, blob__isnull=True)
+            # Compaction would invalidate digital signatures; the job checks the file itself too
+            .exclude(revisions__reason="digital_signature")
+            .annotate(last_write=Subquery(latest.values("created_at")[:1]), last_reason=Subquery(latest.values("reason")[:1]))
+            .filter(last_write__lt=cutoff)
+            .exclude(last_reason="compaction")
+        )
+
+        queued = 0
+        for document in documents.iterator():
+            if schedule_compaction(document, options["policy"]):
+                queued += 1
+        self.stdout.write(f"Queued {queued} document(s) for compaction")
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from documents.uploads import expire_upload_sessions
+
+
+class Command(BaseCommand):
+    help = "Deletes chunked upload sessions left incomplete, with their part files (run daily from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours", type=int, default=settings.CHUNKED_UPLOAD_EXPIRY_HOURS,
+            help="Only sessions that received nothing for at least this long",
+        )
+
+    def handle(self, *args, **options):
+        expired = expire_upload_sessions(timezone.now() - timedelta(hours=options["hours"]))
+        self.stdout.write(f"Deleted {expired} expired upload session(s)")
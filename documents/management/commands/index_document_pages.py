@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from documents.models import Document
+from documents.utils import read_page_geometry
+
+
+class Command(BaseCommand):
+    help = "Builds the page geometry index for documents uploaded before it existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Re-index documents that already have pages")
+
+    def handle(self, *args, **options):
+        documents = Document.objects.all()
+        if not options["all"]:
+            documents = documents.filter(pages__isnull=True)
+
+        for document in documents.iterator():
+            try:
+                document.index_pages(read_page_geometry(document.file.path))
+            except Exception as e:
+                self.stderr.write(f"{document}: {e}")
+                continue
+            self.stdout.write(f"Indexed {document}")
@@ -0,0 +1,60 @@
+import os
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from documents.jobs import claim_next, run_job
+
+
+class Command(BaseCommand):
+    help = "Runs the document job worker pool (python manage.py process_jobs)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=2, help="Number of worker threads")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to sleep when idle")
+        parser.add_argument("--kind", action="append", dest="kinds", help="Only run jobs of this kind")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is drained")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+        threads = [
+            threading.Thread(
+                target=self.work,
+                args=(f"{worker_prefix}:{number}", stop, options),
+                daemon=True,
+            )
+            for number in range(options["workers"])
+        ]
+        for thread in threads:
+            thread.start()
+
+        self.stdout.write(f"Started {len(threads)} job worker(s)")
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping workers after their current job...")
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def work(self, worker_id, stop, options):
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                job = claim_next(worker_id, kinds=options["kinds"])
+                if job is None:
+                    if options["once"]:
+                        return
+                    stop.wait(options["poll_interval"])
+                    continue
+
+                job = run_job(job)
+                self.stdout.write(f"[{worker_id}] {job}")
+        finally:
+            connection.close()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from documents.models import Document
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the fields_total and fields_signed counters of documents from their signature fields"
+
+    def add_arguments(self, parser):
+        parser.add_argument("document_ids", nargs="*", type=int, help="Only these documents (default: all)")
+
+    def handle(self, *args, **options):
+        documents = Document.objects.all()
+        if options["document_ids"]:
+            documents = documents.filter(pk__in=options["document_ids"])
+
+        self.stdout.write(f"Recounted {documents.recount_fields()} document(s)")
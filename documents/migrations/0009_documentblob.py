@@ -0,0 +1,36 @@
+# Generated by Django 4.2.1 on 2026-10-18 20:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+import documents.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0008_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentBlob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('file', models.FileField(max_length=512, upload_to=documents.models.blob_upload_path)),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('normalized', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='filename',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='documents', to='documents.documentblob'),
+        ),
+    ]
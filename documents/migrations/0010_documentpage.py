@@ -0,0 +1,32 @@
+# Generated by Django 4.2.1 on 2026-10-18 20:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0009_documentblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentPage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('mediabox', models.JSONField()),
+                ('cropbox', models.JSONField()),
+                ('rotation', models.IntegerField(default=0)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='documents.document')),
+            ],
+            options={
+                'ordering': ('number',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='documentpage',
+            constraint=models.UniqueConstraint(fields=('document', 'number'), name='unique_document_page'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 20:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0010_documentpage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='revision',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
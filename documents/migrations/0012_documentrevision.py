@@ -0,0 +1,32 @@
+# Generated by Django 4.2.1 on 2026-10-18 20:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0011_document_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentRevision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('reason', models.CharField(blank=True, max_length=32)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='documents.document')),
+            ],
+            options={
+                'ordering': ('document', 'number'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='documentrevision',
+            constraint=models.UniqueConstraint(fields=('document', 'number'), name='unique_document_revision'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.1 on 2026-10-18 21:01
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_fields(apps, schema_editor):
+    Document = apps.get_model("documents", "Document")
+    SignatureField = apps.get_model("documents", "SignatureField")
+
+    def count(**filters):
+        counted = (
+            SignatureField.objects.filter(document=OuterRef("pk"), **filters)
+            .order_by()
+            .values("document")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        return Coalesce(Subquery(counted), 0)
+
+    Document.objects.update(fields_total=count(), fields_signed=count(signed=True))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0012_documentrevision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='fields_signed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='fields_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.1 on 2026-10-18 21:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0013_document_field_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['uploaded_at', 'id'], name='document_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='signaturefield',
+            index=models.Index(fields=['assigned_user', 'signed', 'document'], name='signaturefield_inbox_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 23:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0014_inbox_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentblob',
+            name='normalized_sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
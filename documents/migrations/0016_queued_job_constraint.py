@@ -0,0 +1,21 @@
+# Generated by Django 4.2.1 on 2026-10-18 21:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0015_documentblob_normalized_sha256'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='documentjob',
+            name='unique_active_document_job',
+        ),
+        migrations.AddConstraint(
+            model_name='documentjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('state', 'queued')), fields=('document', 'kind'), name='unique_queued_document_job'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.1 on 2026-10-18 21:35
+
+from django.db import migrations, models
+import documents.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0016_queued_job_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentrevision',
+            name='archive',
+            field=models.FileField(blank=True, max_length=512, upload_to=documents.models.revision_archive_path),
+        ),
+    ]
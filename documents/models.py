@@ -1,9 +1,15 @@
 import os
-import shutil
+import uuid
 
 from django.core.files.base import File
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.conf import settings
+from django.utils import timezone
+from django.utils.crypto import get_random_string
 
 
 def document_upload_path(instance, filename):
@@ -11,78 +17,384 @@ def document_upload_path(instance, filename):
     return f"documents/{instance.owner.username}/{filename}"
 
 
+def blob_upload_path(instance, filename):
+    """Generate a content-addressed path for a shared document blob."""
+    return f"blobs/{instance.sha256[:2]}/{instance.sha256[2:4]}/{instance.sha256}.pdf"
+
+
+def revision_archive_path(instance, filename):
+    """Where a document's file is kept when compaction replaces it, named by the revision it was at."""
+    return f"archive/documents/{instance.document_id}/{filename}"
+
+
+def normalized_blob_path(sha256):
+    """The content-addressed path of a blob's normalized file, by the SHA-256 of the normalized bytes."""
+    return f"blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}.normalized.pdf"
+
+
+class DocumentBlobManager(models.Manager):
+    def acquire(self, uploaded_file, sha256):
+        """
+        Returns the blob for the given content hash with one more reference, storing
+        uploaded_file only if no blob with that hash exists yet.
+        """
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    blob, created = self.select_for_update().get_or_create(
+                        sha256=sha256, defaults={"size": uploaded_file.size}
+                    )
+            except IntegrityError:
+                # A concurrent upload of the same content created it first
+                blob, created = self.select_for_update().get(sha256=sha256), False
+
+            if created or not blob.file or not blob.file.storage.exists(blob.file.name):
+                blob.file.save("blob.pdf", uploaded_file, save=False)
+                # Stored again as uploaded, so it needs normalizing again
+                blob.normalized = False
+                blob.normalized_sha256 = ""
+
+            blob.ref_count = F("ref_count") + 1
+            blob.save()
+            blob.refresh_from_db()
+
+        return blob
+
+    def release(self, sha256):
+        """Drops one reference to a blob, deleting the blob and its file once nothing references it."""
+        with transaction.atomic():
+            blob = self.select_for_update().filter(sha256=sha256).first()
+            if blob is None:
+                return
+
+            if blob.ref_count > 1:
+                self.filter(pk=blob.pk).update(ref_count=F("ref_count") - 1)
+                return
+
+            if blob.file:
+                blob.file.delete(save=False)
+            blob.delete()
+
+
+class DocumentBlob(models.Model):
+    """
+    Content-addressed storage for uploaded PDFs, shared by every Document uploaded with the same bytes.
+
+    The key is the SHA-256 of the upload as received. Normalization (see documents.jobs.normalize_blob)
+    never rewrites the stored file: it writes a new file named by normalized_sha256 and switches the
+    blob and its documents over to it. Blob files are never modified; a Document copies its blob
+    before its first write.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    file = models.FileField(upload_to=blob_upload_path, max_length=512)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    normalized = models.BooleanField(default=False)
+    # SHA-256 of the normalized file, once normalized
+    normalized_sha256 = models.CharField(max_length=64, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = DocumentBlobManager()
+
+    def __str__(self):
+        return f"{self.sha256} ({self.ref_count} references)"
+
+
+class DocumentQuerySet(models.QuerySet):
+    def recount_fields(self):
+        """
+        Rebuilds fields_total and fields_signed from the SignatureField rows, e.g. after writes that
+        bypassed the counters (raw SQL, fixtures).
+
+        Returns:
+            The number of documents updated.
+        """
+        def count(**filters):
+            counted = (
+                SignatureField.objects.filter(document=OuterRef("pk"), **filters)
+                .order_by()
+                .values("document")
+                .annotate(count=Count("pk"))
+                .values("count")
+            )
+            return Coalesce(Subquery(counted), 0)
+
+        return self.update(fields_total=count(), fields_signed=count(signed=True))
+
+
 class Document(models.Model):
+    STATUS_PENDING = "pending"
+    STATUS_PROCESSING = "processing"
+    STATUS_READY = "ready"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_PROCESSING, "Processing"),
+        (STATUS_READY, "Ready"),
+        (STATUS_FAILED, "Failed"),
+    )
+
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
         related_name="uploaded_documents"
     )
     file = models.FileField(upload_to=document_upload_path, max_length=512)
+    # Set while the document still shares its file with other uploads of the same content
+    blob = models.ForeignKey(
+        DocumentBlob,
+        on_delete=models.PROTECT,
+        related_name="documents",
+        null=True,
+        blank=True
+    )
+    filename = models.CharField(max_length=255, blank=True)
+    # Incremented on every write to the file; keys caches derived from its content
+    revision = models.PositiveIntegerField(default=1)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     signed = models.BooleanField(default=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_READY)
+    # Denormalized SignatureField counts, kept exact by SignatureField's signals,
+    # SignatureFieldQuerySet.bulk_create and SignatureFieldQuerySet.sign; rebuilt by the recount_signature_fields command
+    fields_total = models.PositiveIntegerField(default=0)
+    fields_signed = models.PositiveIntegerField(default=0)
+
+    objects = DocumentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Inbox pages are ordered (and keyset-paginated) newest upload first
+            models.Index(fields=["uploaded_at", "id"], name="document_uploaded_idx"),
+        ]
 
     def __str__(self):
         return f"{self.file.name} (Uploaded by {self.owner.username})"
 
-    def get_latest_document(self):
+    @property
+    def display_name(self):
+        """The name the document was uploaded with."""
+        return self.filename or os.path.basename(self.file.name)
+
+    def is_accessible_by(self, user):
+        """Whether user may view the document: its owner or one of its assigned signers."""
+        return self.owner_id == user.pk or self.signature_fields.filter(assigned_user=user).exists()
+
+    def detach_blob(self):
         """
-        Checks for the existence of a signed version of the document and returns its path if it exists.
+        Gives the document a private copy of its shared blob file (copy on first write).
+
+        Called by documents.revisions.RevisionWriter under the document's write lock, before
+        anything is appended to self.file.path.
 
         Returns:
-            The path to the signed document if it exists, None otherwise.
-        """
-        signed_doc_path = os.path.join(
-            settings.MEDIA_ROOT,
-            "signed_documents",
-            "documents",
-            self.owner.username,
-            os.path.basename(self.file.name),  # Use original filename
-        )
-        if os.path.exists(signed_doc_path):
-            return signed_doc_path  # Return self for chaining
+            The Document instance (self) for chaining.
+        """
+        if not self.blob_id:
+            return self
 
-        return None  # Return None if signed version doesn't exist
+        blob = self.blob
+        with open(blob.file.path, "rb") as source:
+            self.file.save(f"{get_random_string(8)}_{self.display_name}", File(source), save=False)
+        self.blob = None
+        self.save(update_fields=["file", "blob"])
 
-    def update_signed_document(self, signed_doc_path):
-        """
-                Copies the file from signed_doc_path to the Document's file field,
-                overwriting the existing file.
+        DocumentBlob.objects.release(blob.pk)
+        return self
 
-                Args:
-                    signed_doc_path: The path to the signed document.
+    def delete_file(self):
+        """Removes the document's file and its revision archives, or its reference to a shared blob."""
+        for name in set(self.revisions.exclude(archive="").values_list("archive", flat=True)):
+            self.file.storage.delete(name)
 
-                Returns:
-                    The Document instance (self) for chaining, or None if an error occurs.
-                """
-        try:
-            # 1. Construct the *full* path to the Document's file location.
-            destination_path = os.path.join(settings.MEDIA_ROOT, self.file.name)
+        if self.blob_id:
+            # The blob reference is released by the post_delete handler
+            return
 
-            # Ensure the directory exists.
-            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        file_path = self.file.path
+        if os.path.exists(file_path):
+            os.remove(file_path)
 
-            # 2. Copy the signed document to the Document's file location.
-            shutil.copy2(signed_doc_path, destination_path)  # copy2 preserves metadata
+    def record_revision(self, reason=""):
+        """
+        Stores where the current revision ends in the file.
 
-            return self  # Return self for chaining
+        Every write appends an incremental update, so revision n is the first DocumentRevision.size
+        bytes of the file and never needs a copy of its own.
+        """
+        return DocumentRevision.objects.update_or_create(
+            document=self,
+            number=self.revision,
+            defaults={"size": os.path.getsize(self.file.path), "reason": reason},
+        )[0]
 
-        except FileNotFoundError:
-            print(f"Error: Signed document not found at {signed_doc_path}")
-            return None
-        except Exception as e:
-            print(f"Error copying file: {e}")
-            return None
+    def get_revision(self, number=None):
+        """
+        Returns the DocumentRevision for number (default: the current revision), recording the
+        current one first for documents stored before revisions were tracked.
+        """
+        number = number or self.revision
+        revision = self.revisions.filter(number=number).first()
+        if revision is None and number == self.revision:
+            revision = self.record_revision()
+        return revision
+
+    def get_pages(self):
+        """Returns the page index, building it first for documents uploaded before it existed."""
+        pages = list(self.pages.all())
+        if not pages:
+            from .utils import read_page_geometry
+            self.index_pages(read_page_geometry(self.file.path))
+            pages = list(self.pages.all())
+        return pages
+
+    def index_pages(self, geometry):
+        """
+        Replaces the document's page index.
+
+        Args:
+            geometry: One dict (mediabox, cropbox, rotation) per page, as returned by
+                documents.utils.normalize_pdf or read_page_geometry.
+        """
+        with transaction.atomic():
+            self.pages.all().delete()
+            DocumentPage.objects.bulk_create([
+                DocumentPage(document=self, number=number, **page)
+                for number, page in enumerate(geometry, start=1)
+            ])
 
     def check_complete(self):
         """
         Checks if all assigned signature fields for this document have been signed.
 
+        Reads the counters on the instance, so it costs no query; refresh them first if the
+        instance may be stale.
+
         Returns:
             True if all fields are signed, False otherwise.
         """
-        total_fields = self.signature_fields.count()
-        signed_fields = self.signature_fields.filter(signed=True).count()
-        return signed_fields == total_fields
+        return self.fields_signed == self.fields_total
+
+
+class DocumentRevision(models.Model):
+    """
+    One revision of a document's file. The file only ever grows by incremental updates, so a
+    revision is identified by its length: the first size bytes are that revision, byte for byte.
+
+    Compaction rewrites the file; the revisions before it are then the first size bytes of archive,
+    the file as it was before the rewrite.
+    """
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="revisions")
+    number = models.PositiveIntegerField()
+    size = models.BigIntegerField()
+    reason = models.CharField(max_length=32, blank=True)
+    archive = models.FileField(upload_to=revision_archive_path, max_length=512, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("document", "number")
+        constraints = [
+            models.UniqueConstraint(fields=("document", "number"), name="unique_document_revision"),
+        ]
+
+    def __str__(self):
+        return f"{self.document} r{self.number} ({self.size} bytes)"
+
+    @property
+    def stored_file(self):
+        """The file this revision is a prefix of: its archive, or the document's file."""
+        return self.archive or self.document.file
+
+
+class DocumentPage(models.Model):
+    """
+    Page geometry of a document, indexed once at upload so nothing has to parse the PDF to learn it.
+
+    Boxes are [x0, y0, x1, y1] in PDF points. width and height describe the page as displayed
+    (cropbox, rotated), which is the space SignatureField coordinates are expressed in.
+    """
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="pages")
+    number = models.PositiveIntegerField()  # 1-based, like SignatureField.page
+    mediabox = models.JSONField()
+    cropbox = models.JSONField()
+    rotation = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ("number",)
+        constraints = [
+            models.UniqueConstraint(fields=["document", "number"], name="unique_document_page"),
+        ]
+
+    def __str__(self):
+        return f"{self.document} - page {self.number}"
+
+    @property
+    def width(self):
+        x0, y0, x1, y1 = self.cropbox
+        return abs(y1 - y0) if self.rotation in (90, 270) else abs(x1 - x0)
+
+    @property
+    def height(self):
+        x0, y0, x1, y1 = self.cropbox
+        return abs(x1 - x0) if self.rotation in (90, 270) else abs(y1 - y0)
+
+    def fits(self, x, y, width, height):
+        """Whether a box (top-left origin, displayed page coordinates) lies within the page."""
+        return 0 <= x and 0 <= y and width > 0 and height > 0 \
+            and x + width <= self.width and y + height <= self.height
+
+    def as_dict(self):
+        return {
+            "number": self.number,
+            "width": self.width,
+            "height": self.height,
+            "rotation": self.rotation,
+            "mediabox": self.mediabox,
+            "cropbox": self.cropbox,
+        }
+
+
+@receiver(post_delete, sender=Document)
+def release_document_blob(sender, instance=None, **kwargs):
+    if instance.blob_id:
+        DocumentBlob.objects.release(instance.blob_id)
+
+
+class SignatureFieldQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        """bulk_create that also counts the new fields on their documents, like the post_save receiver does."""
+        with transaction.atomic():
+            objs = super().bulk_create(objs, *args, **kwargs)
+            counts = {}
+            for field in objs:
+                total, signed = counts.get(field.document_id, (0, 0))
+                counts[field.document_id] = (total + 1, signed + int(field.signed))
+            for document_id, (total, signed) in counts.items():
+                Document.objects.filter(pk=document_id).update(
+                    fields_total=F("fields_total") + total, fields_signed=F("fields_signed") + signed
+                )
+        return objs
+
+    def sign(self):
+        """
+        Marks the fields signed, updating their documents' fields_signed counters in the same transaction.
+
+        Use this instead of update(signed=True), which would leave the counters behind.
+
+        Returns:
+            The number of fields that were not signed yet.
+        """
+        with transaction.atomic():
+            unsigned = self.filter(signed=False).select_for_update()
+            field_ids_by_document = {}
+            for field_id, document_id in unsigned.values_list("pk", "document_id"):
+                field_ids_by_document.setdefault(document_id, []).append(field_id)
+
+            signed = 0
+            for document_id, field_ids in field_ids_by_document.items():
+                count = SignatureField.objects.filter(pk__in=field_ids, signed=False).update(signed=True)
+                Document.objects.filter(pk=document_id).update(fields_signed=F("fields_signed") + count)
+                signed += count
+        return signed
 
 
 class SignatureField(models.Model):
@@ -100,5 +412,123 @@ class SignatureField(models.Model):
     field_name = models.CharField(max_length=255, unique=True)
     signed = models.BooleanField(default=False)
 
+    objects = SignatureFieldQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # The inbox access pattern (documents.inbox): a user's signed or pending fields, by document
+            models.Index(fields=["assigned_user", "signed", "document"], name="signaturefield_inbox_idx"),
+        ]
+
     def __str__(self):
         return f"{self.assigned_user.username} - {self.field_name} ({self.page})"
+
+
+@receiver(post_save, sender=SignatureField)
+def count_created_field(sender, instance=None, created=False, raw=False, **kwargs):
+    # Changes to signed on existing rows go through SignatureFieldQuerySet.sign
+    if created and not raw:
+        Document.objects.filter(pk=instance.document_id).update(
+            fields_total=F("fields_total") + 1,
+            fields_signed=F("fields_signed") + int(instance.signed),
+        )
+
+
+@receiver(post_delete, sender=SignatureField)
+def count_deleted_field(sender, instance=None, **kwargs):
+    Document.objects.filter(pk=instance.document_id).update(
+        fields_total=F("fields_total") - 1,
+        fields_signed=F("fields_signed") - int(instance.signed),
+    )
+
+
+class DocumentJob(models.Model):
+    """
+    A unit of out-of-band work (e.g. normalizing an upload), picked up by the process_jobs worker.
+    """
+    STATE_QUEUED = "queued"
+    STATE_RUNNING = "running"
+    STATE_DONE = "done"
+    STATE_FAILED = "failed"
+    STATE_CHOICES = (
+        (STATE_QUEUED, "Queued"),
+        (STATE_RUNNING, "Running"),
+        (STATE_DONE, "Done"),
+        (STATE_FAILED, "Failed"),
+    )
+    ACTIVE_STATES = (STATE_QUEUED, STATE_RUNNING)
+
+    document = models.ForeignKey(
+        Document,
+        on_delete=models.CASCADE,
+        related_name="jobs",
+        null=True,
+        blank=True
+    )
+    kind = models.CharField(max_length=32)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_QUEUED)
+    payload = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["state", "run_after"]),
+        ]
+        constraints = [
+            # At most one queued job of each kind per document; makes enqueueing idempotent. Whether
+            # a running job also absorbs new enqueues depends on the kind (see documents.jobs.enqueue)
+            models.UniqueConstraint(
+                fields=["document", "kind"],
+                condition=Q(state="queued"),
+                name="unique_queued_document_job",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.state})"
+
+
+class UploadSession(models.Model):
+    """
+    A resumable, chunked upload in progress. Chunks are appended to part_path until offset reaches size.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="upload_sessions"
+    )
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True)
+    document = models.OneToOneField(
+        Document,
+        on_delete=models.SET_NULL,
+        related_name="upload_session",
+        null=True,
+        blank=True
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size} bytes, {self.owner.username})"
+
+    @property
+    def part_path(self):
+        """Where the received bytes are stored until the upload completes."""
+        upload_dir = settings.CHUNKED_UPLOAD_DIR or os.path.join(settings.MEDIA_ROOT, "chunked_uploads")
+        return os.path.join(upload_dir, f"{self.pk}.part")
+
+    @property
+    def is_complete(self):
+        return self.offset == self.size
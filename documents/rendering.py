@@ -0,0 +1,153 @@
+"""
+Server-side page rendering with an on-disk LRU cache.
+
+Renders are keyed by document revision, so any write to a document (new fields, a signature, the QR
+stamp) makes its old renders unreachable; they age out of the cache like any other cold entry. A
+revision is rendered from its committed bytes only (a prefix of the file, see documents.serving), so
+a write appending to the file meanwhile never ends up in the render cached for the older revision.
+Recency is tracked through file mtimes, which are refreshed on every cache hit.
+"""
+import os
+import shutil
+import threading
+
+import fitz
+from django.conf import settings
+
+_cache_lock = threading.Lock()
+# Bytes currently in the cache as seen by this process; None until the first scan
+_cache_size = None
+
+
+def cache_root():
+    return settings.PAGE_RENDER_CACHE_DIR or os.path.join(settings.MEDIA_ROOT, "render_cache")
+
+
+def snap_scale(scale):
+    """Snaps a requested scale to the closest configured one, so renders are shared between clients."""
+    return min(settings.PAGE_RENDER_SCALES, key=lambda allowed: abs(allowed - scale))
+
+
+def thumbnail_scale(page):
+    """The scale that renders page (a DocumentPage) at settings.PAGE_THUMBNAIL_WIDTH pixels wide."""
+    return round(settings.PAGE_THUMBNAIL_WIDTH / page.width, 3)
+
+
+def render_path(document, number, scale):
+    return os.path.join(
+        cache_root(), str(document.pk), f"r{document.revision}", f"p{number}@{scale:g}.png"
+    )
+
+
+def render_pages(document, numbers, scale):
+    """
+    Returns the cached PNG paths of the given pages (1-based) at scale, rendering the missing ones
+    from a single open of the document.
+
+    Returns:
+        A dict mapping page number to PNG path.
+    """
+    paths = {number: render_path(document, number, scale) for number in numbers}
+    missing = []
+    for number, path in paths.items():
+        try:
+            # Mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            missing.append(number)
+
+    if not missing:
+        return paths
+
+    revision = document.get_revision()
+    with open(revision.stored_file.path, "rb") as f:
+        data = f.read(revision.size)
+
+    added = 0
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        for number in missing:
+            path = paths[number]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            pixmap = doc[number - 1].get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            pixmap.save(temp_path, output="png")
+            os.replace(temp_path, path)
+            added += os.path.getsize(path)
+
+    _track(added, keep=set(paths.values()))
+    return paths
+
+
+def open_render(document, number, scale):
+    """
+    Opens the cached PNG of one page (1-based) at scale, rendering it if needed.
+
+    Returns:
+        A binary file object.
+    """
+    try:
+        return open(render_pages(document, [number], scale)[number], "rb")
+    except FileNotFoundError:
+        # Evicted by another process between rendering and opening; render once more
+        return open(render_pages(document, [number], scale)[number], "rb")
+
+
+def purge_document(document, keep_revision=None):
+    """Removes a document's renders, except those of keep_revision and later revisions."""
+    document_dir = os.path.join(cache_root(), str(document.pk))
+    if not os.path.isdir(document_dir):
+        return
+
+    for entry in os.listdir(document_dir):
+        # A prewarm of a later revision may be running alongside the one purging
+        number = entry[1:]
+        if keep_revision is not None and entry.startswith("r") and number.isdigit() and int(number) >= keep_revision:
+            continue
+        shutil.rmtree(os.path.join(document_dir, entry), ignore_errors=True)
+
+
+def _scan():
+    entries = []
+    for dirpath, _, filenames in os.walk(cache_root()):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def _track(added, keep=()):
+    """
+    Adds freshly rendered bytes to the running total and evicts cold renders once over budget.
+    Paths in keep (the renders being served right now) are never evicted.
+    """
+    global _cache_size
+
+    with _cache_lock:
+        if _cache_size is None:
+            _cache_size = sum(size for _, size, _ in _scan())
+        else:
+            _cache_size += added
+
+        if _cache_size <= settings.PAGE_RENDER_CACHE_MAX_BYTES:
+            return
+
+        # Other processes share the directory, so evict from a fresh scan rather than our estimate
+        entries = sorted(_scan())
+        total = sum(size for _, size, _ in entries)
+        target = settings.PAGE_RENDER_CACHE_MAX_BYTES * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        _cache_size = total
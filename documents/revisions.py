@@ -0,0 +1,188 @@
+"""
+Appending revisions to document files.
+
+A document's file only ever grows: every write (field assignment, a signature, the QR stamp) is an
+incremental update appended on top of the latest revision, and Document.revision points at the
+newest committed one. The one exception is compaction (RevisionWriter.replace), which rewrites the
+whole file; the file as it was is archived, so earlier revisions stay servable byte for byte.
+
+Writers prepare their update (signature renditions, field lists, QR codes) without any
+coordination. They take the document's write lock only to append and commit, and always append on
+top of whatever revision is current at that moment. Concurrent signers of one document therefore
+land as separate revisions instead of overwriting each other. The lock is per document, so writers
+to different documents never wait on each other.
+"""
+import fcntl
+import os
+import shutil
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Document, DocumentRevision, revision_archive_path
+
+
+class RevisionConflict(Exception):
+    """The document moved to another revision while a writer held its write lock."""
+
+
+def lock_path(document):
+    return os.path.join(settings.MEDIA_ROOT, "locks", f"document-{document.pk}.lock")
+
+
+class RevisionWriter:
+    """
+    Appends one revision to a document's file.
+
+    Usage:
+        with RevisionWriter(document, "signature") as writer:
+            append_something(writer.path)
+            writer.with_commit(lambda: ...)
+
+    On entry the write lock is taken and the writer is rebased onto the latest committed revision.
+    Bytes left past it by a writer that died before committing are cut off. On a clean exit the
+    appended bytes are committed as the next revision; on an exception they are cut off again.
+    open/commit/abort are available for writers whose append outlives a with block (the batch_sign job).
+    """
+
+    def __init__(self, document, reason):
+        self.document = document
+        self.reason = reason
+        self.path = None
+        self.base = None
+        self._base_size = None
+        self._lock = None
+        self._commit_updates = []
+
+    def open(self):
+        os.makedirs(os.path.dirname(lock_path(self.document)), exist_ok=True)
+        self._lock = open(lock_path(self.document), "a")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+
+        try:
+            # Rebase: whatever was committed while we were preparing is the new base. The field
+            # counters are read too, for completion checks made under the lock.
+            self.document.refresh_from_db(fields=["revision", "file", "blob", "fields_total", "fields_signed"])
+            self.document.detach_blob()
+            self.path = self.document.file.path
+            self.base = self.document.revision
+            self._base_size = self.document.get_revision().size
+            self._truncate()
+        except Exception:
+            self._release()
+            raise
+        return self
+
+    def with_commit(self, func):
+        """Runs func in the same transaction that commits the revision (e.g. marking fields signed)."""
+        self._commit_updates.append(func)
+
+    def commit(self):
+        """
+        Records the appended bytes as the next revision and releases the lock.
+
+        Returns:
+            The new revision number, or the base revision if nothing was appended.
+        """
+        try:
+            if os.path.getsize(self.path) == self._base_size:
+                return self.base
+
+            with transaction.atomic():
+                self._advance()
+                self.document.record_revision(self.reason)
+                for func in self._commit_updates:
+                    func()
+            return self.document.revision
+
+        except Exception:
+            self._truncate()
+            raise
+        finally:
+            self._release()
+
+    def replace(self, source_path):
+        """
+        Replaces the whole file with source_path as the next revision and releases the lock.
+
+        For rewrites (compaction). Earlier revisions are no longer prefixes of the new file, so the
+        file as it is now is kept as an archive (a hard link where possible) and their
+        DocumentRevision rows are pointed at it. They are still served byte for byte.
+
+        source_path is moved into place only after the transaction recording the new revision has
+        committed, while the lock is still held. If the transaction fails, the file is untouched
+        and source_path and the archive are removed. Not to be called inside an outer transaction,
+        whose rollback would undo the commit after the file was already replaced.
+
+        Returns:
+            The new revision number.
+        """
+        archive_name = revision_archive_path(DocumentRevision(document=self.document), f"r{self.base}.pdf")
+        archive_path = self.document.file.storage.path(archive_name)
+        try:
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            # Left behind by an attempt at this same revision that never committed
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+            try:
+                os.link(self.path, archive_path)
+            except OSError:
+                shutil.copyfile(self.path, archive_path)
+
+            try:
+                with transaction.atomic():
+                    self._advance()
+                    self.document.revisions.filter(archive="").update(archive=archive_name)
+                    DocumentRevision.objects.create(
+                        document=self.document,
+                        number=self.document.revision,
+                        size=os.path.getsize(source_path),
+                        reason=self.reason,
+                    )
+                    for func in self._commit_updates:
+                        func()
+            except Exception:
+                os.remove(archive_path)
+                if os.path.exists(source_path):
+                    os.remove(source_path)
+                raise
+
+            os.replace(source_path, self.path)
+            return self.document.revision
+        finally:
+            self._release()
+
+    def _advance(self):
+        moved = Document.objects.filter(pk=self.document.pk, revision=self.base).update(revision=self.base + 1)
+        if not moved:
+            raise RevisionConflict(f"{self.document} is no longer at revision {self.base}")
+        self.document.revision = self.base + 1
+
+    def abort(self):
+        """Drops anything appended since open and releases the lock; a no-op once committed."""
+        if self._lock is None:
+            return
+        try:
+            self._truncate()
+        finally:
+            self._release()
+
+    def _truncate(self):
+        if os.path.getsize(self.path) > self._base_size:
+            os.truncate(self.path, self._base_size)
+
+    def _release(self):
+        if self._lock:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
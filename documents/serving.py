@@ -0,0 +1,133 @@
+"""
+Document downloads with byte ranges, conditional requests and optional web server offload.
+
+Stored PDFs are linearized at normalization, so a viewer issuing range requests (pdf.js does when
+the response advertises Accept-Ranges) can show the first page before the rest of the file arrives.
+"""
+import os
+import re
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _read_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def _parse_range(header, size):
+    """
+    Parses a single-range Range header.
+
+    Returns:
+        (start, end) inclusive, None to serve the whole file (absent or multi-range header),
+        or False if the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if if_range.startswith("W/"):
+        # If-Range only takes strong validators (RFC 9110, 13.1.5); send the whole file
+        return False
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def serve_document_file(request, document, revision=None):
+    """
+    Builds the response for downloading a document at revision (a DocumentRevision, default: the
+    current one).
+
+    Updates are only ever appended to the file, so a revision is served as a prefix of it: bytes
+    appended by a newer (or in-progress) write are never sent, and nothing is copied per revision.
+    Revisions from before a compaction are served from the archived pre-compaction file the same way.
+
+    Supports single byte ranges, If-None-Match / If-Modified-Since / If-Range, and offloading the
+    transfer to the web server through settings.DOCUMENT_SENDFILE ("x-sendfile" for Apache/lighttpd,
+    "x-accel-redirect" for nginx, served under settings.DOCUMENT_ACCEL_REDIRECT_PREFIX) when the
+    revision is the whole of an archived file. The web server reads the file after the response
+    leaves Django, so a file that writes still append to is always streamed from here.
+    """
+    current = revision is None or revision.number == document.revision
+    revision = revision or document.get_revision()
+    stored = revision.stored_file
+    path = stored.path
+    stat = os.stat(path)
+    size = revision.size
+    last_modified = int(revision.created_at.timestamp())
+    # Revision bytes never change, so the revision pins the content
+    etag = quote_etag(f"{document.pk}-{revision.number}-{size}")
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    # The web server can only send the whole file, and only an archive is sure to stay that size
+    offload = settings.DOCUMENT_SENDFILE if revision.archive and size == stat.st_size else None
+    if offload == "x-sendfile":
+        response = HttpResponse(content_type="application/pdf")
+        response["X-Sendfile"] = path
+    elif offload == "x-accel-redirect":
+        response = HttpResponse(content_type="application/pdf")
+        response["X-Accel-Redirect"] = settings.DOCUMENT_ACCEL_REDIRECT_PREFIX + stored.name
+    else:
+        byte_range = None
+        if _if_range_matches(request, etag, last_modified):
+            byte_range = _parse_range(request.headers.get("Range"), size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+        start, end = byte_range or (0, size - 1)
+        response = StreamingHttpResponse(
+            _read_range(path, start, end - start + 1),
+            status=206 if byte_range else 200,
+            content_type="application/pdf",
+        )
+        response["Content-Length"] = str(end - start + 1)
+        if byte_range:
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = "private, no-cache" if current else "private, max-age=31536000, immutable"
+    response["Content-Disposition"] = content_disposition_header(False, document.display_name)
+    return response
@@ -0,0 +1,157 @@
+"""
+Applying a user's signature to their fields, shared by SignDocumentView and the batch_sign job.
+"""
+import asyncio
+import io
+import os
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import reverse
+
+from signatures.pyhanko_signing import (
+    async_sign_fields,
+    get_signer,
+    get_timestamper,
+    stamp_style_for,
+)
+from signatures.utils import get_signature_rendition
+from .models import Document, SignatureField
+from .revisions import RevisionWriter
+from .utils import stamp_qr_file, stamp_signature_file
+
+
+def field_boxes(fields):
+    """The (page, x, y, width, height) of each SignatureField, as taken by stamp_signature_file."""
+    return [(field.page, field.x_pdf, field.y_pdf, field.width_pdf, field.height_pdf) for field in fields]
+
+
+def prepare_rendition(signature, fields):
+    """
+    Returns the (png_bytes, width, height) rendition of signature sized for the largest of fields,
+    so one embedded image serves all of them.
+    """
+    return get_signature_rendition(
+        signature,
+        max(field.width_pdf for field in fields),
+        max(field.height_pdf for field in fields),
+    )
+
+
+def pending_fields(fields):
+    """Re-reads which of fields are still unsigned; another request may have signed some meanwhile."""
+    return list(
+        SignatureField.objects.filter(pk__in=[field.pk for field in fields], signed=False)
+        .select_related("assigned_user")
+        .order_by("pk")
+    )
+
+
+def mark_signed(fields):
+    """Returns a callable marking fields signed, for RevisionWriter.with_commit."""
+    field_ids = [field.pk for field in fields]
+    return lambda: SignatureField.objects.filter(pk__in=field_ids).sign()
+
+
+def completion_qr_data(document, fields):
+    """
+    Returns what the completion QR code encodes (the document's URL) if signing fields completes
+    the document, None otherwise.
+
+    Must be called under the document's write lock, so exactly one writer sees itself completing
+    it. Reads the field counters RevisionWriter refreshed when taking the lock, so it costs no query.
+    """
+    if document.fields_total - document.fields_signed > len(fields):
+        return None
+    return f"{settings.SITE_URL}{reverse('document_file', args=[document.pk])}"
+
+
+def mark_completed(document):
+    """Returns a callable marking document fully signed, for RevisionWriter.with_commit."""
+
+    def update():
+        Document.objects.filter(pk=document.pk).update(signed=True)
+        document.signed = True
+
+    return update
+
+
+def sign_fields(document, fields, rendition):
+    """
+    Appends the signature stamp for fields to the document as a new revision and marks them signed.
+
+    If that completes the document, the QR code is stamped in the same write.
+
+    Args:
+        rendition: The (png_bytes, width, height) from prepare_rendition.
+
+    Returns:
+        The fields that were signed; fields signed concurrently by another request are skipped.
+    """
+    with RevisionWriter(document, "signature") as writer:
+        pending = pending_fields(fields)
+        if pending:
+            qr_data = completion_qr_data(document, pending)
+            stamp_signature_file(writer.path, field_boxes(pending), *rendition, qr_data=qr_data)
+            writer.with_commit(mark_signed(pending))
+            if qr_data:
+                writer.with_commit(mark_completed(document))
+
+    return pending
+
+
+def digital_signings(fields):
+    """The (field_name, signer, stamp_style) of each field, for signatures.pyhanko_signing.async_sign_fields."""
+    signer = get_signer()
+    return [(field.field_name, signer, stamp_style_for(field.assigned_user)) for field in fields]
+
+
+async def async_add_digital_signatures(document, fields, timestamper=None):
+    """
+    Cryptographically signs the pyHanko signature fields (created at assignment) of fields with
+    the process's signing certificate, one incremental revision per field, and marks them signed.
+
+    All signatures are computed in one session on an in-memory copy of the latest revision, then
+    appended to the file in a single write. If they complete the document, the QR code is stamped
+    first, so the final signature covers it.
+
+    For async views: time stamping waits are awaited and file I/O and hashing run in the default
+    executor, so concurrent requests overlap their waits.
+
+    Args:
+        timestamper: Defaults to get_timestamper().
+
+    Returns:
+        The new revision number.
+    """
+    loop = asyncio.get_running_loop()
+
+    writer = RevisionWriter(document, "digital_signature")
+    await sync_to_async(writer.open)()
+    try:
+        pending = await sync_to_async(pending_fields)(fields)
+        if not pending:
+            await sync_to_async(writer.abort)()
+            return document.revision
+
+        qr_data = await sync_to_async(completion_qr_data)(document, pending)
+        if qr_data:
+            await loop.run_in_executor(None, stamp_qr_file, writer.path, qr_data)
+            writer.with_commit(mark_completed(document))
+        signings = await sync_to_async(digital_signings)(pending)
+
+        with open(writer.path, "rb") as pdf_in:
+            buffer = io.BytesIO(await loop.run_in_executor(None, pdf_in.read))
+        base_size = buffer.seek(0, os.SEEK_END)
+
+        await async_sign_fields(buffer, signings, timestamper=timestamper or get_timestamper())
+
+        with open(writer.path, "ab") as pdf_out:
+            await loop.run_in_executor(None, pdf_out.write, buffer.getbuffer()[base_size:])
+        writer.with_commit(mark_signed(pending))
+    except BaseException:
+        await sync_to_async(writer.abort)()
+        raise
+
+    await sync_to_async(writer.commit)()
+    return document.revision
@@ -1,3 +1,1412 @@
-from django.test import TestCase
+import base64
+import hashlib
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import fitz
+from PIL import Image
+from pikepdf import Array, Dictionary, Name, Pdf, String
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+
+import pdfsign.urls
+from accounts.models import Account
+from signatures.models import Signature
+from pdfsign.routers import PIN_COOKIE, ReplicaPinningMiddleware, ReplicaRouter, replica_reads
+from . import rendering, uploads
+from .assignees import search_assignees
+from .checks import check_compaction_policies
+from .inbox import inbox_page
+from .jobs import HANDLERS, claim_next, enqueue, normalize_blob, run_job, schedule_compaction
+from .models import Document, DocumentBlob, DocumentJob, DocumentRevision, SignatureField, UploadSession
+from .rendering import cache_root, purge_document, render_pages
+from .revisions import RevisionConflict, RevisionWriter
+from .uploads import append_chunk, complete_upload
+from .utils import (
+    compact_pdf,
+    normalize_pdf,
+    qr_code_matrix,
+    qr_code_pdf,
+    stamp_qr_file,
+    stamp_signature_fields,
+)
+
+
+def make_pdf(page_count=2):
+    doc = fitz.open()
+    for _ in range(page_count):
+        doc.new_page()
+    return doc
+
+
+def read_qr_modules(doc, size):
+    """
+    Reads back the size x size modules of the QR code stamp_qr_code put on the first page of doc, by
+    rendering its box and sampling the middle of each module (True is dark).
+    """
+    page = doc[0]
+    width = size * 10 // 4
+    right, bottom = page.rect.width - 20, page.rect.height - 20
+    box = fitz.Rect(right - width, bottom - width, right, bottom)
+    zoom = 8 * size / width
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=box, colorspace=fitz.csGRAY, alpha=False)
+    module = pixmap.width / size
+    return [
+        [pixmap.pixel(int((x + 0.5) * module), int((y + 0.5) * module))[0] < 128 for x in range(size)]
+        for y in range(size)
+    ]
+
+
+def make_signature_image(width=600, height=200):
+    # Random pixels, so the PNG does not compress away and any duplicate copies show in the file size
+    img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format="PNG")
+    return img_bytes.getvalue(), width, height
+
+
+class StampSignatureFieldsTests(SimpleTestCase):
+    def stamped_size(self, field_count):
+        image_bytes, width, height = make_signature_image()
+        fields = [
+            SignatureField(page=1 + i % 2, x_pdf=40, y_pdf=20 + (i // 2) * 40, width_pdf=150, height_pdf=36)
+            for i in range(field_count)
+        ]
+
+        doc = make_pdf()
+        stamp_signature_fields(doc, fields, image_bytes, width, height)
+        size = len(doc.tobytes(garbage=1, deflate=True))
+        doc.close()
+        return size, len(image_bytes)
+
+    def test_image_is_embedded_once(self):
+        doc = make_pdf()
+        image_bytes, width, height = make_signature_image()
+        fields = [SignatureField(page=1 + i % 2, x_pdf=40, y_pdf=20 + i * 10, width_pdf=150, height_pdf=36)
+                  for i in range(6)]
+
+        xref = stamp_signature_fields(doc, fields, image_bytes, width, height)
+
+        image_xrefs = {image[0] for page in doc for image in page.get_images(full=True)}
+        self.assertEqual(image_xrefs, {xref})
+
+    def test_output_size_stays_flat_as_fields_grow(self):
+        one_field, image_size = self.stamped_size(1)
+        forty_fields, _ = self.stamped_size(40)
+
+        # 39 more placements cost a few bytes of content stream each, not 39 image copies
+        self.assertLess(forty_fields - one_field, image_size / 10)
+
+    def test_placement_keeps_aspect_ratio_within_box(self):
+        doc = make_pdf(1)
+        image_bytes, width, height = make_signature_image(300, 100)
+        field = SignatureField(page=1, x_pdf=50, y_pdf=60, width_pdf=200, height_pdf=200)
+
+        stamp_signature_fields(doc, [field], image_bytes, width, height)
+
+        rect = doc[0].get_image_rects(doc[0].get_images()[0][0])[0]
+        self.assertAlmostEqual(rect.x0, 50, places=3)
+        self.assertAlmostEqual(rect.y0, 60, places=3)
+        self.assertAlmostEqual(rect.width, 200, places=3)
+        self.assertAlmostEqual(rect.height, 200 / 3, places=3)
+
+
+class QrCodeTests(SimpleTestCase):
+    data = "https://sign.example.com/documents/file/12345/"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+
+    def test_vector_modules_match_the_matrix(self):
+        matrix = qr_code_matrix(self.data)
+
+        with qr_code_pdf(self.data) as doc:
+            self.assertEqual(doc[0].rect, fitz.Rect(0, 0, len(matrix), len(matrix)))
+            pixmap = doc[0].get_pixmap(matrix=fitz.Matrix(8, 8), colorspace=fitz.csGRAY, alpha=False)
+
+        modules = [
+            [pixmap.pixel(x * 8 + 4, y * 8 + 4)[0] < 128 for x in range(len(matrix))]
+            for y in range(len(matrix))
+        ]
+        self.assertEqual(modules, matrix)
+
+    def stamp(self, mode):
+        path = os.path.join(self.tmpdir, f"{mode}.pdf")
+        make_pdf(1).save(path)
+        size = os.path.getsize(path)
+        with self.settings(QR_STAMP_MODE=mode):
+            stamp_qr_file(path, self.data)
+        return path, os.path.getsize(path) - size
+
+    def test_vector_stamp_is_smaller_than_the_raster_one(self):
+        matrix = qr_code_matrix(self.data)
+        (vector_path, vector_update), (raster_path, raster_update) = self.stamp("vector"), self.stamp("raster")
+
+        for path in (vector_path, raster_path):
+            with fitz.open(path) as doc:
+                self.assertEqual(read_qr_modules(doc, len(matrix)), matrix)
+        self.assertLess(vector_update, raster_update)
+        self.assertLess(vector_update, 4 * 1024)
+
+
+class NormalizePdfTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+
+    def test_form_fields_survive_normalization(self):
+        doc = make_pdf(1)
+        for index, name in enumerate(("full_name", "company")):
+            widget = fitz.Widget()
+            widget.field_name = name
+            widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+            widget.field_value = name.upper()
+            widget.rect = fitz.Rect(50, 50 + index * 40, 250, 80 + index * 40)
+            doc[0].add_widget(widget)
+        path = os.path.join(self.tmpdir, "form.pdf")
+        doc.save(path)
+
+        geometry = normalize_pdf(path)
+
+        self.assertEqual(len(geometry), 1)
+        with Pdf.open(path) as pdf:
+            self.assertEqual([str(field.T) for field in pdf.Root.AcroForm.Fields], ["full_name", "company"])
+        with fitz.open(path) as normalized:
+            self.assertEqual(
+                [(widget.field_name, widget.field_value) for widget in normalized[0].widgets()],
+                [("full_name", "FULL_NAME"), ("company", "COMPANY")],
+            )
+
+    def test_strips_only_the_configured_catalog_keys(self):
+        doc = make_pdf(1)
+        doc.set_pagemode("UseOutlines")
+        path = os.path.join(self.tmpdir, "plain.pdf")
+        doc.save(path)
+
+        with override_settings(PDF_NORMALIZE_STRIP_KEYS=["/PageMode"]):
+            normalize_pdf(path)
+
+        with Pdf.open(path) as pdf:
+            self.assertNotIn("/PageMode", pdf.Root)
+
+
+class TempMediaRootMixin:
+    """
+    Gives a test class its own empty MEDIA_ROOT (self.media_root), removed with everything in it
+    once the class is done. List it before the TestCase base.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls._media_root_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls._media_root_override.enable()
+        try:
+            super().setUpClass()
+        except Exception:
+            cls._remove_media_root()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            super().tearDownClass()
+        finally:
+            cls._remove_media_root()
+
+    @classmethod
+    def _remove_media_root(cls):
+        cls._media_root_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True)
+class ChunkedUploadTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.client.force_login(self.owner)
+        self.data = make_pdf(3).tobytes()
+
+    def start(self, data=None):
+        data = data or self.data
+        response = self.client.post(
+            "/documents/upload/chunked/", {"filename": "big.pdf", "size": len(data)}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 201)
+        return UploadSession.objects.get(pk=response.json()["upload_id"])
+
+    def put(self, session, start, end, body=None):
+        return self.client.generic(
+            "PUT", f"/documents/upload/chunked/{session.pk}/",
+            self.data[start:end] if body is None else body,
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{end - 1}/{session.size}",
+        )
+
+    def complete(self, session):
+        return self.client.post(
+            f"/documents/upload/chunked/{session.pk}/complete/",
+            {"sha256": hashlib.sha256(self.data).hexdigest()}, content_type="application/json",
+        )
+
+    def test_resumes_from_the_acknowledged_offset_after_an_interrupted_chunk(self):
+        session = self.start()
+        middle = len(self.data) // 2
+        self.assertEqual(self.put(session, 0, middle).status_code, 200)
+
+        # The connection drops halfway through the second chunk
+        response = self.put(session, middle, len(self.data), body=self.data[middle:middle + 10])
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(self.client.get(f"/documents/upload/chunked/{session.pk}/").json()["offset"], middle)
+        self.assertEqual(self.put(session, middle, len(self.data)).json()["complete"], True)
+
+        response = self.complete(session)
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(Document.objects.get(pk=response.json()["document_id"]).status, Document.STATUS_READY)
+
+    def test_replayed_chunk_is_rejected_without_touching_the_file(self):
+        session = self.start()
+        middle = len(self.data) // 2
+        self.put(session, 0, middle)
+        self.put(session, middle, len(self.data))
+
+        response = self.put(session, 0, middle)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], len(self.data))
+        with open(session.part_path, "rb") as part:
+            self.assertEqual(part.read(), self.data)
+        self.assertEqual(self.complete(session).status_code, 201)
+
+    def test_chunk_checked_against_a_stale_offset_does_not_truncate_later_chunks(self):
+        session = self.start()
+        middle = len(self.data) // 2
+        stale = UploadSession.objects.get(pk=session.pk)
+        self.put(session, 0, middle)
+        self.put(session, middle, len(self.data))
+
+        # A slow duplicate of the first chunk, which passed the view's offset check before the others
+        acknowledged = append_chunk(stale, 0, io.BytesIO(self.data[:middle]), middle)
+
+        self.assertFalse(acknowledged)
+        self.assertEqual(stale.offset, len(self.data))
+        self.assertEqual(os.path.getsize(session.part_path), len(self.data))
+
+    @override_settings(CHUNKED_UPLOAD_HASHER_CACHE_SIZE=1)
+    def test_evicted_checksums_are_rebuilt_from_disk(self):
+        first, second = self.start(), self.start()
+        middle = len(self.data) // 2
+        self.put(first, 0, middle)
+        self.put(second, 0, middle)
+        self.assertNotIn(first.pk, uploads._hashers)
+
+        self.put(first, middle, len(self.data))
+
+        self.assertEqual(len(uploads._hashers), 1)
+        self.assertEqual(self.complete(first).status_code, 201)
+
+    def test_expiry_keeps_sessions_still_receiving_chunks(self):
+        with mock.patch("django.utils.timezone.now", return_value=timezone.now() - timedelta(days=2)):
+            abandoned, active = self.start(), self.start()
+            self.put(abandoned, 0, 10)
+            self.put(active, 0, 10)
+        # Started before the cutoff, but a chunk arrived since
+        self.put(active, 10, 20)
+
+        call_command("expire_uploads", stdout=io.StringIO())
+
+        self.assertFalse(UploadSession.objects.filter(pk=abandoned.pk).exists())
+        self.assertFalse(os.path.exists(abandoned.part_path))
+        self.assertNotIn(abandoned.pk, uploads._hashers)
+        self.assertTrue(os.path.exists(active.part_path))
+        self.assertEqual(self.put(active, 20, len(self.data)).json()["complete"], True)
+        self.assertEqual(self.complete(active).status_code, 201)
+
+        # A chunk for the expired session finds it gone and leaves no part file behind
+        with self.assertRaises(UploadSession.DoesNotExist):
+            append_chunk(abandoned, 10, io.BytesIO(self.data[10:20]), 10)
+        self.assertFalse(os.path.exists(abandoned.part_path))
+
+    def test_repeated_completion_returns_the_first_document(self):
+        session = self.start()
+        self.put(session, 0, len(self.data))
+        stale = UploadSession.objects.get(pk=session.pk)
+
+        first = self.complete(session)
+        # A concurrent completion that passed the view's check before the first one finished
+        document = complete_upload(stale)
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(document.pk, first.json()["document_id"])
+        self.assertEqual(Document.objects.filter(owner=self.owner).count(), 1)
+        self.assertFalse(os.path.exists(session.part_path))
+
+
+def run_jobs():
+    while True:
+        job = claim_next("test")
+        if job is None:
+            return
+        run_job(job)
+
+
+def sha256_of(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=False)
+class BlobStoreTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.client.force_login(self.owner)
+        self.data = make_pdf(2).tobytes()
+        self.existing_blob_files = set()
+        self.existing_blob_files = set(self.blob_files())
+
+    def upload(self):
+        self.client.post(
+            "/documents/upload/", {"file": SimpleUploadedFile("contract.pdf", self.data, "application/pdf")}
+        )
+        return Document.objects.latest("pk")
+
+    def blob_files(self):
+        """The files in the blob store that were not there when the test started."""
+        names = {name for _, _, names in os.walk(os.path.join(self.media_root, "blobs")) for name in names}
+        return sorted(names - self.existing_blob_files)
+
+    def test_identical_uploads_share_one_blob_normalized_into_a_new_file(self):
+        first, second = self.upload(), self.upload()
+        blob = DocumentBlob.objects.get()
+        raw_path = blob.file.path
+        self.assertEqual((blob.ref_count, blob.normalized), (2, False))
+
+        run_jobs()
+
+        blob.refresh_from_db()
+        self.assertEqual(blob.sha256, hashlib.sha256(self.data).hexdigest())
+        self.assertTrue(blob.normalized)
+        self.assertEqual(blob.normalized_sha256, sha256_of(blob.file.path))
+        self.assertFalse(os.path.exists(raw_path))
+        self.assertEqual(self.blob_files(), [f"{blob.normalized_sha256}.normalized.pdf"])
+        for document in (first, second):
+            document.refresh_from_db()
+            self.assertEqual(document.status, Document.STATUS_READY)
+            self.assertEqual(document.file.name, blob.file.name)
+
+        # Later uploads of the same content are ready at once
+        third = self.upload()
+        self.assertEqual((third.status, third.file.name), (Document.STATUS_READY, blob.file.name))
+
+    def test_a_late_concurrent_normalization_keeps_the_first_result(self):
+        document = self.upload()
+        stale = DocumentBlob.objects.get()
+        run_jobs()
+        blob = DocumentBlob.objects.get()
+        normalized = blob.normalized_sha256
+
+        normalize_blob(stale)
+
+        blob.refresh_from_db()
+        self.assertEqual(blob.normalized_sha256, normalized)
+        self.assertEqual(sha256_of(blob.file.path), normalized)
+        self.assertEqual(self.blob_files(), [f"{normalized}.normalized.pdf"])
+        document.refresh_from_db()
+        self.assertEqual(document.file.name, blob.file.name)
+
+    def test_blob_is_deleted_with_its_last_reference(self):
+        first, second = self.upload(), self.upload()
+        run_jobs()
+        path = DocumentBlob.objects.get().file.path
+
+        self.client.post(f"/documents/delete/{first.pk}/")
+        self.assertEqual(DocumentBlob.objects.get().ref_count, 1)
+        self.assertTrue(os.path.exists(path))
+
+        self.client.post(f"/documents/delete/{second.pk}/")
+        self.assertFalse(DocumentBlob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_first_write_detaches_the_document_from_the_blob(self):
+        first, second = self.upload(), self.upload()
+        run_jobs()
+        blob = DocumentBlob.objects.get()
+
+        with RevisionWriter(first, "test") as writer, open(writer.path, "ab") as f:
+            f.write(b"\n% appended\n")
+
+        first.refresh_from_db()
+        blob.refresh_from_db()
+        self.assertIsNone(first.blob_id)
+        self.assertNotEqual(first.file.name, blob.file.name)
+        self.assertEqual(blob.ref_count, 1)
+        self.assertEqual(sha256_of(blob.file.path), blob.normalized_sha256)
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=False)
+class JobQueueTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        owner = Account.objects.create_user(username="owner", password="pw")
+        self.document = Document.objects.create(owner=owner, file="documents/owner/contract.pdf")
+
+    def running(self, kind):
+        return DocumentJob.objects.create(
+            document=self.document, kind=kind, state=DocumentJob.STATE_RUNNING, attempts=1,
+            locked_by="test", locked_until=timezone.now() + timedelta(minutes=5),
+        )
+
+    def test_prewarm_is_queued_again_while_an_older_one_runs(self):
+        older = self.running("prewarm_renders")
+
+        queued = enqueue("prewarm_renders", document=self.document)
+
+        self.assertNotEqual(queued.pk, older.pk)
+        self.assertEqual(queued.state, DocumentJob.STATE_QUEUED)
+        self.assertEqual(enqueue("prewarm_renders", document=self.document).pk, queued.pk)
+
+    def test_other_kinds_merge_into_a_running_job(self):
+        running = self.running("normalize")
+        self.assertEqual(enqueue("normalize", document=self.document).pk, running.pk)
+
+    def test_failed_run_is_superseded_by_a_newer_queued_job(self):
+        older = self.running("prewarm_renders")
+        newer = enqueue("prewarm_renders", document=self.document)
+
+        with mock.patch.dict(HANDLERS, {"prewarm_renders": mock.Mock(side_effect=RuntimeError("boom"))}), \
+                self.assertLogs("documents.jobs", "ERROR"):
+            run_job(older)
+
+        older.refresh_from_db()
+        self.assertEqual(older.state, DocumentJob.STATE_DONE)
+        self.assertEqual(older.result, {"superseded_by": newer.pk})
+
+    def test_expired_lease_is_reclaimed(self):
+        crashed = self.running("normalize")
+        self.assertIsNone(claim_next("worker-2"))
+
+        DocumentJob.objects.filter(pk=crashed.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        job = claim_next("worker-2")
+
+        self.assertEqual(job.pk, crashed.pk)
+        self.assertEqual((job.state, job.locked_by, job.attempts), (DocumentJob.STATE_RUNNING, "worker-2", 2))
+        self.assertGreater(job.locked_until, timezone.now())
+
+    def test_failures_back_off_then_fail_the_document(self):
+        Document.objects.filter(pk=self.document.pk).update(status=Document.STATUS_PROCESSING)
+        job = DocumentJob.objects.create(document=self.document, kind="normalize")
+        handler = mock.Mock(side_effect=RuntimeError("corrupt xref"))
+
+        with mock.patch.dict(HANDLERS, {"normalize": handler}), self.assertLogs("documents.jobs", "ERROR"):
+            for attempt in range(1, job.max_attempts + 1):
+                claimed = claim_next("worker")
+                self.assertEqual((claimed.pk, claimed.attempts), (job.pk, attempt))
+                before = timezone.now()
+                run_job(claimed)
+                job.refresh_from_db()
+                if attempt < job.max_attempts:
+                    self.assertEqual(job.state, DocumentJob.STATE_QUEUED)
+                    self.assertGreaterEqual(job.run_after, before + timedelta(seconds=2 ** attempt))
+                    # Not due until the backoff has passed
+                    self.assertIsNone(claim_next("worker"))
+                    DocumentJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+
+        self.assertEqual(handler.call_count, job.max_attempts)
+        self.assertEqual((job.state, job.last_error), (DocumentJob.STATE_FAILED, "corrupt xref"))
+        self.assertIsNone(claim_next("worker"))
+
+        self.client.force_login(self.document.owner)
+        response = self.client.get(f"/documents/status/{self.document.pk}/")
+        self.assertEqual(
+            response.json(), {"id": self.document.pk, "status": "failed", "ready": False, "error": "corrupt xref"}
+        )
+
+    def test_purge_keeps_renders_of_later_revisions(self):
+        document_dir = os.path.join(cache_root(), str(self.document.pk))
+        for entry in ("r1", "r2", "r3"):
+            os.makedirs(os.path.join(document_dir, entry))
+
+        purge_document(self.document, keep_revision=2)
+
+        self.assertEqual(sorted(os.listdir(document_dir)), ["r2", "r3"])
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True)
+class PageRenderTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.client.force_login(self.owner)
+        self.client.post(
+            "/documents/upload/", {"file": SimpleUploadedFile("contract.pdf", make_pdf(3).tobytes(), "application/pdf")}
+        )
+        self.document = Document.objects.latest("pk")
+
+        # A cache of its own, empty of the renders prewarmed at upload
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        cache_settings = override_settings(PAGE_RENDER_CACHE_DIR=cache_dir)
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+        rendering._cache_size = None
+        self.addCleanup(setattr, rendering, "_cache_size", None)
+
+    def image(self, number, **params):
+        return self.client.get(f"/documents/pages/{self.document.pk}/{number}/image/", params)
+
+    def png_size(self, content):
+        with Image.open(io.BytesIO(content)) as image:
+            return image.size
+
+    def test_page_image_endpoint(self):
+        response = self.image(1, scale=1.9)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(self.png_size(b"".join(response.streaming_content)), (1190, 1684))
+        self.assertEqual(response["ETag"], f'"{self.document.pk}-1-1-2"')
+
+        self.assertEqual(
+            self.client.get(
+                f"/documents/pages/{self.document.pk}/1/image/", {"scale": 1.9}, HTTP_IF_NONE_MATCH=response["ETag"]
+            ).status_code,
+            304,
+        )
+        self.assertEqual(self.image(4).status_code, 404)
+        self.assertEqual(self.image(1, scale="big").status_code, 400)
+
+        thumbnail = self.client.get(f"/documents/pages/{self.document.pk}/2/thumbnail/")
+        # Scales are rounded, so the width may be off by a pixel
+        self.assertAlmostEqual(
+            self.png_size(b"".join(thumbnail.streaming_content))[0], settings.PAGE_THUMBNAIL_WIDTH, delta=1
+        )
+
+        Account.objects.create_user(username="stranger", password="pw")
+        self.client.login(username="stranger", password="pw")
+        self.assertEqual(self.image(1).status_code, 403)
+
+    def test_renders_only_the_committed_revision(self):
+        path = self.document.file.path
+        # An incremental update that doubles page 1, appended by a write that has not committed yet
+        with fitz.open(path) as doc:
+            doc[0].set_mediabox(fitz.Rect(0, 0, 1190, 1684))
+            doc.saveIncr()
+        self.assertGreater(os.path.getsize(path), self.document.get_revision().size)
+
+        self.assertEqual(self.png_size(b"".join(self.image(1).streaming_content)), (595, 842))
+
+    def test_cold_renders_are_evicted_over_budget(self):
+        first = render_pages(self.document, [1], 1.0)[1]
+        budget = int(os.path.getsize(first) * 2.5)
+        os.utime(first, (0, 0))
+
+        with self.settings(PAGE_RENDER_CACHE_MAX_BYTES=budget):
+            paths = render_pages(self.document, [2, 3], 1.0)
+
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(all(os.path.exists(path) for path in paths.values()))
+
+        # Renders being served survive even a budget too small for them
+        with self.settings(PAGE_RENDER_CACHE_MAX_BYTES=1):
+            path = render_pages(self.document, [1], 1.0)[1]
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(any(os.path.exists(path) for path in paths.values()))
+
+
+class MediaRoutesTests(SimpleTestCase):
+    def setUp(self):
+        # The media routes only exist with DEBUG on, which the test runner turns off
+        with override_settings(DEBUG=True):
+            self.urlconf = importlib.reload(pdfsign.urls)
+        self.addCleanup(importlib.reload, pdfsign.urls)
+
+    def test_only_signature_images_are_served_from_media(self):
+        match = resolve(f"{settings.MEDIA_URL}signatures/owner_signature.png", urlconf=self.urlconf)
+        self.assertEqual(match.kwargs["path"], "owner_signature.png")
+
+        for path in (
+            "documents/owner/contract.pdf",
+            "blobs/ab/cd/abcd.pdf",
+            "chunked_uploads/1.part",
+            "archive/documents/1/r3.pdf",
+        ):
+            with self.assertRaises(Resolver404):
+                resolve(f"{settings.MEDIA_URL}{path}", urlconf=self.urlconf)
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True)
+class RevisionServingTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.signer = Account.objects.create_user(username="signer", password="pw")
+        self.client.force_login(self.owner)
+        self.client.post(
+            "/documents/upload/", {"file": SimpleUploadedFile("contract.pdf", make_pdf(1).tobytes(), "application/pdf")}
+        )
+        self.document = Document.objects.latest("pk")
+        with open(self.document.file.path, "rb") as f:
+            self.uploaded = f.read()
+
+        field = {"page": 1, "assigned_user_id": str(self.signer.pk), "x_pdf": 50, "y_pdf": 50, "width_pdf": 150, "height_pdf": 50}
+        response = self.client.post(
+            f"/documents/save_signatures/{self.document.pk}/", {"signatures": [field]}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.document.refresh_from_db()
+
+    def download(self, revision=None, **headers):
+        query = f"?revision={revision}" if revision is not None else ""
+        return self.client.get(f"/documents/file/{self.document.pk}/{query}", **headers)
+
+    def test_earlier_revision_is_served_as_the_bytes_it_had(self):
+        self.assertEqual(self.document.revision, 2)
+
+        response = self.download(1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.uploaded)
+        self.assertIn("immutable", response["Cache-Control"])
+        with open(self.document.file.path, "rb") as f:
+            current = f.read()
+        self.assertTrue(current.startswith(self.uploaded))
+        self.assertEqual(b"".join(self.download().streaming_content), current)
+
+    def test_byte_range_of_an_earlier_revision(self):
+        response = self.download(1, HTTP_RANGE="bytes=-10")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes {len(self.uploaded) - 10}-{len(self.uploaded) - 1}/{len(self.uploaded)}")
+        self.assertEqual(b"".join(response.streaming_content), self.uploaded[-10:])
+
+    def test_if_range_needs_a_strong_validator(self):
+        etag = self.download(1)["ETag"]
+
+        response = self.download(1, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.uploaded[:10])
+
+        for if_range in (f"W/{etag}", '"stale"'):
+            response = self.download(1, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=if_range)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), self.uploaded)
+
+    @override_settings(DOCUMENT_SENDFILE="x-sendfile", PDF_COMPACTION_WINDOW="")
+    def test_only_archived_files_are_offloaded(self):
+        # Appends may land after the web server picks the file up, so live files are streamed
+        for revision in (None, 1):
+            self.assertNotIn("X-Sendfile", self.download(revision))
+
+        schedule_compaction(self.document, "full")
+        archive = self.document.revisions.get(number=2).archive
+
+        self.assertEqual(self.download(2)["X-Sendfile"], archive.path)
+        # Revision 1 is only a prefix of the archive
+        self.assertNotIn("X-Sendfile", self.download(1))
+        self.assertNotIn("X-Sendfile", self.download())
+
+    def test_unknown_and_invalid_revisions(self):
+        self.assertEqual(self.download(9).status_code, 404)
+        self.assertEqual(self.download("latest").status_code, 400)
+
+    def test_only_the_owner_and_signers_can_download(self):
+        stranger = Account.objects.create_user(username="stranger", password="pw")
+        self.client.force_login(stranger)
+        self.assertEqual(self.download(1).status_code, 403)
+
+        self.client.force_login(self.signer)
+        self.assertEqual(self.download(1).status_code, 200)
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True)
+class SignDocumentViewTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.signer = Account.objects.create_user(username="signer", password="pw")
+        image_bytes, _, _ = make_signature_image(300, 100)
+        Signature.objects.create(user=self.signer, image=SimpleUploadedFile("signature.png", image_bytes, "image/png"))
+
+        self.client.force_login(self.owner)
+        self.client.post(
+            "/documents/upload/", {"file": SimpleUploadedFile("contract.pdf", make_pdf(1).tobytes(), "application/pdf")}
+        )
+        self.document = Document.objects.latest("pk")
+        field = {"page": 1, "assigned_user_id": str(self.signer.pk), "x_pdf": 50, "y_pdf": 50, "width_pdf": 150, "height_pdf": 50}
+        self.client.post(
+            f"/documents/save_signatures/{self.document.pk}/", {"signatures": [field]}, content_type="application/json"
+        )
+        self.document.refresh_from_db()
+        self.client.force_login(self.signer)
+
+    def sign(self):
+        return self.client.post(f"/documents/sign/{self.document.pk}/")
+
+    def test_documents_not_ready_cannot_be_signed(self):
+        size = os.path.getsize(self.document.file.path)
+        for status in (Document.STATUS_PROCESSING, Document.STATUS_FAILED):
+            Document.objects.filter(pk=self.document.pk).update(status=status)
+
+            self.assertEqual(self.sign().status_code, 409)
+
+        self.assertFalse(self.document.signature_fields.filter(signed=True).exists())
+        self.assertEqual(os.path.getsize(self.document.file.path), size)
+
+        Document.objects.filter(pk=self.document.pk).update(status=Document.STATUS_READY)
+        self.assertEqual(self.sign().status_code, 200)
+        self.assertFalse(self.document.signature_fields.filter(signed=False).exists())
+
+
+    @override_settings(SITE_URL="https://sign.example.com")
+    def test_completion_qr_is_stamped_with_the_last_signature(self):
+        second = Account.objects.create_user(username="second", password="pw")
+        image_bytes, _, _ = make_signature_image(300, 100)
+        Signature.objects.create(user=second, image=SimpleUploadedFile("second.png", image_bytes, "image/png"))
+        SignatureField.objects.create(
+            document=self.document, assigned_user=second, field_name="second_field",
+            page=1, x_pdf=250, y_pdf=50, width_pdf=150, height_pdf=50,
+        )
+        expected = qr_code_matrix(f"https://sign.example.com/documents/file/{self.document.pk}/")
+        blank = [[False] * len(expected) for _ in expected]
+
+        self.assertEqual(self.sign().status_code, 200)
+        self.document.refresh_from_db()
+        self.assertFalse(self.document.signed)
+        with fitz.open(self.document.file.path) as doc:
+            self.assertEqual(read_qr_modules(doc, len(expected)), blank)
+        revisions = self.document.revisions.count()
+
+        self.client.force_login(second)
+        self.assertEqual(self.sign().status_code, 200)
+
+        self.document.refresh_from_db()
+        self.assertTrue(self.document.signed)
+        # The QR code is part of the signature's revision, not a revision of its own
+        self.assertEqual(self.document.revisions.count(), revisions + 1)
+        revision = self.document.get_revision()
+        self.assertEqual(revision.reason, "signature")
+        self.assertEqual(os.path.getsize(self.document.file.path), revision.size)
+        with fitz.open(self.document.file.path) as doc:
+            self.assertEqual(read_qr_modules(doc, len(expected)), expected)
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True)
+@mock.patch(
+    "documents.jobs.ProcessPoolExecutor", lambda max_workers, mp_context: ThreadPoolExecutor(max_workers)
+)
+class BatchSignTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.signer = Account.objects.create_user(username="signer", password="pw")
+        image_bytes, _, _ = make_signature_image(300, 100)
+        Signature.objects.create(user=self.signer, image=SimpleUploadedFile("signature.png", image_bytes, "image/png"))
+
+        self.client.force_login(self.owner)
+        self.documents = []
+        for _ in range(2):
+            self.client.post(
+                "/documents/upload/",
+                {"file": SimpleUploadedFile("contract.pdf", make_pdf(1).tobytes(), "application/pdf")},
+            )
+            document = Document.objects.latest("pk")
+            field = {"page": 1, "assigned_user_id": str(self.signer.pk), "x_pdf": 50, "y_pdf": 50, "width_pdf": 150, "height_pdf": 50}
+            self.client.post(
+                f"/documents/save_signatures/{document.pk}/", {"signatures": [field]}, content_type="application/json"
+            )
+            self.documents.append(document)
+        self.client.force_login(self.signer)
+
+    def batch(self, documents="all"):
+        return self.client.post("/documents/sign/batch/", {"documents": documents}, content_type="application/json")
+
+    @override_settings(BATCH_SIGN_MAX_DOCUMENTS=1)
+    def test_all_is_capped_like_an_explicit_list(self):
+        response = self.batch()
+
+        self.assertEqual(response.status_code, 202, response.content)
+        status = self.client.get(response.json()["status_url"]).json()
+        self.assertEqual((status["state"], status["signed"], status["remaining"]), ("done", 1, 1))
+        self.assertEqual(
+            [document.signature_fields.filter(signed=True).count() for document in self.documents], [1, 0]
+        )
+
+    def test_rejects_a_second_batch_while_one_is_active(self):
+        active = DocumentJob.objects.create(kind="batch_sign", payload={"user_id": str(self.signer.pk), "documents": "all"})
+
+        response = self.batch([self.documents[0].pk])
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["job"], active.pk)
+        self.assertEqual(DocumentJob.objects.filter(kind="batch_sign").count(), 1)
+        self.assertFalse(SignatureField.objects.filter(signed=True).exists())
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True)
+class RevisionWriterTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        owner = Account.objects.create_user(username="owner", password="pw")
+        self.client.force_login(owner)
+        self.client.post(
+            "/documents/upload/", {"file": SimpleUploadedFile("contract.pdf", make_pdf(1).tobytes(), "application/pdf")}
+        )
+        self.document = Document.objects.latest("pk")
+
+    def append(self, document, data):
+        with RevisionWriter(document, "test") as writer, open(writer.path, "ab") as f:
+            f.write(data)
+        return writer
+
+    def file_bytes(self):
+        with open(self.document.file.path, "rb") as f:
+            return f.read()
+
+    def test_writer_prepared_before_another_commit_appends_on_top_of_it(self):
+        stale = Document.objects.get(pk=self.document.pk)
+        self.append(self.document, b"\n% first\n")
+
+        writer = self.append(stale, b"\n% second\n")
+
+        self.assertEqual((writer.base, stale.revision), (2, 3))
+        content = self.file_bytes()
+        sizes = [revision.size for revision in self.document.revisions.all()]
+        self.assertEqual(sizes, sorted(sizes))
+        self.assertEqual(content[sizes[0]:sizes[1]], b"\n% first\n")
+        self.assertEqual(content[sizes[1]:], b"\n% second\n")
+
+    def test_bytes_left_by_a_crashed_writer_are_cut_off(self):
+        size = self.document.get_revision().size
+        with open(self.document.file.path, "ab") as f:
+            f.write(b"\n% never committed\n")
+
+        writer = self.append(self.document, b"")
+
+        self.assertEqual(writer.base, 1)
+        self.assertEqual(os.path.getsize(self.document.file.path), size)
+        self.assertEqual(Document.objects.get(pk=self.document.pk).revision, 1)
+
+    def test_failed_block_discards_its_append(self):
+        size = self.document.get_revision().size
+        with self.assertRaises(RuntimeError):
+            with RevisionWriter(self.document, "test") as writer, open(writer.path, "ab") as f:
+                f.write(b"\n% half written\n")
+                f.flush()
+                raise RuntimeError("stamping failed")
+
+        self.assertEqual(os.path.getsize(self.document.file.path), size)
+        self.assertEqual(Document.objects.get(pk=self.document.pk).revision, 1)
+
+    def test_revision_moved_under_the_lock_is_a_conflict(self):
+        size = self.document.get_revision().size
+        writer = RevisionWriter(self.document, "test").open()
+        with open(writer.path, "ab") as f:
+            f.write(b"\n% lost\n")
+        Document.objects.filter(pk=self.document.pk).update(revision=5)
+
+        with self.assertRaises(RevisionConflict):
+            writer.commit()
+
+        self.assertEqual(os.path.getsize(self.document.file.path), size)
+
+
+def pdf_with_signature_field(path, signed):
+    with Pdf.new() as pdf:
+        pdf.add_blank_page()
+        field = Dictionary(FT=Name.Sig, T=String("Signature1"))
+        if signed:
+            field.V = Dictionary(Type=Name.Sig, Filter=Name("/Adobe.PPKLite"))
+        pdf.Root.AcroForm = Dictionary(Fields=Array([pdf.make_indirect(field)]))
+        pdf.save(path)
+
+
+class CompactPdfTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        self.source = os.path.join(self.tmpdir, "source.pdf")
+        self.output = os.path.join(self.tmpdir, "output.pdf")
+
+    def test_policies(self):
+        make_pdf(3).save(self.source)
+
+        self.assertFalse(compact_pdf(self.source, self.output, "none"))
+        self.assertFalse(os.path.exists(self.output))
+        for policy in ("light", "full"):
+            self.assertTrue(compact_pdf(self.source, self.output, policy))
+            with fitz.open(self.output) as doc:
+                self.assertEqual(doc.page_count, 3)
+
+    def test_refuses_digitally_signed_documents(self):
+        pdf_with_signature_field(self.source, signed=True)
+        self.assertFalse(compact_pdf(self.source, self.output, "full"))
+        self.assertFalse(os.path.exists(self.output))
+
+        # An empty signature field has no signed bytes to protect
+        pdf_with_signature_field(self.source, signed=False)
+        self.assertTrue(compact_pdf(self.source, self.output, "full"))
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True, PDF_COMPACTION_WINDOW="")
+class CompactionTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.signer = Account.objects.create_user(username="signer", password="pw")
+        self.client.force_login(self.owner)
+        self.client.post(
+            "/documents/upload/", {"file": SimpleUploadedFile("contract.pdf", make_pdf(4).tobytes(), "application/pdf")}
+        )
+        self.document = Document.objects.latest("pk")
+        fields = [
+            {"page": page, "assigned_user_id": str(self.signer.pk), "x_pdf": 50, "y_pdf": 50, "width_pdf": 150, "height_pdf": 50}
+            for page in range(1, 5)
+        ]
+        self.client.post(
+            f"/documents/save_signatures/{self.document.pk}/", {"signatures": fields}, content_type="application/json"
+        )
+        self.document.refresh_from_db()
+
+    def download(self, revision):
+        response = self.client.get(f"/documents/file/{self.document.pk}/?revision={revision}")
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content)
+
+    def test_compaction_keeps_earlier_revisions_byte_identical(self):
+        before = {number: self.download(number) for number in (1, 2)}
+
+        job = schedule_compaction(self.document, "full")
+
+        self.assertEqual(job.result["status"], "compacted", job.result)
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.revision, 3)
+        self.assertEqual({number: self.download(number) for number in (1, 2)}, before)
+        with open(self.document.file.path, "rb") as f:
+            self.assertEqual(self.download(3), f.read())
+        self.assertLess(os.path.getsize(self.document.file.path), len(before[2]))
+
+        # Appends after compaction build on the compacted file
+        with RevisionWriter(self.document, "test") as writer, open(writer.path, "ab") as f:
+            f.write(b"\n% appended\n")
+        self.assertEqual(self.download(4)[-12:], b"\n% appended\n")
+        self.assertEqual(self.download(2), before[2])
+
+    def test_failed_commit_leaves_the_file_and_history_alone(self):
+        path = self.document.file.path
+        with open(path, "rb") as f:
+            content = f.read()
+        source = os.path.join(os.path.dirname(path), "compacted.pdf")
+        with open(source, "wb") as f:
+            f.write(b"%PDF-1.7 compacted")
+
+        writer = RevisionWriter(self.document, "compaction").open()
+        with mock.patch.object(DocumentRevision.objects, "create", side_effect=DatabaseError("commit failed")):
+            with self.assertRaises(DatabaseError):
+                writer.replace(source)
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(source))
+        archive_dir = os.path.join(self.media_root, "archive", "documents", str(self.document.pk))
+        self.assertEqual(os.listdir(archive_dir) if os.path.isdir(archive_dir) else [], [])
+        self.assertEqual(Document.objects.get(pk=self.document.pk).revision, 2)
+        self.assertFalse(self.document.revisions.exclude(archive="").exists())
+
+    def test_skip_reasons(self):
+        for policy, reason in (("none", "Policy none"), ("fast", "Unknown policy 'fast'")):
+            with self.subTest(policy=policy):
+                # Queued directly: schedule_compaction would not take either
+                job = enqueue("compact", document=self.document, payload={"policy": policy})
+                self.assertEqual((job.state, job.attempts), (DocumentJob.STATE_DONE, 1))
+                self.assertEqual(job.result, {"status": "skipped", "reason": reason})
+
+        with RevisionWriter(self.document, "test") as writer:
+            pdf_with_signature_field(writer.path, signed=True)
+        signed = sha256_of(self.document.file.path)
+        job = schedule_compaction(self.document, "full")
+        self.assertEqual(job.result, {"status": "skipped", "reason": "Digitally signed"})
+        self.assertEqual(sha256_of(self.document.file.path), signed)
+
+    def test_unknown_policies_are_refused_up_front(self):
+        with self.assertRaises(ValueError):
+            schedule_compaction(self.document, "fast")
+        self.assertFalse(self.document.jobs.filter(kind="compact").exists())
+
+        with override_settings(PDF_COMPACTION_IDLE="fast"):
+            errors = check_compaction_policies(None)
+        self.assertEqual([error.id for error in errors], ["documents.E001"])
+        self.assertEqual(check_compaction_policies(None), [])
+
+    def test_deleting_the_document_removes_its_archive(self):
+        schedule_compaction(self.document, "full")
+        archive = self.document.revisions.get(number=1).archive.path
+        self.assertTrue(os.path.exists(archive))
+
+        self.client.post(f"/documents/delete/{self.document.pk}/")
+
+        self.assertFalse(os.path.exists(archive))
+
+
+class FieldCounterTests(TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.signer = Account.objects.create_user(username="signer", password="pw")
+        self.document = Document.objects.create(owner=self.owner, file="documents/owner/contract.pdf")
+
+    def field(self, name, signed=False):
+        return SignatureField(
+            document=self.document, assigned_user=self.signer, field_name=name, signed=signed,
+            page=1, x_pdf=0, y_pdf=0, width_pdf=10, height_pdf=10,
+        )
+
+    def assertCounters(self, total, signed):
+        self.document.refresh_from_db()
+        self.assertEqual((self.document.fields_total, self.document.fields_signed), (total, signed))
+        self.assertEqual(self.document.signature_fields.count(), total)
+        self.assertEqual(self.document.signature_fields.filter(signed=True).count(), signed)
+
+    def test_save_and_bulk_create_count_fields(self):
+        self.field("single").save()
+        SignatureField.objects.bulk_create([self.field("a"), self.field("b", signed=True), self.field("c")])
+
+        self.assertCounters(4, 1)
+
+    def test_sign_counts_each_field_once(self):
+        SignatureField.objects.bulk_create([self.field("a"), self.field("b"), self.field("c", signed=True)])
+
+        self.assertEqual(self.document.signature_fields.filter(field_name="a").sign(), 1)
+        self.assertCounters(3, 2)
+        # Already signed fields are skipped, not counted again
+        self.assertEqual(self.document.signature_fields.sign(), 1)
+        self.assertEqual(self.document.signature_fields.sign(), 0)
+        self.assertCounters(3, 3)
+        self.assertTrue(self.document.check_complete())
+
+    def test_delete_uncounts_fields(self):
+        SignatureField.objects.bulk_create([self.field("a"), self.field("b", signed=True), self.field("c")])
+
+        self.document.signature_fields.get(field_name="b").delete()
+        self.assertCounters(2, 0)
+        self.document.signature_fields.all().delete()
+        self.assertCounters(0, 0)
+
+    def test_recount_repairs_drift(self):
+        SignatureField.objects.bulk_create([self.field("a"), self.field("b", signed=True)])
+        # Writes that bypass the counters
+        SignatureField.objects.filter(field_name="a").update(signed=True)
+        Document.objects.filter(pk=self.document.pk).update(fields_total=7)
+        empty = Document.objects.create(owner=self.owner, file="documents/owner/empty.pdf")
+        Document.objects.filter(pk=empty.pk).update(fields_total=3, fields_signed=1)
+
+        stdout = io.StringIO()
+        call_command("recount_signature_fields", stdout=stdout)
+
+        self.assertIn("Recounted 2 document(s)", stdout.getvalue())
+        self.assertCounters(2, 2)
+        empty.refresh_from_db()
+        self.assertEqual((empty.fields_total, empty.fields_signed), (0, 0))
+
+
+class InboxPagingTests(TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.signer = Account.objects.create_user(username="signer", password="pw")
+        self.documents = [
+            Document.objects.create(owner=self.owner, file=f"documents/owner/{number}.pdf") for number in range(7)
+        ]
+        SignatureField.objects.bulk_create([
+            SignatureField(
+                document=document, assigned_user=self.signer, field_name=f"field_{document.pk}",
+                page=1, x_pdf=0, y_pdf=0, width_pdf=10, height_pdf=10,
+            )
+            for document in self.documents
+        ])
+        # Uploads in the same instant are ordered by pk
+        now = timezone.now()
+        Document.objects.filter(pk__in=[document.pk for document in self.documents[:5]]).update(uploaded_at=now)
+        Document.objects.filter(pk__in=[document.pk for document in self.documents[5:]]).update(
+            uploaded_at=now - timedelta(days=1)
+        )
+        self.client.force_login(self.signer)
+
+    def test_pages_cover_ties_without_duplicates_or_gaps(self):
+        seen, cursor, pages = [], None, 0
+        while True:
+            documents, cursor = inbox_page(self.signer, cursor=cursor, page_size=2)
+            seen.extend(document.pk for document in documents)
+            pages += 1
+            if cursor is None:
+                break
+
+        expected = [document.pk for document in reversed(self.documents[:5])]
+        expected += [document.pk for document in reversed(self.documents[5:])]
+        self.assertEqual(seen, expected)
+        self.assertEqual(pages, 4)
+
+    def test_last_page_has_no_cursor(self):
+        documents, cursor = inbox_page(self.signer, page_size=7)
+        self.assertEqual(len(documents), 7)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursors(self):
+        not_a_cursor = base64.urlsafe_b64encode(b"no separator").decode()
+        bad_date = base64.urlsafe_b64encode(b"yesterday|1").decode()
+        for cursor in ("%%%", "abc", not_a_cursor, bad_date):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    inbox_page(self.signer, cursor=cursor)
+                self.assertEqual(self.client.get("/documents/inbox/", {"cursor": cursor}).status_code, 400)
+                self.assertEqual(self.client.get("/documents/to_sign/", {"cursor": cursor}).status_code, 404)
+
+    def test_views_follow_the_cursor(self):
+        with self.settings(INBOX_PAGE_SIZE=4):
+            first = self.client.get("/documents/inbox/").json()
+            second = self.client.get("/documents/inbox/", {"cursor": first["next_cursor"]}).json()
+            page = self.client.get("/documents/to_sign/", {"cursor": first["next_cursor"]})
+
+        ids = [document["id"] for document in first["documents"] + second["documents"]]
+        self.assertEqual(sorted(ids), sorted(document.pk for document in self.documents))
+        self.assertIsNone(second["next_cursor"])
+        self.assertEqual(
+            [document["id"] for document in second["documents"]],
+            [document.pk for document in page.context["to_sign_documents"]],
+        )
+
+
+@override_settings(ASSIGNEE_SEARCH_PAGE_SIZE=3)
+class AssigneeSearchTests(TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.accounts = {
+            name: Account.objects.create_user(username=name, email=f"{name}@example.com", password="pw")
+            for name in ("alice", "bob", "carol", "dave", "erin", "frank", "grace")
+        }
+        Account.objects.filter(username="grace").update(is_active=False)
+
+    def assign(self, *names):
+        document = Document.objects.create(owner=self.owner, file="documents/owner/contract.pdf")
+        SignatureField.objects.bulk_create([
+            SignatureField(
+                document=document, assigned_user=self.accounts[name], field_name=f"field_{document.pk}_{name}",
+                page=1, x_pdf=0, y_pdf=0, width_pdf=10, height_pdf=10,
+            )
+            for name in names
+        ])
+
+    def pages(self, query=""):
+        pages, cursor = [], None
+        while True:
+            accounts, recent_ids, cursor = search_assignees(self.owner, query, after=cursor)
+            pages.append(([account.username for account in accounts], recent_ids))
+            if cursor is None:
+                return pages
+
+    def test_recent_assignees_lead_the_first_page(self):
+        self.assign("erin")
+
+        pages = self.pages()
+
+        self.assertEqual(
+            [names for names, _ in pages], [["erin", "alice", "bob"], ["carol", "dave", "frank"], ["owner"]]
+        )
+        self.assertEqual(pages[0][1], {self.accounts["erin"].pk})
+
+    def test_recents_filling_the_first_page_are_not_repeated_or_lost(self):
+        # Four recents tie on one document and overflow the page of three
+        self.assign("bob", "dave", "erin", "frank")
+
+        pages = self.pages()
+
+        names = [name for page, _ in pages for name in page]
+        self.assertEqual(len(pages[0][0]), 3)
+        self.assertEqual(pages[0][1], {self.accounts[name].pk for name in pages[0][0]})
+        self.assertEqual(sorted(names), ["alice", "bob", "carol", "dave", "erin", "frank", "owner"])
+        self.assertTrue(all(not recent_ids for _, recent_ids in pages[1:]))
+
+    def test_prefix_query(self):
+        self.assign("carol")
+        Account.objects.filter(username="frank").update(email="CARL@example.com")
+
+        self.assertEqual([names for names, _ in self.pages("CA")], [["carol", "frank"]])
+        self.assertEqual(self.pages("gr"), [([], set())])
+
+    def test_view(self):
+        self.assign("erin")
+        self.client.force_login(self.owner)
+
+        first = self.client.get("/documents/assignees/").json()
+        second = self.client.get("/documents/assignees/", {"after": first["next_cursor"]}).json()
+
+        self.assertEqual(
+            [(result["username"], result["recent"]) for result in first["results"]],
+            [("erin", True), ("alice", False), ("bob", False)],
+        )
+        self.assertEqual([result["username"] for result in second["results"]], ["carol", "dave", "frank"])
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True)
+class SaveSignaturesViewTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.signers = [Account.objects.create_user(username=f"signer{i}", password="pw") for i in range(3)]
+        self.client.force_login(self.owner)
+
+    def upload(self):
+        doc = make_pdf(1)
+        self.client.post(
+            "/documents/upload/", {"file": SimpleUploadedFile("contract.pdf", doc.tobytes(), "application/pdf")}
+        )
+        return Document.objects.latest("pk")
+
+    def layout(self, count):
+        # A grid of 80x60 boxes on an A4 page, assigned round-robin
+        return [
+            {
+                "page": 1, "assigned_user_id": str(self.signers[i % len(self.signers)].pk),
+                "x_pdf": 10 + (i % 6) * 90, "y_pdf": 10 + (i // 6) * 70, "width_pdf": 80, "height_pdf": 60,
+            }
+            for i in range(count)
+        ]
+
+    def save(self, document, fields):
+        return self.client.post(
+            f"/documents/save_signatures/{document.pk}/", {"signatures": fields}, content_type="application/json"
+        )
+
+    def test_query_count_does_not_grow_with_fields(self):
+        counts = {}
+        for field_count in (2, 60):
+            document = self.upload()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.save(document, self.layout(field_count))
+            self.assertEqual(response.status_code, 201, response.content)
+            counts[field_count] = len(queries)
+
+            document.refresh_from_db()
+            self.assertEqual(document.signature_fields.count(), field_count)
+            self.assertEqual(document.fields_total, field_count)
+
+        self.assertEqual(counts[2], counts[60])
+
+    def test_reports_every_invalid_field_and_saves_nothing(self):
+        document = self.upload()
+        fields = self.layout(4)
+        fields[1]["assigned_user_id"] = "not-a-user"
+        fields[2]["x_pdf"] = 10000
+        fields[3] = dict(fields[0])
+
+        response = self.save(document, fields)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error["index"] for error in response.json()["errors"]], [1, 2, 3])
+        document.refresh_from_db()
+        self.assertFalse(document.signature_fields.exists())
+        self.assertEqual(document.revision, 1)
+
+    def test_resaving_a_layout_keeps_existing_fields(self):
+        document = self.upload()
+        first = self.save(document, self.layout(3)).json()["fields"]
+
+        response = self.save(document, self.layout(4))
+
+        self.assertEqual(response.status_code, 201, response.content)
+        fields = response.json()["fields"]
+        self.assertEqual([field["created"] for field in fields], [False, False, False, True])
+        self.assertEqual([field["id"] for field in fields[:3]], [field["id"] for field in first])
+        document.refresh_from_db()
+        self.assertEqual(document.fields_total, 4)
+        self.assertEqual(document.revision, 3)
+
+
+@override_settings(REPLICA_DATABASE="replica")
+@mock.patch("pdfsign.routers.replica_is_healthy", return_value=True)
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+
+    def read_in_request(self, request, before_read=None):
+        """Runs a replica-scoped read through ReplicaPinningMiddleware; returns (alias, response)."""
+        aliases = []
+
+        def view(request):
+            with replica_reads():
+                if before_read:
+                    before_read()
+                aliases.append(self.router.db_for_read(Document))
+            return HttpResponse()
+
+        response = ReplicaPinningMiddleware(view)(request)
+        return aliases[0], response
+
+    def test_reads_use_the_primary_outside_replica_scope(self, healthy):
+        self.assertIsNone(self.router.db_for_read(Document))
+        self.assertEqual(self.read_in_request(RequestFactory().get("/"))[0], "replica")
+
+    def test_write_pins_the_rest_of_the_request_and_the_client(self, healthy):
+        request = RequestFactory().post("/")
+        alias, response = self.read_in_request(request, before_read=lambda: self.router.db_for_write(Document))
+
+        self.assertIsNone(alias)
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        # The client's next request still reads from the primary
+        request = RequestFactory().get("/")
+        request.COOKIES[PIN_COOKIE] = response.cookies[PIN_COOKIE].value
+        self.assertIsNone(self.read_in_request(request)[0])
+
+        # Without a recent write, reads go to the replica again
+        alias, response = self.read_in_request(RequestFactory().get("/"))
+        self.assertEqual(alias, "replica")
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_falls_back_to_the_primary_when_the_replica_is_unhealthy(self, healthy):
+        healthy.return_value = False
+        self.assertIsNone(self.read_in_request(RequestFactory().get("/"))[0])
+
+    def test_writes_and_migrations_stay_on_the_primary(self, healthy):
+        with replica_reads():
+            self.assertEqual(self.router.db_for_write(Document), "default")
+        self.assertTrue(self.router.allow_migrate("default", "documents"))
+        self.assertFalse(self.router.allow_migrate("replica", "documents"))
+
+
+@unittest.skipUnless(
+    "replica" in settings.DATABASES,
+    "No replica configured; run with PDFSIGN_SQLITE_REPLICA=<path> (or DB_REPLICA_HOST)",
+)
+class ReplicaReadViewTests(TempMediaRootMixin, TransactionTestCase):
+    # Declaring a missing alias fails the whole run, even with the class skipped
+    databases = {"default", "replica"} if "replica" in settings.DATABASES else {"default"}
+
+    def setUp(self):
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.client.force_login(self.owner)
+
+    def queries_per_database(self, path):
+        with CaptureQueriesContext(connections["default"]) as primary, \
+                CaptureQueriesContext(connections["replica"]) as replica:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(primary), len(replica)
+
+    def test_list_views_read_from_the_replica(self):
+        for path in ("/documents/uploads/", "/documents/to_sign/", "/documents/inbox/"):
+            primary, replica = self.queries_per_database(path)
+            self.assertGreater(replica, 0, path)
+
+    def test_reads_stick_to_the_primary_after_a_write(self):
+        response = self.client.post("/documents/upload/", {
+            "file": SimpleUploadedFile("contract.pdf", make_pdf(1).tobytes(), "application/pdf"),
+        })
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        primary, replica = self.queries_per_database("/documents/uploads/")
+        self.assertEqual(replica, 0)
@@ -0,0 +1,261 @@
+"""
+Document creation from uploads, shared by the form upload and the chunked upload API.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.base import File
+from django.db import transaction
+from django.utils import timezone
+
+from .jobs import enqueue
+from .models import Document, DocumentBlob, UploadSession
+from .utils import read_page_geometry
+
+CHUNK_SIZE = 64 * 1024
+
+# Running SHA-256 state per upload session, so each chunk is hashed exactly once as it arrives.
+# hashlib objects cannot be persisted, so a worker that has not seen the session yet (or was
+# restarted, or evicted it) rebuilds the state from the bytes already on disk. An LRU bounded by
+# settings.CHUNKED_UPLOAD_HASHER_CACHE_SIZE, so abandoned sessions do not pile up.
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+class AssembledUpload(File):
+    """
+    A finished chunked upload. Exposing temporary_file_path lets FileSystemStorage move the part
+    file into place instead of copying it.
+    """
+
+    def __init__(self, path, name):
+        super().__init__(open(path, "rb"), name=name)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def hash_file(uploaded_file):
+    """Returns the SHA-256 hex digest of a django File, reading it in chunks."""
+    hasher = hashlib.sha256()
+    for chunk in uploaded_file.chunks(CHUNK_SIZE):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def create_document(owner, uploaded_file, sha256=None):
+    """
+    Saves an uploaded PDF as a new Document owned by owner and queues its normalization.
+
+    The bytes are stored once per distinct content: a Document whose content was uploaded before
+    points at the existing DocumentBlob and, if that blob is already normalized, is ready at once.
+
+    Args:
+        owner: The uploading Account.
+        uploaded_file: A django File (form upload or AssembledUpload).
+        sha256: The content hash, if the caller already computed it while receiving the file.
+
+    Returns:
+        The new Document.
+    """
+    filename = os.path.basename(uploaded_file.name)
+    sha256 = sha256 or hash_file(uploaded_file)
+
+    # The blob's row stays locked until the document is saved, so a concurrent normalization of the
+    # blob, which points every document of the blob at the normalized file, cannot miss this one
+    with transaction.atomic():
+        blob = DocumentBlob.objects.acquire(uploaded_file, sha256)
+        document = Document(
+            owner=owner,
+            blob=blob,
+            filename=filename,
+            status=Document.STATUS_READY if blob.normalized else Document.STATUS_PENDING,
+        )
+        document.file.name = blob.file.name
+        document.save()
+
+    if blob.normalized:
+        document.index_pages(read_page_geometry(blob.file.path))
+        document.record_revision("upload")
+        return document
+
+    # Normalization runs out of band; the assign page polls DocumentStatusView until it is done
+    enqueue("normalize", document=document)
+    return document
+
+
+def _get_hasher(session):
+    with _hashers_lock:
+        cached = _hashers.get(session.pk)
+        if cached:
+            _hashers.move_to_end(session.pk)
+    if cached and cached[0] == session.offset:
+        return cached[1].copy()
+
+    hasher = hashlib.sha256()
+    if session.offset:
+        with open(session.part_path, "rb") as part:
+            remaining = session.offset
+            while remaining:
+                data = part.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise ValueError("Upload part file is shorter than the acknowledged offset")
+                hasher.update(data)
+                remaining -= len(data)
+    return hasher
+
+
+def _store_hasher(session, offset, hasher):
+    with _hashers_lock:
+        _hashers[session.pk] = (offset, hasher)
+        _hashers.move_to_end(session.pk)
+        while len(_hashers) > settings.CHUNKED_UPLOAD_HASHER_CACHE_SIZE:
+            _hashers.popitem(last=False)
+
+
+def _forget_hasher(session):
+    with _hashers_lock:
+        _hashers.pop(session.pk, None)
+
+
+@contextmanager
+def _locked_part(session):
+    """
+    The session's part file, opened (and created if missing) under an exclusive lock held until exit.
+
+    Every writer of a session (append_chunk, complete_upload, expire_upload_sessions) takes it, and
+    then re-reads the session row: whoever held the lock before may have moved the offset, completed
+    the upload or deleted the session.
+    """
+    os.makedirs(os.path.dirname(session.part_path), exist_ok=True)
+    # Opened without truncating: a concurrent request may be holding the lock on existing bytes
+    with os.fdopen(os.open(session.part_path, os.O_RDWR | os.O_CREAT, 0o644), "r+b") as part:
+        fcntl.flock(part, fcntl.LOCK_EX)
+        yield part
+        # The lock is released when the file is closed
+
+
+def _discard_part(session):
+    """Removes a part file recreated by opening it after its session was completed or deleted."""
+    if os.path.exists(session.part_path):
+        os.remove(session.part_path)
+
+
+def append_chunk(session, start, stream, length):
+    """
+    Writes length bytes from stream to the session's part file at start and advances its offset.
+
+    Chunks of one session are written one at a time, under an exclusive lock on the part file, and
+    only if start still equals the acknowledged offset once the lock is held. A retried or duplicated
+    chunk therefore never writes, or cuts the file, at an offset a later chunk has already moved past.
+
+    Returns:
+        True if the chunk was acknowledged, False if another request advanced the offset first.
+
+    Raises:
+        UploadSession.DoesNotExist: If the session expired meanwhile.
+    """
+    with _locked_part(session) as part:
+        offset = UploadSession.objects.filter(pk=session.pk).values_list("offset", flat=True).first()
+        if offset is None:
+            _discard_part(session)
+            raise UploadSession.DoesNotExist(f"Upload session {session.pk} expired")
+        session.offset = offset
+        if start != session.offset:
+            return False
+
+        hasher = _get_hasher(session)
+        part.seek(start)
+        remaining = length
+        while remaining:
+            data = stream.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise ValueError("Chunk ended before its declared length")
+            hasher.update(data)
+            part.write(data)
+            remaining -= len(data)
+        # Drop any tail left behind by an interrupted earlier attempt
+        part.truncate()
+        part.flush()
+
+        end = start + length
+        # update() skips auto_now; expiry goes by the time the last chunk arrived
+        acknowledged = UploadSession.objects.filter(pk=session.pk, offset=start).update(
+            offset=end, updated_at=timezone.now()
+        )
+        if acknowledged:
+            session.offset = end
+            _store_hasher(session, end, hasher)
+    return bool(acknowledged)
+
+
+def complete_upload(session, expected_sha256=None):
+    """
+    Finalizes a fully received upload session into a Document.
+
+    Completions of one session are serialized on the part file lock, so a retried or duplicated
+    request gets the document the first one made instead of a second copy.
+
+    Args:
+        session: A complete UploadSession.
+        expected_sha256: Optional client-side digest; a mismatch raises ValueError.
+
+    Returns:
+        The session's Document.
+
+    Raises:
+        UploadSession.DoesNotExist: If the session expired meanwhile.
+    """
+    with _locked_part(session):
+        try:
+            session.refresh_from_db()
+        except UploadSession.DoesNotExist:
+            _discard_part(session)
+            raise
+        if session.document_id:
+            _discard_part(session)
+            return session.document
+
+        sha256 = _get_hasher(session).hexdigest()
+        if expected_sha256 and expected_sha256.lower() != sha256:
+            raise ValueError(f"Checksum mismatch: received data hashes to {sha256}")
+        session.sha256 = sha256
+
+        with AssembledUpload(session.part_path, session.filename) as upload:
+            document = create_document(session.owner, upload, sha256=sha256)
+
+        # Still there if the content was already stored; the blob was reused instead of this copy
+        _discard_part(session)
+
+        session.document = document
+        session.save(update_fields=["sha256", "document", "updated_at"])
+
+    _forget_hasher(session)
+    return document
+
+
+def expire_upload_sessions(older_than):
+    """
+    Deletes the upload sessions left incomplete since before older_than, with their part files.
+
+    Returns:
+        The number of sessions deleted.
+    """
+    sessions = UploadSession.objects.filter(document__isnull=True, updated_at__lt=older_than)
+    expired = 0
+    for session in sessions.iterator():
+        with _locked_part(session):
+            # A chunk or the completion may have landed while the lock was awaited
+            deleted, _ = sessions.filter(pk=session.pk).delete()
+            if not deleted:
+                continue
+            _discard_part(session)
+        _forget_hasher(session)
+        expired += 1
+    return expired
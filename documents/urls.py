@@ -1,15 +1,33 @@
 from django.urls import path
 from .views import UploadDocumentView, DocumentListView, ToSignListView, SignDocumentView, AssignSignaturesView, \
-    SaveSignaturesView, DeleteDocumentView, SignedListView
+    SaveSignaturesView, DeleteDocumentView, SignedListView, DocumentStatusView, DocumentPagesView, DocumentPageImageView, \
+    DocumentFileView, ChunkedUploadStartView, ChunkedUploadView, ChunkedUploadCompleteView, BatchSignView, BatchSignStatusView, \
+    DigitalSignDocumentView, InboxView, InboxBadgeView, AssigneeSearchView
 
 urlpatterns = [
     path("upload/", UploadDocumentView.as_view(), name="upload_document"),
+    path("upload/chunked/", ChunkedUploadStartView.as_view(), name="chunked_upload_start"),
+    path("upload/chunked/<uuid:upload_id>/", ChunkedUploadView.as_view(), name="chunked_upload"),
+    path("upload/chunked/<uuid:upload_id>/complete/", ChunkedUploadCompleteView.as_view(),
+         name="chunked_upload_complete"),
     path("uploads/", DocumentListView.as_view(), name="document_list"),
     path("to_sign/", ToSignListView.as_view(), name="to_sign_list"),
     path("signed/", SignedListView.as_view(), name="signed_list"),
+    path("inbox/", InboxView.as_view(), name="inbox"),
+    path("inbox/badge/", InboxBadgeView.as_view(), name="inbox_badge"),
     path("sign/<int:pk>/", SignDocumentView.as_view(), name="sign_document"),
+    path("sign/<int:pk>/digital/", DigitalSignDocumentView.as_view(), name="digital_sign_document"),
+    path("sign/batch/", BatchSignView.as_view(), name="batch_sign"),
+    path("sign/batch/<int:pk>/", BatchSignStatusView.as_view(), name="batch_sign_status"),
     path("assign_signatures/<int:pk>/", AssignSignaturesView.as_view(), name="assign_signatures"),
     path("save_signatures/<int:pk>/", SaveSignaturesView.as_view(), name="save_signatures"),
+    path("assignees/", AssigneeSearchView.as_view(), name="assignee_search"),
     path("delete/<int:pk>/", DeleteDocumentView.as_view(), name="delete_document"),
+    path("status/<int:pk>/", DocumentStatusView.as_view(), name="document_status"),
+    path("file/<int:pk>/", DocumentFileView.as_view(), name="document_file"),
+    path("pages/<int:pk>/", DocumentPagesView.as_view(), name="document_pages"),
+    path("pages/<int:pk>/<int:number>/image/", DocumentPageImageView.as_view(), name="document_page_image"),
+    path("pages/<int:pk>/<int:number>/thumbnail/", DocumentPageImageView.as_view(thumbnail=True),
+         name="document_page_thumbnail"),
 
 ]
@@ -1,13 +1,22 @@
+from django.conf import settings
+from pikepdf import Pdf, Name, ObjectStreamMode, StreamDecodeLevel
 from pypdf import PdfReader, PdfWriter
 
 import qrcode
 import fitz  # PyMuPDF
+import io
 import os
-from PIL import Image  # ***Import Image from PIL***
+from types import SimpleNamespace
 
 
-def generate_qr_code(data, output_path):
-    """Generates a QR code from the given data and saves it to the specified path."""
+
+def generate_qr_code(data):
+    """
+    Generates a QR code from the given data, in memory.
+
+    Returns:
+        (png_bytes, width, height), the size in pixels.
+    """
 
     qr = qrcode.QRCode(
         version=None,  # Let qrcode decide the version
@@ -19,49 +28,182 @@ def generate_qr_code(data, output_path):
     qr.make(fit=True)  # Make the QR code fit the data
 
     img = qr.make_image(fill_color="black", back_color="white")  # Customize colors
-    img.save(output_path)
-    return output_path
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format="PNG")
+    return img_bytes.getvalue(), img.pixel_size, img.pixel_size
 
 
-def stamp_pdf_with_qr(qr_code_path, pdf_path, output_path):
-    """Stamps a PDF file with a QR code on the lower right corner of the first page."""
+def save_incremental(doc):
+    """
+    Appends the changes made to doc (opened from a file path) to that file as an incremental update.
+
+    The bytes of earlier revisions are left untouched, so the write costs what was changed, not
+    the size of the document.
+    """
+    doc.save(doc.name, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+
+
+def qr_code_matrix(data):
+    """The modules of a QR code encoding data, including its quiet zone, as rows of booleans (True is dark)."""
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def qr_code_pdf(data):
+    """
+    Draws a QR code encoding data as a one-page PDF, one point per module, for fitz's show_pdf_page.
+
+    Each run of dark modules in a row is a single rectangle and all of them are filled at once, so
+    the content stream stays small (well under 1 KB compressed for a typical URL) and sharp at any zoom.
+    """
+    matrix = qr_code_matrix(data)
+    size = len(matrix)
+
+    # White background, then the dark runs; PDF y runs bottom-up
+    ops = [f"1 g 0 0 {size} {size} re f 0 g"]
+    for row_index, row in enumerate(matrix):
+        y = size - row_index - 1
+        x = 0
+        while x < size:
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < size and row[x]:
+                x += 1
+            ops.append(f"{start} {y} {x - start} 1 re")
+    ops.append("f")
+
+    src = fitz.open()
+    page = src.new_page(width=size, height=size)
+    page.draw_rect(page.rect, width=0)  # Creates the page's content stream, replaced below
+    src.update_stream(page.get_contents()[0], "\n".join(ops).encode())
+    return src
 
-    try:
-        doc = fitz.open(pdf_path)
-        page = doc[0]  # Get the first page
 
-        # Get QR code image dimensions
-        qr_img = Image.open(qr_code_path)  # PIL Image
-        qr_width, qr_height = qr_img.size
+def stamp_qr_code(doc, data):
+    """
+    Stamps a QR code encoding data on the lower right corner of the first page of an open fitz.Document.
 
+    With settings.QR_STAMP_MODE "vector" (the default) the code is drawn as a form XObject of filled
+    rectangles; "raster" embeds the PNG from generate_qr_code instead.
+    """
+    page = doc[0]  # Get the first page
+
+    if settings.QR_STAMP_MODE == "raster":
+        qr_bytes, qr_width, qr_height = generate_qr_code(data)
         qr_width = qr_width // 4
         qr_height = qr_height // 4
+    else:
+        qr_pdf = qr_code_pdf(data)
+        # Same footprint as the raster stamp: 10 px per module, scaled down by 4
+        qr_width = qr_height = qr_pdf[0].rect.width * 10 // 4
 
-        # PDF page dimensions
-        page_width = page.rect.width
-        page_height = page.rect.height
+    # PDF page dimensions
+    page_width = page.rect.width
+    page_height = page.rect.height
 
-        # Calculate QR code position (lower right corner with some margin)
-        margin = 20  # Adjust margin as needed
-        x = page_width - qr_width - margin
-        y = page_height - qr_height - margin
+    # Calculate QR code position (lower right corner with some margin)
+    margin = 20  # Adjust margin as needed
+    x = page_width - qr_width - margin
+    y = page_height - qr_height - margin
 
-        rect = fitz.Rect(x, y, x + qr_width, y + qr_height)
+    rect = fitz.Rect(x, y, x + qr_width, y + qr_height)
 
-        # Insert QR code
-        page.insert_image(rect, filename=qr_code_path)
+    # Insert QR code
+    if settings.QR_STAMP_MODE == "raster":
+        page.insert_image(rect, stream=qr_bytes)
+    else:
+        with qr_pdf:
+            page.show_pdf_page(rect, qr_pdf, 0)
 
-        doc.save(output_path, garbage=4, clean=True)  # Overwrite the PDF, and clean the PDF
-        doc.close()
 
+def stamp_qr_file(pdf_path, data):
+    """Stamps a QR code encoding data on the PDF at pdf_path, appended as an incremental update."""
+    try:
+        with fitz.open(pdf_path) as doc:
+            stamp_qr_code(doc, data)
+            save_incremental(doc)
     except fitz.FileNotFoundError:
         raise FileNotFoundError(f"PDF file not found: {pdf_path}")
-    except Exception as e:
-        raise Exception(f"An error occurred: {e}")
+
+
+def stamp_signature_fields(doc, fields, image_bytes, image_width, image_height):
+    """
+    Places a signature image in every field rectangle, embedding the image only once.
+
+    The first field embeds the image; every other field reuses the same image XObject by xref, so
+    the document grows by one image no matter how many fields are signed. Each placement is scaled
+    to fit its field's box, anchored at the top-left corner like the original per-field images.
+
+    Args:
+        doc: An open fitz.Document.
+        fields: SignatureFields (or anything with page, x_pdf, y_pdf, width_pdf, height_pdf).
+        image_bytes: The encoded signature image, ideally sized for the largest field.
+        image_width: Width of the image in pixels.
+        image_height: Height of the image in pixels.
+
+    Returns:
+        The xref of the embedded image, or 0 if there were no fields.
+    """
+    xref = 0
+    for field in fields:
+        scale_factor = min(field.width_pdf / image_width, field.height_pdf / image_height)
+        rect = fitz.Rect(
+            field.x_pdf,
+            field.y_pdf,
+            field.x_pdf + image_width * scale_factor,
+            field.y_pdf + image_height * scale_factor,
+        )
+
+        page = doc[field.page - 1]
+        if xref:
+            page.insert_image(rect, xref=xref)
+        else:
+            xref = page.insert_image(rect, stream=image_bytes)
+
+    return xref
+
+
+def stamp_signature_file(pdf_path, boxes, image_bytes, image_width, image_height, qr_data=None):
+    """
+    Stamps a signature image into every box of the PDF at pdf_path and appends the result to it as
+    an incremental update.
+
+    Takes plain values only, so it can run in a worker process (see the batch_sign job).
+
+    Args:
+        boxes: (page, x_pdf, y_pdf, width_pdf, height_pdf) tuples, page 1-based.
+        qr_data: If given, a QR code encoding it is stamped in the same update (for the signature
+            that completes the document).
+
+    Returns:
+        The size of the file after the update.
+    """
+    fields = [
+        SimpleNamespace(page=page, x_pdf=x, y_pdf=y, width_pdf=width, height_pdf=height)
+        for page, x, y, width, height in boxes
+    ]
+    with fitz.open(pdf_path) as doc:
+        stamp_signature_fields(doc, fields, image_bytes, image_width, image_height)
+        if qr_data:
+            stamp_qr_code(doc, qr_data)
+        save_incremental(doc)
+    return os.path.getsize(pdf_path)
 
 
 def remove_hybrid_xrefs(pdf_path, cleaned_pdf_path):
-    """Rewrites a PDF to remove hybrid cross-reference tables."""
+    """
+    Rewrites a PDF to remove hybrid cross-reference tables.
+
+    Superseded by normalize_pdf; kept as the baseline for the benchmark_normalize command.
+    """
     reader = PdfReader(pdf_path)
     writer = PdfWriter()
 
@@ -70,3 +212,119 @@ def remove_hybrid_xrefs(pdf_path, cleaned_pdf_path):
 
     with open(cleaned_pdf_path, "wb") as output_pdf:
         writer.write(output_pdf)
+
+
+def _inherited(page_obj, key):
+    """Looks up a page attribute that may be inherited from the page tree."""
+    node = page_obj
+    while node is not None:
+        if key in node:
+            return node[key]
+        node = node.get("/Parent")
+    return None
+
+
+def _page_geometry(pdf):
+    """Returns the mediabox, cropbox and rotation of every page of an open pikepdf.Pdf."""
+    geometry = []
+    for page in pdf.pages:
+        rotation = _inherited(page.obj, "/Rotate")
+        geometry.append({
+            "mediabox": [float(value) for value in page.mediabox],
+            "cropbox": [float(value) for value in page.cropbox],
+            "rotation": int(rotation) % 360 if rotation is not None else 0,
+        })
+    return geometry
+
+
+def read_page_geometry(pdf_path):
+    """
+    Reads page geometry without rewriting the file.
+
+    Returns:
+        A list with one dict (mediabox, cropbox, rotation) per page.
+    """
+    with Pdf.open(pdf_path) as pdf:
+        return _page_geometry(pdf)
+
+
+def normalize_pdf(pdf_path, output_path=None):
+    """
+    Normalizes an uploaded PDF with a single parse and a single write.
+
+    Replaces the old pypdf (remove_hybrid_xrefs) + pikepdf double rewrite: the cross-reference
+    section is rebuilt from scratch (which drops hybrid xref tables), the catalog entries listed in
+    settings.PDF_NORMALIZE_STRIP_KEYS (none by default) are removed, and the result is saved once, linearized unless
+    settings.PDF_LINEARIZE is off. Page geometry is collected from the same parse.
+
+    Args:
+        pdf_path: The PDF to normalize.
+        output_path: Where to write the result. Defaults to overwriting pdf_path.
+
+    Returns:
+        A list with one dict (mediabox, cropbox, rotation) per page.
+    """
+    output_path = output_path or pdf_path
+    object_stream_mode = getattr(ObjectStreamMode, settings.PDF_NORMALIZE_OBJECT_STREAMS)
+
+    with Pdf.open(pdf_path, allow_overwriting_input=True) as pdf:
+        for key in settings.PDF_NORMALIZE_STRIP_KEYS:
+            if key in pdf.Root:
+                del pdf.Root[key]
+
+        geometry = _page_geometry(pdf)
+        pdf.save(output_path, object_stream_mode=object_stream_mode, linearize=settings.PDF_LINEARIZE)
+
+    return geometry
+
+
+# Full-rewrite settings for compact_pdf, by policy name. Any rewrite drops unreachable objects and
+# folds the incremental revisions into one; "full" also recompresses every Flate stream and packs
+# objects into object streams, at a higher CPU cost.
+COMPACTION_POLICIES = {
+    "none": None,
+    "light": {"object_stream_mode": ObjectStreamMode.preserve, "compress_streams": True},
+    "full": {
+        "object_stream_mode": ObjectStreamMode.generate,
+        "compress_streams": True,
+        "recompress_flate": True,
+        "stream_decode_level": StreamDecodeLevel.generalized,
+    },
+}
+
+
+def _signature_fields(fields):
+    for field in fields:
+        if field.get("/FT") == Name.Sig:
+            yield field
+        if "/Kids" in field:
+            yield from _signature_fields(field.Kids)
+
+
+def has_digital_signatures(pdf):
+    """Whether an open pikepdf.Pdf has a signed signature field, whose byte range a rewrite would break."""
+    acroform = pdf.Root.get("/AcroForm")
+    if acroform is None or "/Fields" not in acroform:
+        return False
+    return any("/V" in field for field in _signature_fields(acroform.Fields))
+
+
+def compact_pdf(pdf_path, output_path, policy):
+    """
+    Rewrites a PDF with one of COMPACTION_POLICIES.
+
+    Documents carrying digital signatures are left alone: a rewrite moves the signed bytes and
+    invalidates every signature.
+
+    Returns:
+        Whether output_path was written; False for the "none" policy and for signed documents.
+    """
+    options = COMPACTION_POLICIES[policy]
+    if options is None:
+        return False
+
+    with Pdf.open(pdf_path) as pdf:
+        if has_digital_signatures(pdf):
+            return False
+        pdf.save(output_path, linearize=settings.PDF_LINEARIZE, **options)
+    return True
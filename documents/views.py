@@ -1,16 +1,16 @@
-import io
 import json
 import json
 import logging
 import os
+import re
+import uuid
 
-from PIL import Image
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
-from django.db.models.aggregates import Count
-from django.http import JsonResponse
-from django.http.response import HttpResponseRedirect
+from django.http import FileResponse, Http404, JsonResponse
+from django.http.response import HttpResponse, HttpResponseRedirect
 from django.shortcuts import redirect
 from django.shortcuts import render, get_object_or_404
 from django.urls.base import reverse
@@ -19,16 +19,23 @@ from django.views import View
 from django.views.generic import ListView
 from django.views.generic.base import TemplateView
 from django.views.generic.edit import FormView
-from pikepdf import Pdf
 import fitz
 from pyhanko.sign.fields import SigFieldSpec, append_signature_field
 from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
 
 from accounts.models import Account
+from pdfsign.routers import ReplicaReadMixin
 from signatures.utils import get_user_signature_path
+from .assignees import search_assignees
 from .forms import DocumentUploadForm
-from .models import Document, SignatureField
-from .utils import remove_hybrid_xrefs, generate_qr_code, stamp_pdf_with_qr
+from .inbox import inbox_page, pending_count
+from .jobs import enqueue, enqueue_batch_sign, schedule_compaction
+from .models import Document, DocumentJob, SignatureField, UploadSession
+from .rendering import open_render, snap_scale, thumbnail_scale
+from .revisions import RevisionWriter
+from .serving import serve_document_file
+from .signing import async_add_digital_signatures, prepare_rendition, sign_fields
+from .uploads import append_chunk, complete_upload, create_document
 
 # Set up logging (customize as needed)
 logger = logging.getLogger(__name__)  # Use your view's module name
@@ -43,42 +50,208 @@ class UploadDocumentView(LoginRequiredMixin, FormView):
     form_class = DocumentUploadForm
 
     def form_valid(self, form):
-        # Grab the file from the form
-        uploaded_file = form.cleaned_data['file']
+        document = create_document(self.request.user, form.cleaned_data['file'])
 
-        # Generate an 8-character random string
-        random_str = get_random_string(8)
+        # Redirect
+        return redirect("assign_signatures", pk=document.pk)
+
+
+class ChunkedUploadStartView(LoginRequiredMixin, View):
+    """
+    Opens a resumable upload. Expects JSON {"filename": ..., "size": <total bytes>}.
+    """
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+            filename = os.path.basename(data["filename"])
+            size = int(data["size"])
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            return JsonResponse({"error": "filename and size are required"}, status=400)
+
+        if not filename or size <= 0:
+            return JsonResponse({"error": "filename and size are required"}, status=400)
+        if size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+            return JsonResponse({"error": "File is too large"}, status=413)
 
-        # Split the original filename to avoid double extensions
-        base, ext = os.path.splitext(uploaded_file.name)
+        session = UploadSession.objects.create(owner=request.user, filename=filename, size=size)
+        return JsonResponse({"upload_id": str(session.pk), "offset": 0, "size": size}, status=201)
 
-        # Create your new name
-        new_filename = f"{random_str}_{base}{ext}"
 
-        # Assign the new name to the uploaded file
-        uploaded_file.name = new_filename
+class ChunkedUploadView(LoginRequiredMixin, View):
+    """
+    GET reports the acknowledged offset to resume from; PUT appends a chunk.
+
+    Chunks are raw request bodies with a "Content-Range: bytes <start>-<end>/<size>" header, where
+    start must equal the acknowledged offset. The body is streamed to disk, never buffered whole.
+    """
+    content_range_re = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
 
-        # Save the Document with the new file name
-        document = form.save(commit=False)
-        document.owner = self.request.user
-        document.save()  # now the file gets saved with the new name
+    def dispatch(self, request, *args, **kwargs):
+        self.session = get_object_or_404(UploadSession, pk=kwargs["upload_id"], owner=request.user)
+        return super().dispatch(request, *args, **kwargs)
 
-        # Remove hybrid xrefs on the newly saved file
-        pdf_path = document.file.path
-        remove_hybrid_xrefs(pdf_path, pdf_path)
+    def status(self, status=200):
+        return JsonResponse({
+            "upload_id": str(self.session.pk),
+            "offset": self.session.offset,
+            "size": self.session.size,
+            "complete": self.session.is_complete,
+        }, status=status)
+
+    def get(self, request, upload_id):
+        return self.status()
+
+    def put(self, request, upload_id):
+        if self.session.document_id:
+            return JsonResponse({"error": "Upload already completed"}, status=409)
+
+        match = self.content_range_re.match(request.headers.get("Content-Range", ""))
+        if not match:
+            return JsonResponse({"error": "A Content-Range header is required"}, status=400)
+
+        start, end, size = (int(value) for value in match.groups())
+        length = end - start + 1
+        if size != self.session.size or length <= 0 or end >= size:
+            return JsonResponse({"error": "Content-Range does not match the upload"}, status=416)
+        if start != self.session.offset:
+            # Out of order chunk; the client resumes from the offset we report
+            return self.status(status=409)
 
-        # Re-save to strip out any incompatible features
         try:
-            with Pdf.open(pdf_path, allow_overwriting_input=True) as pdf:
-                pdf.save(pdf_path)
-        except Exception as e:
-            print(f"Error rewriting PDF with pikepdf: {e}")
+            acknowledged = append_chunk(self.session, start, request, length)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        except UploadSession.DoesNotExist:
+            raise Http404("Upload session expired")
 
-        # Redirect
-        return redirect("assign_signatures", pk=document.pk)
+        if not acknowledged:
+            self.session.refresh_from_db()
+            return self.status(status=409)
+        return self.status()
+
+
+class ChunkedUploadCompleteView(LoginRequiredMixin, View):
+    """
+    Turns a fully received upload into a Document. Accepts an optional JSON {"sha256": ...} to verify.
+    """
+
+    def post(self, request, upload_id):
+        session = get_object_or_404(UploadSession, pk=upload_id, owner=request.user)
+        if session.document_id:
+            return JsonResponse({"document_id": session.document_id, "sha256": session.sha256})
+        if not session.is_complete:
+            return JsonResponse({"error": "Upload is incomplete", "offset": session.offset}, status=409)
+
+        try:
+            expected = json.loads(request.body or b"{}").get("sha256")
+        except json.JSONDecodeError:
+            return JsonResponse({"error": "Invalid JSON data"}, status=400)
+
+        try:
+            document = complete_upload(session, expected_sha256=expected)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=422)
+        except UploadSession.DoesNotExist:
+            raise Http404("Upload session expired")
+
+        return JsonResponse({
+            "document_id": document.pk,
+            "sha256": session.sha256,
+            "assign_url": reverse("assign_signatures", kwargs={"pk": document.pk}),
+        }, status=201)
 
 
-class DocumentListView(LoginRequiredMixin, ListView):
+class DocumentStatusView(LoginRequiredMixin, View):
+    """
+    Reports the post-upload processing state of a document, polled by the assign page.
+    """
+
+    def get(self, request, pk):
+        document = get_object_or_404(Document, pk=pk, owner=request.user)
+        job = document.jobs.filter(kind="normalize").order_by("-pk").first()
+
+        return JsonResponse({
+            "id": document.pk,
+            "status": document.status,
+            "ready": document.status == Document.STATUS_READY,
+            "error": job.last_error if job and document.status == Document.STATUS_FAILED else None,
+        })
+
+
+class DocumentPagesView(LoginRequiredMixin, View):
+    """
+    Returns the page geometry indexed at upload, so clients can lay out pages without the PDF.
+    """
+
+    def get(self, request, pk):
+        document = get_object_or_404(Document, pk=pk)
+        if not document.is_accessible_by(request.user):
+            raise PermissionDenied
+
+        pages = [page.as_dict() for page in document.pages.all()]
+        return JsonResponse({"id": document.pk, "page_count": len(pages), "pages": pages})
+
+
+class DocumentPageImageView(LoginRequiredMixin, View):
+    """
+    Serves one page rendered server-side as PNG, from the render cache when possible.
+
+    ?scale= picks the zoom (snapped to settings.PAGE_RENDER_SCALES); thumbnail=True renders at
+    settings.PAGE_THUMBNAIL_WIDTH pixels wide instead.
+    """
+    thumbnail = False
+
+    def get(self, request, pk, number):
+        document = get_object_or_404(Document, pk=pk)
+        if not document.is_accessible_by(request.user):
+            raise PermissionDenied
+
+        pages = document.get_pages()
+        if not 1 <= number <= len(pages):
+            raise Http404("No such page")
+
+        if self.thumbnail:
+            scale = thumbnail_scale(pages[number - 1])
+        else:
+            try:
+                scale = snap_scale(float(request.GET.get("scale", 1)))
+            except ValueError:
+                return JsonResponse({"error": "Invalid scale"}, status=400)
+
+        etag = f'"{document.pk}-{document.revision}-{number}-{scale:g}"'
+        if request.headers.get("If-None-Match") == etag:
+            response = HttpResponse(status=304)
+        else:
+            response = FileResponse(open_render(document, number, scale), content_type="image/png")
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, max-age=3600"
+        return response
+
+
+class DocumentFileView(LoginRequiredMixin, View):
+    """
+    Downloads a document's current file, or an earlier revision of it with ?revision=<number>,
+    with byte range and conditional request support.
+    """
+
+    def get(self, request, pk):
+        document = get_object_or_404(Document, pk=pk)
+        if not document.is_accessible_by(request.user):
+            raise PermissionDenied
+
+        revision = None
+        if request.GET.get("revision"):
+            try:
+                number = int(request.GET["revision"])
+            except ValueError:
+                return JsonResponse({"error": "Invalid revision"}, status=400)
+            revision = get_object_or_404(document.revisions, number=number)
+
+        return serve_document_file(request, document, revision)
+
+
+class DocumentListView(LoginRequiredMixin, ReplicaReadMixin, ListView):
     model = Document
     template_name = "documents/document_list.html"
     context_object_name = "documents"
@@ -100,10 +273,8 @@ class DeleteDocumentView(LoginRequiredMixin, View):
             raise PermissionDenied
 
         try:
-            # Remove the file from the filesystem
-            file_path = document.file.path
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            # Remove the file from the filesystem (shared blobs only once nothing references them)
+            document.delete_file()
 
             # Delete the document from the database
             document.delete()
@@ -113,32 +284,92 @@ class DeleteDocumentView(LoginRequiredMixin, View):
             return JsonResponse({"status": False})
 
 
-class ToSignListView(LoginRequiredMixin, ListView):
-    template_name = "documents/to_sign_list.html"
-    context_object_name = "to_sign_documents"
+class InboxListView(LoginRequiredMixin, ReplicaReadMixin, ListView):
+    """
+    One keyset-paginated page of the user's inbox (see documents.inbox); ?cursor= selects the page.
+    """
+    signed = False
 
     def get_queryset(self):
-        """
-        Get distinct documents that the user needs to sign, consolidating multiple required signatures.
-        """
-        return Document.objects.filter(
-            signature_fields__assigned_user=self.request.user,
-            signature_fields__signed=False
-        ).annotate(num_signatures=Count('signature_fields'))
+        try:
+            documents, self.next_cursor = inbox_page(
+                self.request.user, signed=self.signed, cursor=self.request.GET.get("cursor")
+            )
+        except ValueError:
+            raise Http404("Invalid cursor")
+        return documents
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["next_cursor"] = self.next_cursor
+        return context
+
+
+class ToSignListView(InboxListView):
+    """
+    Documents the user still needs to sign, consolidating multiple required signatures.
+    """
+    template_name = "documents/to_sign_list.html"
+    context_object_name = "to_sign_documents"
 
-class SignedListView(LoginRequiredMixin, ListView):
+
+class SignedListView(InboxListView):
+    """
+    Documents the user has signed fields on.
+    """
     template_name = "documents/signed_list.html"
     context_object_name = "signed_documents"
+    signed = True
 
-    def get_queryset(self):
-        """
-        Get distinct documents that the user needs to sign, consolidating multiple required signatures.
-        """
-        return Document.objects.filter(
-            signature_fields__assigned_user=self.request.user,
-            signature_fields__signed=True
-        ).annotate(num_signatures=Count('signature_fields'))
+
+class InboxView(LoginRequiredMixin, ReplicaReadMixin, View):
+    """
+    The JSON inbox: a page of documents waiting on the user (?box=to_sign, the default) or signed by
+    them (?box=signed), with the cursor of the next page and the pending count for the nav badge.
+    """
+
+    def get(self, request):
+        box = request.GET.get("box", "to_sign")
+        if box not in ("to_sign", "signed"):
+            return JsonResponse({"error": "box must be \"to_sign\" or \"signed\""}, status=400)
+
+        try:
+            documents, next_cursor = inbox_page(
+                request.user, signed=box == "signed", cursor=request.GET.get("cursor")
+            )
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        return JsonResponse({
+            "documents": [
+                {
+                    "id": document.pk,
+                    "name": document.display_name,
+                    "uploaded_at": document.uploaded_at.isoformat(),
+                    "num_signatures": document.num_signatures,
+                    "fields_signed": document.fields_signed,
+                    "fields_total": document.fields_total,
+                    "sign_url": reverse("sign_document", args=[document.pk]),
+                }
+                for document in documents
+            ],
+            "next_cursor": next_cursor,
+            "pending_count": pending_count(request.user),
+        })
+
+
+class InboxBadgeView(LoginRequiredMixin, ReplicaReadMixin, View):
+    """
+    The pending count as an HTML fragment, swapped into the nav by htmx.
+    """
+
+    def get(self, request):
+        count = pending_count(request.user)
+        if not count:
+            return HttpResponse("")
+        return HttpResponse(
+            f'<span class="ml-1 bg-red-600 text-white text-xs font-bold rounded-full px-2 py-0.5">{count}</span>'
+        )
 
 
 class AssignSignaturesView(LoginRequiredMixin, TemplateView):
@@ -151,11 +382,28 @@ class AssignSignaturesView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["document"] = self.document
-        # Exclude the owner if you want them not to sign, or show all users
-        context["users"] = Account.objects.all().order_by("username")
         return context
 
 
+class AssigneeSearchView(LoginRequiredMixin, View):
+    """
+    Typeahead for the assign page: active accounts whose username or email starts with ?q=, the
+    user's recent assignees first. ?after= takes the next_cursor of the previous page.
+    """
+
+    def get(self, request):
+        accounts, recent_ids, next_cursor = search_assignees(
+            request.user, request.GET.get("q", ""), after=request.GET.get("after")
+        )
+        return JsonResponse({
+            "results": [
+                {"id": str(account.pk), "username": account.username, "recent": account.pk in recent_ids}
+                for account in accounts
+            ],
+            "next_cursor": next_cursor,
+        })
+
+
 class SaveSignaturesView(LoginRequiredMixin, View):
     def post(self, request, pk):
         document = get_object_or_404(Document, pk=pk)
@@ -164,66 +412,109 @@ class SaveSignaturesView(LoginRequiredMixin, View):
         except json.JSONDecodeError:
             return JsonResponse({"error": "Invalid JSON data"}, status=400)
 
+        if document.status != Document.STATUS_READY:
+            return JsonResponse({"error": "Document is still being processed"}, status=409)
+
         fields = data.get("signatures", [])
         if not fields:
             return JsonResponse({"error": "No signature fields provided"}, status=400)
 
-        saved_fields = []
-        pdf_path = document.file.path
-        temp_pdf_path = os.path.join(settings.MEDIA_ROOT, f"temp_{document.file.name}")
-
-        temp_dir = os.path.dirname(temp_pdf_path)  # Extract directory part of the path
-        os.makedirs(temp_dir, exist_ok=True)  # Create it, including parents
-
-        with open(pdf_path, "rb") as pdf_in:
-            writer = IncrementalPdfFileWriter(pdf_in)
-
-            for field in fields:
-                user_id = field.get("assigned_user_id")
-                x, y, width, height, page = field.get("x_pdf"), field.get("y_pdf"), field.get("width_pdf"), field.get(
-                    "height_pdf"), field.get("page")
-
-                if user_id is None or x is None or y is None or page is None or width is None or height is None:
+        # Resolve every assignee with one query
+        assignee_ids = {}
+        for index, field in enumerate(fields):
+            try:
+                assignee_ids[index] = uuid.UUID(str(field.get("assigned_user_id")))
+            except ValueError:
+                pass
+        assignees = Account.objects.in_bulk(set(assignee_ids.values()))
+
+        # Check every field, and report every problem, before touching the file or the database
+        pages = {page.number: page for page in document.pages.all()}
+        errors = []
+        entries = []
+        field_names = set()
+        for index, field in enumerate(fields):
+            x, y, width, height, page = (field.get(key) for key in ("x_pdf", "y_pdf", "width_pdf", "height_pdf", "page"))
+            assignee = assignees.get(assignee_ids.get(index))
+
+            if x is None or y is None or width is None or height is None or page is None:
+                errors.append({"index": index, "error": "Missing position or size"})
+                continue
+            if assignee is None:
+                errors.append({"index": index, "error": "Unknown assigned user"})
+                continue
+            if pages:
+                try:
+                    fits = page in pages and pages[page].fits(x, y, width, height)
+                except TypeError:
+                    fits = False
+                if not fits:
+                    errors.append({"index": index, "error": f"Field does not fit on page {page}"})
                     continue
 
-                assigned_user = get_object_or_404(Account, pk=user_id)
-                field_name = f"Signature_{document.id}_{assigned_user.id}_{x}_{y}_{page}"
-
-                signature_field, created = SignatureField.objects.update_or_create(
-                    document=document,
-                    assigned_user=assigned_user,
-                    x_pdf=x,
-                    y_pdf=y,
-                    page=page,
-                    width_pdf=width,
-                    height_pdf=height,
-                    defaults={"signed": False, "field_name": field_name},
-                )
+            field_name = f"Signature_{document.id}_{assignee.id}_{x}_{y}_{page}"
+            if field_name in field_names:
+                errors.append({"index": index, "error": "Duplicate field"})
+                continue
+            field_names.add(field_name)
+            entries.append((index, field_name, SignatureField(
+                document=document, assigned_user=assignee, field_name=field_name,
+                x_pdf=x, y_pdf=y, width_pdf=width, height_pdf=height, page=page,
+            )))
+
+        # Fields saved before keep their row, and their signature if they have one
+        existing = {
+            signature_field.field_name: signature_field
+            for signature_field in SignatureField.objects.filter(field_name__in=field_names).select_related("assigned_user")
+        }
+        for index, field_name, signature_field in entries:
+            old = existing.get(field_name)
+            if old and (old.width_pdf, old.height_pdf) != (signature_field.width_pdf, signature_field.height_pdf):
+                errors.append({"index": index, "error": "A field of another size is already at this position"})
+
+        if errors:
+            errors.sort(key=lambda error: error["index"])
+            return JsonResponse({"error": "Invalid signature fields", "errors": errors}, status=400)
+
+        new_fields = [signature_field for _, field_name, signature_field in entries if field_name not in existing]
+
+        if new_fields:
+            # Appended as a new revision on top of the latest one, even if someone signed meanwhile.
+            # The rows are created in the transaction that commits the revision.
+            with RevisionWriter(document, "fields") as revision, open(revision.path, "r+b") as pdf_in:
+                writer = IncrementalPdfFileWriter(pdf_in)
+                for signature_field in new_fields:
+                    append_signature_field(writer, SigFieldSpec(
+                        sig_field_name=signature_field.field_name,
+                        on_page=signature_field.page - 1,  # Important: 0-based page index
+                        box=(
+                            signature_field.x_pdf,
+                            signature_field.y_pdf,
+                            signature_field.x_pdf + signature_field.width_pdf,
+                            signature_field.y_pdf + signature_field.height_pdf,
+                        ),
+                    ))
+
+                # Appends the new fields as an incremental update; earlier revisions stay as they are
+                writer.write_in_place()
+                revision.with_commit(lambda: SignatureField.objects.bulk_create(new_fields))
+
+            enqueue("prewarm_renders", document=document)
 
-                spec = SigFieldSpec(
-                    sig_field_name=field_name,
-                    on_page=page - 1,  # Important: 0-based page index
-                    box=(x, y, x + width, y + height)
-                )
-
-                append_signature_field(writer, spec)  # Use the imported function
-
-                saved_fields.append({
-                    "id": signature_field.id,
-                    "user": assigned_user.username,
-                    "x_pdf": signature_field.x_pdf,
-                    "y_pdf": signature_field.y_pdf,
-                    "width_pdf": signature_field.width_pdf,
-                    "height_pdf": signature_field.height_pdf,
-                    "page": signature_field.page,
-                    "field_name": field_name,
-                    "created": created,
-                })
-
-            with open(temp_pdf_path, "wb") as pdf_out:
-                writer.write(pdf_out)
-
-            os.replace(temp_pdf_path, pdf_path)
+        saved_fields = []
+        for _, field_name, signature_field in entries:
+            signature_field = existing.get(field_name, signature_field)
+            saved_fields.append({
+                "id": signature_field.id,
+                "user": signature_field.assigned_user.username,
+                "x_pdf": signature_field.x_pdf,
+                "y_pdf": signature_field.y_pdf,
+                "width_pdf": signature_field.width_pdf,
+                "height_pdf": signature_field.height_pdf,
+                "page": signature_field.page,
+                "field_name": field_name,
+                "created": field_name not in existing,
+            })
 
         return JsonResponse({"status": "Signatures saved successfully", "fields": saved_fields}, status=201)
 
@@ -240,10 +531,6 @@ class SignDocumentView(LoginRequiredMixin, View):
             signed=False
         )
 
-        latest_document = document.get_latest_document()
-        if latest_document:
-            document.update_signed_document(latest_document)
-
         # Convert QuerySet -> JSON for the template
         signature_fields_data = list(signature_fields.values("id", "x_pdf", "y_pdf", "width_pdf", "height_pdf", "page"))
         return render(
@@ -252,13 +539,17 @@ class SignDocumentView(LoginRequiredMixin, View):
             {
                 "document": document,
                 "signature_fields_json": json.dumps(signature_fields_data),
+                "pages_json": json.dumps([page.as_dict() for page in document.get_pages()]),
             },
         )
 
     def post(self, request, pk):
         document = get_object_or_404(Document, pk=pk)
+        if document.status != Document.STATUS_READY:
+            return JsonResponse({"error": "Document is still being processed"}, status=409)
+
         signature_fields = SignatureField.objects.filter(
-            document=document, assigned_user=request.user
+            document=document, assigned_user=request.user, signed=False
         )
 
         if not signature_fields.exists():
@@ -267,78 +558,138 @@ class SignDocumentView(LoginRequiredMixin, View):
         signature_path = get_user_signature_path(request.user)
         if not signature_path or not os.path.exists(signature_path):
             return JsonResponse({"error": "No registered signature image found"}, status=400)
+        signature = request.user.signature
+
+        fields = list(signature_fields)
 
-        pdf_path = document.file.path
+        try:
+            # One rendition, sized for the largest box, embedded once and shown in every field.
+            # Prepared before taking the document's write lock, so concurrent signers only wait on the append.
+            try:
+                rendition = prepare_rendition(signature, fields)
+            except Exception as e:
+                error_message = f"Error inserting image: {e}"
+                logger.error(error_message, exc_info=True)
+                return JsonResponse({"error": error_message}, status=500)
+
+            # Appends only the stamped images and page content to the file
+            sign_fields(document, fields, rendition)
 
+        except fitz.FileNotFoundError:
+            return JsonResponse({"error": "PDF file not found"}, status=404)
+        except Exception as e:
+            error_message = "A general error occurred processing the PDF: " + str(e)
+            logger.error(error_message, exc_info=True)
+            return JsonResponse({"error": error_message}, status=500)
 
-        signed_pdf_path = os.path.join(settings.MEDIA_ROOT, f"signed_documents/{document.file.name}")
+        enqueue("prewarm_renders", document=document)
+        if document.signed:
+            schedule_compaction(document, settings.PDF_COMPACTION_ON_COMPLETE)
 
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(signed_pdf_path), exist_ok=True)
+        return JsonResponse({"status": "Signed successfully", "signed_pdf": reverse("document_file", args=[document.pk])})
 
-        try:
-            doc = fitz.open(pdf_path)
 
-            for field in signature_fields:
-                try:
-                    # 1. Load and scale image (PIL for size)
-                    img = Image.open(signature_path)
-                    img_width, img_height = img.size
 
-                    max_width = field.width_pdf
-                    max_height = field.height_pdf
+class DigitalSignDocumentView(View):
+    """
+    Cryptographically signs the requesting user's pending fields on a document.
 
-                    scale_factor = min(max_width / img_width, max_height / img_height) if img_width and img_height else 1
-                    scaled_width = int(img_width * scale_factor)
-                    scaled_height = int(img_height * scale_factor)
+    An async view: served under ASGI, a request waiting on the time stamping authority does not hold
+    a worker thread, and concurrent signing requests overlap their waits.
+    """
 
-                    img = img.resize((scaled_width, scaled_height))
+    async def post(self, request, pk):
+        # request.user is resolved lazily through the session and database
+        user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+        if user is None:
+            return JsonResponse({"error": "Authentication required"}, status=401)
+
+        document = await Document.objects.filter(pk=pk).afirst()
+        if document is None:
+            raise Http404("Document not found")
+        if document.status != Document.STATUS_READY:
+            return JsonResponse({"error": "Document is still being processed"}, status=409)
+
+        fields = [
+            field async for field in SignatureField.objects.filter(
+                document=document, assigned_user=user, signed=False
+            ).select_related("assigned_user")
+        ]
+        if not fields:
+            return JsonResponse({"error": "No signature fields found"}, status=400)
 
-                    # ***In-Memory File Handling (Robust Fix)***
-                    img_bytes = io.BytesIO()  # Create an in-memory byte stream
-                    img.save(img_bytes, format="PNG")  # Save PIL image to memory
-                    img_bytes.seek(0)  # Reset stream position to the beginning
+        try:
+            revision = await async_add_digital_signatures(document, fields)
+        except Exception as e:
+            error_message = "A general error occurred signing the PDF: " + str(e)
+            logger.error(error_message, exc_info=True)
+            return JsonResponse({"error": error_message}, status=500)
 
-                    # 2. Add image to the PDF page (Corrected insert_image call)
-                    page = doc[field.page - 1]
-                    rect = fitz.Rect(field.x_pdf, field.y_pdf, field.x_pdf + scaled_width, field.y_pdf + scaled_height)
+        await sync_to_async(enqueue)("prewarm_renders", document=document)
 
-                    try:
-                        page.insert_image(rect, stream=img_bytes)  # Correct call for 1.25.3
-                    except Exception as e:
-                        error_message = f"Error inserting image: {e}"
-                        logger.error(error_message, exc_info=True)
-                        return JsonResponse({"error": error_message}, status=500)
+        return JsonResponse({"status": "Signed successfully", "revision": revision, "signed_pdf": reverse("document_file", args=[document.pk])})
 
-                    field.signed = True
-                    field.save()
 
-                except Exception as e:
-                    error_message = f"Error processing image or field: {e}"
-                    logger.error(error_message, exc_info=True)
-                    return JsonResponse({"error": error_message}, status=500)
+class BatchSignView(LoginRequiredMixin, View):
+    """
+    Queues signing of the user's pending fields on many documents at once.
 
-            doc.save(signed_pdf_path)
-            doc.close()
-            document.update_signed_document(signed_pdf_path)
+    Expects JSON {"documents": [<document id>, ...]} or {"documents": "all"}; either way at most
+    settings.BATCH_SIGN_MAX_DOCUMENTS documents are signed. One batch per user at a time; progress
+    is polled from BatchSignStatusView.
+    """
 
-        except fitz.FileNotFoundError:
-            return JsonResponse({"error": "PDF file not found"}, status=404)
-        except Exception as e:
-            error_message = "A general error occurred processing the PDF: " + str(e)
-            logger.error(error_message, exc_info=True)
-            return JsonResponse({"error": error_message}, status=500)
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return JsonResponse({"error": "Invalid JSON data"}, status=400)
 
-        if document.check_complete():
-            qr_dir_path = os.path.join(settings.MEDIA_ROOT, f"qr")
-            base_name = f"{settings.SITE_URL}{document.file.url}"
-            os.makedirs(qr_dir_path, exist_ok=True)
-            qr_path = f"{qr_dir_path}/{document.file.name.split('/')[-1].split('.')[0]}.jpg"
-            generate_qr_code(base_name, qr_path)
-            stamp_pdf_with_qr(qr_path, signed_pdf_path, pdf_path)
-            document.signed = True
-            document.save()
+        documents = data.get("documents", "all")
+        if documents != "all":
+            if not isinstance(documents, list) or not all(isinstance(pk, int) for pk in documents):
+                return JsonResponse({"error": "documents must be a list of ids or \"all\""}, status=400)
+            if not documents:
+                return JsonResponse({"error": "No documents given"}, status=400)
+            if len(documents) > settings.BATCH_SIGN_MAX_DOCUMENTS:
+                return JsonResponse(
+                    {"error": f"At most {settings.BATCH_SIGN_MAX_DOCUMENTS} documents per batch"}, status=400
+                )
+            documents = sorted(set(documents))
 
+        signature_path = get_user_signature_path(request.user)
+        if not signature_path or not os.path.exists(signature_path):
+            return JsonResponse({"error": "No registered signature image found"}, status=400)
+
+        job, created = enqueue_batch_sign(request.user, documents)
+        if not created:
+            return JsonResponse({
+                "error": "A batch is already being signed",
+                "job": job.pk,
+                "status_url": reverse("batch_sign_status", args=[job.pk]),
+            }, status=409)
+        return JsonResponse(
+            {"job": job.pk, "status_url": reverse("batch_sign_status", args=[job.pk])}, status=202
+        )
 
-        return JsonResponse({"status": "Signed successfully", "signed_pdf": signed_pdf_path})
 
+class BatchSignStatusView(LoginRequiredMixin, View):
+    """
+    Reports the progress and per-document results of a batch signing job.
+    """
+
+    def get(self, request, pk):
+        job = get_object_or_404(DocumentJob, pk=pk, kind="batch_sign", payload__user_id=str(request.user.pk))
+        result = job.result or {}
+
+        return JsonResponse({
+            "job": job.pk,
+            "state": job.state,
+            "total": result.get("total"),
+            "done": result.get("done", 0),
+            "signed": result.get("signed", 0),
+            "failed": result.get("failed", 0),
+            "remaining": result.get("remaining", 0),
+            "results": result.get("results", {}),
+            "error": job.last_error if job.state == DocumentJob.STATE_FAILED else None,
+        })
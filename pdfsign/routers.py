@@ -0,0 +1,145 @@
+"""
+Read replica routing.
+
+Reads go to the primary database unless code opts in with replica_reads() (or, for views,
+ReplicaReadMixin). Even then they stay on the primary when:
+- no replica is configured (settings.REPLICA_DATABASE)
+- the current request already wrote something, or the same client wrote within the last
+  settings.REPLICA_STICKY_SECONDS (read-your-writes; see ReplicaPinningMiddleware)
+- the replica failed its last health check, or lags more than settings.REPLICA_MAX_LAG_SECONDS
+
+Writes always go to the primary.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = "db_pinned_until"
+
+_replica_reads = ContextVar("replica_reads", default=False)
+_wrote = ContextVar("primary_written", default=False)
+_pinned = ContextVar("primary_pinned", default=False)
+
+# alias -> (checked at, healthy); per process
+_health = {}
+
+
+@contextmanager
+def replica_reads():
+    """Lets the reads made inside the block go to the read replica."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_is_healthy(alias):
+    """
+    Whether alias answers and keeps up with the primary, checked at most every
+    settings.REPLICA_HEALTH_CHECK_SECONDS.
+    """
+    now = time.monotonic()
+    checked = _health.get(alias)
+    if checked and now - checked[0] < settings.REPLICA_HEALTH_CHECK_SECONDS:
+        return checked[1]
+
+    try:
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # Seconds behind the primary; 0 once everything received is replayed, or on a
+                # server that is not a streaming replica at all
+                cursor.execute(
+                    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+                )
+                lag = float(cursor.fetchone()[0] or 0)
+            else:
+                cursor.execute("SELECT 1")
+                lag = 0
+        healthy = lag <= settings.REPLICA_MAX_LAG_SECONDS
+        if not healthy:
+            logger.warning(f"Read replica {alias} is {lag:.1f}s behind; reading from the primary")
+    except DatabaseError as e:
+        logger.warning(f"Read replica {alias} is unavailable; reading from the primary: {e}")
+        healthy = False
+
+    _health[alias] = (now, healthy)
+    return healthy
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = settings.REPLICA_DATABASE
+        if not alias or not _replica_reads.get() or _wrote.get() or _pinned.get():
+            return None
+        if not replica_is_healthy(alias):
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema through replication
+        return db != settings.REPLICA_DATABASE
+
+
+class ReplicaPinningMiddleware:
+    """
+    Read-your-writes for the replica: once a request writes to the primary, the client's reads
+    stay on the primary for settings.REPLICA_STICKY_SECONDS, so it never sees data older than
+    its own write (e.g. a document still unsigned right after signing it).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            pinned_until = float(request.COOKIES.get(PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+
+        tokens = (_pinned.set(pinned_until > time.time()), _wrote.set(False))
+        try:
+            response = self.get_response(request)
+            if _wrote.get() and settings.REPLICA_DATABASE:
+                response.set_cookie(
+                    PIN_COOKIE,
+                    str(time.time() + settings.REPLICA_STICKY_SECONDS),
+                    max_age=settings.REPLICA_STICKY_SECONDS,
+                    httponly=True,
+                    samesite="Lax",
+                )
+        finally:
+            _pinned.reset(tokens[0])
+            _wrote.reset(tokens[1])
+        return response
+
+
+class ReplicaReadMixin:
+    """Serves GET and HEAD requests of a class-based view from the read replica, template rendering included."""
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return super().dispatch(request, *args, **kwargs)
+
+        with replica_reads():
+            response = super().dispatch(request, *args, **kwargs)
+            # Querysets handed to a template are only evaluated when it renders
+            if callable(getattr(response, "render", None)) and not response.is_rendered:
+                response.render()
+        return response
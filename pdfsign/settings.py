@@ -51,6 +51,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'pdfsign.routers.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -104,6 +105,32 @@ DATABASES = {
     'default': default_db
 }
 
+# Optional read replica (pdfsign/routers.py), used by read-only views. DB_REPLICA_HOST points at a
+# streaming replica of the Postgres primary; with PDFSIGN_SQLITE, PDFSIGN_SQLITE_REPLICA names a
+# second SQLite file (a copy of db.sqlite3) to try the routing locally
+if os.getenv("DB_REPLICA_HOST"):
+    DATABASES['replica'] = {
+        **default_db,
+        'HOST': os.getenv("DB_REPLICA_HOST"),
+        'PORT': os.getenv("DB_REPLICA_PORT", default_db.get('PORT', '')),
+    }
+elif os.getenv("PDFSIGN_SQLITE") and os.getenv("PDFSIGN_SQLITE_REPLICA"):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv("PDFSIGN_SQLITE_REPLICA"),
+    }
+if 'replica' in DATABASES:
+    # Tests read the replica through the primary's test database
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+REPLICA_DATABASE = 'replica' if 'replica' in DATABASES else None
+DATABASE_ROUTERS = ['pdfsign.routers.ReplicaRouter']
+# After a client writes, its reads stay on the primary this long (read-your-writes)
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+# Replica health is re-checked this often; a replica further behind than REPLICA_MAX_LAG_SECONDS is skipped
+REPLICA_HEALTH_CHECK_SECONDS = int(os.getenv("REPLICA_HEALTH_CHECK_SECONDS", "15"))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -153,3 +180,98 @@ MEDIA_ROOT = os.getenv('MEDIA_ROOT')
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.getenv('STATIC_ROOT')
+
+# PDF normalization, applied once to every uploaded document
+# https://pikepdf.readthedocs.io/en/latest/api/main.html#pikepdf.ObjectStreamMode
+# disable: classic xref table (most compatible), preserve: keep as uploaded, generate: compact xref streams
+PDF_NORMALIZE_OBJECT_STREAMS = os.getenv("PDF_NORMALIZE_OBJECT_STREAMS", "disable")
+# Linearized ("fast web view") output lets viewers show page 1 before the whole file has arrived
+PDF_LINEARIZE = os.getenv("PDF_LINEARIZE", "1") == "1"
+# Catalog entries dropped during normalization (comma separated, e.g. "/OpenAction,/AA"). None by
+# default: /AcroForm, /Names and the like hold users' form fields, destinations and attachments, and
+# dropping /AcroForm leaves its widget annotations orphaned on the pages
+PDF_NORMALIZE_STRIP_KEYS = [
+    key.strip() for key in os.getenv("PDF_NORMALIZE_STRIP_KEYS", "").split(",") if key.strip()
+]
+
+# Document job queue (see documents/jobs.py, run workers with `python manage.py process_jobs`)
+# Eager mode runs jobs inline on the request thread, for local development without a worker
+DOCUMENT_JOBS_EAGER = os.getenv("DOCUMENT_JOBS_EAGER", "") == "1"
+# A running job whose lease expires is assumed crashed and is picked up again
+DOCUMENT_JOBS_LEASE_SECONDS = int(os.getenv("DOCUMENT_JOBS_LEASE_SECONDS", "300"))
+
+# Chunked uploads (documents/uploads.py); keep CHUNKED_UPLOAD_DIR on the same filesystem as MEDIA_ROOT
+# so finished uploads are moved into place instead of copied
+CHUNKED_UPLOAD_DIR = os.getenv("CHUNKED_UPLOAD_DIR")
+CHUNKED_UPLOAD_MAX_SIZE = int(os.getenv("CHUNKED_UPLOAD_MAX_SIZE", str(512 * 1024 * 1024)))
+# Sessions left incomplete this long are deleted by `python manage.py expire_uploads`
+CHUNKED_UPLOAD_EXPIRY_HOURS = int(os.getenv("CHUNKED_UPLOAD_EXPIRY_HOURS", "24"))
+# Running checksums of in-progress uploads kept per process; evicted ones are rebuilt from disk
+CHUNKED_UPLOAD_HASHER_CACHE_SIZE = int(os.getenv("CHUNKED_UPLOAD_HASHER_CACHE_SIZE", "256"))
+
+# Signer inbox pages (documents/inbox.py)
+INBOX_PAGE_SIZE = int(os.getenv("INBOX_PAGE_SIZE", "25"))
+
+# Caches shared by every process; without REDIS_URL each process keeps a local-memory cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv("REDIS_URL"),
+    } if os.getenv("REDIS_URL") else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Account permission codenames (accounts/models/account/permissions.py), cached across requests in
+# this cache; membership and role changes invalidate them right away, the timeout only bounds memory.
+# A local-memory cache can't see other processes' invalidations, so with one the codenames are
+# only kept for the request
+ACCOUNT_PERMISSIONS_CACHE = os.getenv("ACCOUNT_PERMISSIONS_CACHE", "default")
+ACCOUNT_PERMISSIONS_CACHE_TIMEOUT = int(os.getenv("ACCOUNT_PERMISSIONS_CACHE_TIMEOUT", "3600"))
+
+# Assignee typeahead on the assign page (documents/assignees.py)
+ASSIGNEE_SEARCH_PAGE_SIZE = int(os.getenv("ASSIGNEE_SEARCH_PAGE_SIZE", "10"))
+# How many of the owner's most recent assignees are ranked first
+ASSIGNEE_SEARCH_RECENT = int(os.getenv("ASSIGNEE_SEARCH_RECENT", "20"))
+
+# Server-side page renders (documents/rendering.py), kept in a size-bounded LRU disk cache
+PAGE_RENDER_CACHE_DIR = os.getenv("PAGE_RENDER_CACHE_DIR")
+PAGE_RENDER_CACHE_MAX_BYTES = int(os.getenv("PAGE_RENDER_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Requested scales are snapped to one of these so renders are shared between clients
+PAGE_RENDER_SCALES = (0.5, 1.0, 1.5, 2.0, 3.0)
+PAGE_THUMBNAIL_WIDTH = 160
+# Pages holding signature fields are rendered ahead of time at these scales
+PAGE_RENDER_PREWARM_SCALES = (1.0, 2.0)
+
+# Document downloads (documents/serving.py): "" streams from Django, "x-sendfile" (Apache, lighttpd)
+# or "x-accel-redirect" (nginx, with an internal location serving MEDIA_ROOT at the prefix below).
+# Only archived pre-compaction files are offloaded; files still being appended to are streamed
+DOCUMENT_SENDFILE = os.getenv("DOCUMENT_SENDFILE", "")
+DOCUMENT_ACCEL_REDIRECT_PREFIX = os.getenv("DOCUMENT_ACCEL_REDIRECT_PREFIX", "/protected-media/")
+
+# Prepared signature images (signatures/utils.py), cached per process
+SIGNATURE_RENDITION_CACHE_SIZE = int(os.getenv("SIGNATURE_RENDITION_CACHE_SIZE", "256"))
+SIGNATURE_SOURCE_CACHE_SIZE = int(os.getenv("SIGNATURE_SOURCE_CACHE_SIZE", "32"))
+
+# Batch signing (the batch_sign job in documents/jobs.py) stamps documents in parallel worker processes
+BATCH_SIGN_WORKERS = int(os.getenv("BATCH_SIGN_WORKERS", str(min(os.cpu_count() or 1, 4))))
+BATCH_SIGN_MAX_DOCUMENTS = int(os.getenv("BATCH_SIGN_MAX_DOCUMENTS", "500"))
+
+# Certificate for cryptographic (pyHanko) signatures; loaded once per process by signatures/pyhanko_signing.py
+SIGNING_CERT_PATH = os.getenv("SIGNING_CERT_PATH", str(BASE_DIR / "certs" / "my_certificate.pfx"))
+SIGNING_CERT_PASSPHRASE = os.getenv("SIGNING_CERT_PASSPHRASE", "your_password").encode()
+# Optional RFC 3161 time stamping authority for cryptographic signatures
+SIGNING_TSA_URL = os.getenv("SIGNING_TSA_URL", "")
+SIGNING_TSA_TIMEOUT = int(os.getenv("SIGNING_TSA_TIMEOUT", "10"))
+
+# Completion QR code stamp (documents/utils.py): "vector" draws the modules as PDF paths, "raster" embeds a PNG
+QR_STAMP_MODE = os.getenv("QR_STAMP_MODE", "vector")
+
+# Compaction (the compact job in documents/jobs.py): signing only appends, so files are rewritten later
+# with a named policy ("none", "light", "full"; see documents/utils.py), during the off-peak window below
+PDF_COMPACTION_WINDOW = os.getenv("PDF_COMPACTION_WINDOW", "01:00-05:00")
+# Policy for documents once fully signed, and for documents left unchanged for PDF_COMPACTION_IDLE_DAYS
+# (queued by `python manage.py compact_documents`); unknown policies fail the startup system checks
+PDF_COMPACTION_ON_COMPLETE = os.getenv("PDF_COMPACTION_ON_COMPLETE", "full")
+PDF_COMPACTION_IDLE = os.getenv("PDF_COMPACTION_IDLE", "light")
+PDF_COMPACTION_IDLE_DAYS = int(os.getenv("PDF_COMPACTION_IDLE_DAYS", "30"))
@@ -13,6 +13,8 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import os
+
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
@@ -25,4 +27,11 @@ urlpatterns = [
     path('accounts/', include('accounts.urls')),
     path('signatures/', include('signatures.urls')),
     path('documents/', include('documents.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+
+# Only signature images are served straight from MEDIA_ROOT (in development). Documents, their
+# revisions and blobs go through documents.views.DocumentFileView, which checks access.
+if settings.MEDIA_ROOT:
+    urlpatterns += static(
+        f"{settings.MEDIA_URL}signatures/", document_root=os.path.join(settings.MEDIA_ROOT, "signatures")
+    )
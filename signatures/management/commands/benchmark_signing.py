@@ -0,0 +1,97 @@
+import datetime
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import fitz
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import BestAvailableEncryption, pkcs12
+from cryptography.x509.oid import NameOID
+from django.core.management.base import BaseCommand
+from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+from pyhanko.sign import signers
+
+from signatures.pyhanko_signing import clear_signers, get_signer, load_signer
+
+
+def build_test_pkcs12(path, passphrase, key_size=2048):
+    """Writes a throwaway self-signed certificate and key as an encrypted PKCS#12 file."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "pdfsign benchmark")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    with open(path, "wb") as f:
+        f.write(pkcs12.serialize_key_and_certificates(b"benchmark", key, cert, None, BestAvailableEncryption(passphrase)))
+
+
+def build_sample_pdf():
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "Benchmark document")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def sign_once(pdf_bytes, signer):
+    writer = IncrementalPdfFileWriter(io.BytesIO(pdf_bytes))
+    output = io.BytesIO()
+    signers.sign_pdf(writer, signers.PdfSignatureMetadata(field_name="Signature1"), signer=signer, output=output)
+    return output
+
+
+class Command(BaseCommand):
+    help = "Compares per-signature latency with the cached signer registry against loading the PKCS#12 file on every call"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50, help="Signatures per strategy")
+        parser.add_argument("--cert", help="PKCS#12 file to use (default: a generated throwaway certificate)")
+        parser.add_argument("--passphrase", default="benchmark", help="Passphrase of --cert")
+        parser.add_argument("--key-size", type=int, default=2048, help="RSA key size of the generated certificate")
+
+    def handle(self, *args, **options):
+        passphrase = options["passphrase"].encode()
+        pdf_bytes = build_sample_pdf()
+
+        with tempfile.TemporaryDirectory() as workdir:
+            pfx_path = options["cert"]
+            if not pfx_path:
+                pfx_path = os.path.join(workdir, "benchmark.pfx")
+                build_test_pkcs12(pfx_path, passphrase, options["key_size"])
+
+            strategies = {
+                "uncached": lambda: load_signer(pfx_path, passphrase),
+                "cached": lambda: get_signer(pfx_path, passphrase),
+            }
+
+            clear_signers()
+            results = {}
+            for name, strategy in strategies.items():
+                timings = []
+                for _ in range(options["iterations"]):
+                    start = time.perf_counter()
+                    sign_once(pdf_bytes, strategy())
+                    timings.append(time.perf_counter() - start)
+                results[name] = timings
+
+        for name, timings in results.items():
+            self.stdout.write(
+                f"{name:>8}: median {statistics.median(timings) * 1000:,.2f} ms, "
+                f"p95 {sorted(timings)[int(len(timings) * 0.95) - 1] * 1000:,.2f} ms "
+                f"over {len(timings)} signatures"
+            )
+        self.stdout.write(
+            f"speedup x{statistics.median(results['uncached']) / statistics.median(results['cached']):.2f}"
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('signatures', '0002_alter_signature_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='signature',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -16,6 +16,8 @@ class Signature(models.Model):
     )
     image = models.ImageField(upload_to=signature_upload_path)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Incremented whenever the image is replaced; keys the prepared renditions in signatures.utils
+    version = models.PositiveIntegerField(default=1)
 
     @property
     def signature_path(self):
@@ -1,46 +1,142 @@
-from pyhanko.sign.signers.pdf_signer import sign_pdf
-from pyhanko.sign import signers
-from pyhanko.sign.fields import append_signature_field
+from pyhanko import stamp
+from pyhanko.pdf_utils import images
+from pyhanko.sign import signers, timestamps
+from pyhanko.sign.signers.pdf_cms import PdfCMSSignedAttributes
 from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
 from django.conf import settings
+import asyncio
 import os
+import threading
 from signatures.utils import get_user_signature_path
 
+# Process-wide registry of loaded signers, keyed by certificate path. Each entry remembers the
+# identity (inode, size, mtime) of the file it was loaded from, so a replaced certificate is reloaded.
+_signers = {}
+_signers_lock = threading.Lock()
 
-def sign_pdf_with_user_signature(user, pdf_path, output_path, signature_position):
-    """Sign a PDF with the user's registered signature image"""
 
-    # Get the user's signature image path
+def _file_identity(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def load_signer(pfx_path, passphrase):
+    """Decrypts a PKCS#12 file into a pyHanko signer, without caching."""
+    signer = signers.SimpleSigner.load_pkcs12(pfx_path, passphrase=passphrase)
+    if signer is None:
+        # pyHanko logs the cause and returns None on a bad passphrase or corrupt file
+        raise ValueError(f"Could not load signing key from {pfx_path}")
+    return signer
+
+
+def get_signer(pfx_path=None, passphrase=None):
+    """
+    Returns the signer for a PKCS#12 certificate, decrypting the file only once per process.
+
+    Signers are immutable once loaded and are shared between threads.
+
+    Args:
+        pfx_path: Path of the .pfx/.p12 file. Defaults to settings.SIGNING_CERT_PATH.
+        passphrase: bytes. Defaults to settings.SIGNING_CERT_PASSPHRASE.
+    """
+    pfx_path = os.path.abspath(pfx_path or settings.SIGNING_CERT_PATH)
+    if passphrase is None:
+        passphrase = settings.SIGNING_CERT_PASSPHRASE
+    identity = _file_identity(pfx_path)
+
+    with _signers_lock:
+        cached = _signers.get(pfx_path)
+        if cached and cached[0] == (identity, passphrase):
+            return cached[1]
+
+        # Loaded under the lock so concurrent first calls decrypt the file once
+        signer = load_signer(pfx_path, passphrase)
+        _signers[pfx_path] = ((identity, passphrase), signer)
+        return signer
+
+
+def clear_signers():
+    """Drops every cached signer, e.g. after rotating certificates in place."""
+    with _signers_lock:
+        _signers.clear()
+
+
+def stamp_style_for(user):
+    """The visible appearance of a user's cryptographic signature: their signature image, if registered."""
     signature_img_path = get_user_signature_path(user)
-    if not signature_img_path:
-        raise ValueError("No signature registered for this user.")
-
-    with open(pdf_path, "rb") as pdf_in:
-        w = IncrementalPdfFileWriter(pdf_in)
-
-        # Append a signature field at the specified position
-        append_signature_field(
-            w,
-            sig_field_name="Signature1",
-            box=(signature_position["x"], signature_position["y"],
-                 signature_position["x"] + 100, signature_position["y"] + 50),
-            page=signature_position["page"]
-        )
-
-        # Load digital certificate (Modify with your certificate details)
-        with open(os.path.join(settings.BASE_DIR, "certs/my_certificate.pfx"), "rb") as key_file:
-            signer = signers.SimpleSigner.load_pkcs12(key_file, passphrase=b"your_password")
-
-        # Sign the PDF and embed the signature image
-        meta = signers.PdfSignatureMetadata()
-        signature = signers.PdfSigner(
-            signer=signer,
-            signature_meta=meta,
-            appearance_text_params=signers.TextParams(),  # Optional text next to signature
-            stamp_style=signers.PdfStampAppearance.from_file(signature_img_path)  # Embed the image
-        )
-
-        with open(output_path, "wb") as pdf_out:
-            signature.sign_pdf(w, output=pdf_out)
-
-    return output_path
+    return stamp.TextStampStyle(
+        stamp_text="Signed by: %(signer)s\nTime: %(ts)s",  # Optional text next to signature
+        background=images.PdfImage(signature_img_path) if signature_img_path else None,  # Embed the image
+    )
+
+
+def get_timestamper():
+    """The RFC 3161 time stamping authority from settings.SIGNING_TSA_URL, or None to sign without timestamps."""
+    if not settings.SIGNING_TSA_URL:
+        return None
+    return timestamps.HTTPTimeStamper(settings.SIGNING_TSA_URL, timeout=settings.SIGNING_TSA_TIMEOUT)
+
+
+async def async_sign_field(pdf_stream, field_name, signer, stamp_style=None, timestamper=None, executor=None):
+    """
+    Cryptographically signs one existing signature field, as an incremental revision appended in
+    place to pdf_stream. Built from pyHanko's interrupted signing API.
+
+    The waits (the signer, the time stamping authority) are awaited, so concurrent signings overlap
+    them. Writing the prepared revision and hashing its byte range are CPU-bound and run in executor
+    (default: the event loop's default executor).
+    """
+    loop = asyncio.get_running_loop()
+    pdf_signer = signers.PdfSigner(
+        signers.PdfSignatureMetadata(field_name=field_name),
+        signer=signer,
+        stamp_style=stamp_style,
+        timestamper=timestamper,
+    )
+
+    writer = await loop.run_in_executor(executor, IncrementalPdfFileWriter, pdf_stream)
+    session = pdf_signer.init_signing_session(writer)
+    validation_info = await session.perform_presign_validation(writer)
+    bytes_reserved = await session.estimate_signature_container_size(
+        validation_info, tight=pdf_signer.signature_meta.tight_size_estimates
+    )
+    tbs_document = session.prepare_tbs_document(validation_info=validation_info, bytes_reserved=bytes_reserved)
+
+    prepared_digest, output = await loop.run_in_executor(
+        executor, lambda: tbs_document.digest_tbs_document(in_place=True)
+    )
+
+    post_signing = await tbs_document.perform_signature(
+        document_digest=prepared_digest.document_digest,
+        pdf_cms_signed_attrs=PdfCMSSignedAttributes(
+            signing_time=session.system_time,
+            adobe_revinfo_attr=None if validation_info is None else validation_info.adobe_revinfo_attr,
+            cades_signed_attrs=pdf_signer.signature_meta.cades_signed_attr_spec,
+        ),
+    )
+    await post_signing.post_signature_processing(output)
+    return pdf_stream.seek(0, os.SEEK_END)
+
+
+async def async_sign_fields(pdf_stream, signings, timestamper=None, executor=None):
+    """
+    Cryptographically signs several existing signature fields in one pass.
+
+    Each signature becomes its own incremental revision, appended in place to pdf_stream, so every
+    signature after the first one covers the ones before it. Passing an in-memory stream keeps the
+    whole chain out of temp files.
+
+    Args:
+        pdf_stream: A seekable, readable and writable binary stream holding the PDF.
+        signings: (field_name, signer, stamp_style) tuples, signed in order. signer is a pyHanko
+            Signer (see get_signer); stamp_style may be None for pyHanko's default appearance.
+        timestamper: Optional pyHanko TimeStamper (see get_timestamper) to timestamp each signature.
+        executor: Where the CPU-bound steps run, see async_sign_field.
+
+    Returns:
+        The offset at which each signature's revision ends in pdf_stream.
+    """
+    ends = []
+    for field_name, signer, stamp_style in signings:
+        ends.append(await async_sign_field(pdf_stream, field_name, signer, stamp_style, timestamper, executor))
+    return ends
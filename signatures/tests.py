@@ -1,3 +1,312 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import fitz
+from PIL import Image
+from asgiref.sync import async_to_sync
+from asn1crypto import keys as asn1_keys, x509 as asn1_x509
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+from pyhanko.pdf_utils.reader import PdfFileReader
+from pyhanko.sign import signers
+from pyhanko.sign.fields import SigFieldSpec, append_signature_field
+from pyhanko.sign.timestamps import DummyTimeStamper
+from pyhanko.sign.validation import validate_pdf_signature
+from pyhanko_certvalidator.registry import SimpleCertificateStore
+
+from accounts.models import Account
+from documents.models import Document
+from documents.tests import TempMediaRootMixin
+from .models import Signature
+from . import pyhanko_signing
+from .pyhanko_signing import async_sign_fields, clear_signers, get_signer
+from .utils import get_signature_rendition
+
+
+def make_key_and_cert(common_name, extended_key_usage=None):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+    )
+    builder = builder.add_extension(
+        x509.KeyUsage(
+            digital_signature=True, content_commitment=True, key_encipherment=False, data_encipherment=False,
+            key_agreement=False, key_cert_sign=False, crl_sign=False, encipher_only=False, decipher_only=False,
+        ),
+        critical=True,
+    )
+    if extended_key_usage:
+        builder = builder.add_extension(x509.ExtendedKeyUsage([extended_key_usage]), critical=True)
+    return key, builder.sign(key, hashes.SHA256())
+
+
+def to_asn1(key, cert):
+    key_info = asn1_keys.PrivateKeyInfo.load(
+        key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    )
+    return key_info, asn1_x509.Certificate.load(cert.public_bytes(serialization.Encoding.DER))
+
+
+def make_signer():
+    key, cert = to_asn1(*make_key_and_cert("Test signer"))
+    return signers.SimpleSigner(
+        signing_cert=cert, signing_key=key, cert_registry=SimpleCertificateStore.from_certs([cert])
+    )
+
+
+def write_pfx(path, passphrase, common_name="Test signer"):
+    key, cert = make_key_and_cert(common_name)
+    with open(path, "wb") as f:
+        f.write(serialization.pkcs12.serialize_key_and_certificates(
+            b"signer", key, cert, None, serialization.BestAvailableEncryption(passphrase)
+        ))
+
+
+class SlowTimeStamper(DummyTimeStamper):
+    """
+    A local stand-in for a remote time stamping authority that takes delay seconds to answer.
+
+    max_in_flight records how many requests it was answering at once. With wait_for set, a request
+    is answered as soon as that many are in flight (or after delay at the latest), so tests observe
+    overlap without depending on how fast the machine signs.
+    """
+
+    def __init__(self, delay, wait_for=None, **kwargs):
+        key, cert = to_asn1(*make_key_and_cert("Test TSA", ExtendedKeyUsageOID.TIME_STAMPING))
+        super().__init__(tsa_cert=cert, tsa_key=key, **kwargs)
+        self.delay = delay
+        self.wait_for = wait_for
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._all_in_flight = None
+
+    async def async_request_tsa_response(self, req):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.wait_for:
+                self._all_in_flight = self._all_in_flight or asyncio.Event()
+                if self.in_flight >= self.wait_for:
+                    self._all_in_flight.set()
+                try:
+                    await asyncio.wait_for(self._all_in_flight.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(self.delay)
+            return await super().async_request_tsa_response(req)
+        finally:
+            self.in_flight -= 1
+
+
+def pdf_with_fields(*field_names):
+    doc = fitz.open()
+    doc.new_page()
+    buffer = io.BytesIO(doc.tobytes())
+    doc.close()
+
+    writer = IncrementalPdfFileWriter(buffer)
+    for index, name in enumerate(field_names):
+        append_signature_field(writer, SigFieldSpec(sig_field_name=name, on_page=0, box=(50, 50 + index * 60, 200, 100 + index * 60)))
+    writer.write_in_place()
+    return buffer
+
+
+class SignerCacheTests(SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, ignore_errors=True)
+        self.pfx_path = os.path.join(tmpdir, "signer.pfx")
+        write_pfx(self.pfx_path, b"secret")
+        clear_signers()
+        self.addCleanup(clear_signers)
+        patcher = mock.patch.object(pyhanko_signing, "load_signer", wraps=pyhanko_signing.load_signer)
+        self.load = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def common_name(self, signer):
+        return signer.signing_cert.subject.native["common_name"]
+
+    def test_certificate_is_decrypted_once(self):
+        signer = get_signer(self.pfx_path, b"secret")
+
+        self.assertIs(get_signer(self.pfx_path, b"secret"), signer)
+        # The same file by another path shares the entry
+        relative = os.path.relpath(self.pfx_path)
+        self.assertIs(get_signer(relative, b"secret"), signer)
+        self.assertEqual(self.load.call_count, 1)
+
+    def test_replaced_certificate_is_reloaded(self):
+        old = get_signer(self.pfx_path, b"secret")
+
+        replacement = f"{self.pfx_path}.new"
+        write_pfx(replacement, b"secret", common_name="Rotated signer")
+        os.replace(replacement, self.pfx_path)
+
+        new = get_signer(self.pfx_path, b"secret")
+        self.assertIsNot(new, old)
+        self.assertEqual(self.common_name(new), "Rotated signer")
+        self.assertEqual(self.load.call_count, 2)
+
+    def test_certificate_rewritten_in_place_is_reloaded(self):
+        get_signer(self.pfx_path, b"secret")
+        inode = os.stat(self.pfx_path).st_ino
+
+        write_pfx(self.pfx_path, b"secret", common_name="Rewritten signer")
+        # Even when the size and the clock's resolution hide the rewrite, the mtime moves on
+        stat = os.stat(self.pfx_path)
+        os.utime(self.pfx_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        self.assertEqual(os.stat(self.pfx_path).st_ino, inode)
+        self.assertEqual(self.common_name(get_signer(self.pfx_path, b"secret")), "Rewritten signer")
+
+    def test_passphrase_is_part_of_the_key(self):
+        get_signer(self.pfx_path, b"secret")
+
+        # pyHanko logs why it could not decrypt the file
+        with self.assertRaises(ValueError), self.assertLogs("pyhanko", "ERROR"):
+            get_signer(self.pfx_path, b"wrong")
+
+        write_pfx(self.pfx_path, b"rotated", common_name="Rotated passphrase")
+        with self.assertRaises(ValueError), self.assertLogs("pyhanko", "ERROR"):
+            get_signer(self.pfx_path, b"secret")
+        self.assertEqual(self.common_name(get_signer(self.pfx_path, b"rotated")), "Rotated passphrase")
+        self.assertEqual(self.load.call_count, 4)
+
+
+class AsyncSigningTests(SimpleTestCase):
+    def setUp(self):
+        self.signer = make_signer()
+
+    def test_signs_each_field_as_its_own_timestamped_revision(self):
+        buffer = pdf_with_fields("First", "Second", "Third")
+        timestamper = SlowTimeStamper(delay=0)
+
+        ends = async_to_sync(async_sign_fields)(
+            buffer, [(name, self.signer, None) for name in ("First", "Second", "Third")], timestamper=timestamper
+        )
+
+        self.assertEqual(ends, sorted(ends))
+        self.assertEqual(ends[-1], len(buffer.getvalue()))
+        embedded = PdfFileReader(buffer).embedded_signatures
+        self.assertEqual([sig.field_name for sig in embedded], ["First", "Second", "Third"])
+        for sig in embedded:
+            status = validate_pdf_signature(sig)
+            self.assertTrue(status.intact)
+            self.assertTrue(status.valid)
+            self.assertIsNotNone(sig.attached_timestamp_data)
+
+    def test_concurrent_signings_overlap_their_timestamp_waits(self):
+        documents = [pdf_with_fields("Signature") for _ in range(4)]
+        # One after another, every request would time out waiting for the others
+        timestamper = SlowTimeStamper(delay=10, wait_for=len(documents))
+
+        async def sign_all():
+            await asyncio.gather(*(
+                async_sign_fields(buffer, [("Signature", self.signer, None)], timestamper=timestamper)
+                for buffer in documents
+            ))
+
+        async_to_sync(sign_all)()
+
+        self.assertEqual(timestamper.max_in_flight, len(documents))
+        for buffer in documents:
+            self.assertEqual(len(PdfFileReader(buffer).embedded_signatures), 1)
+
+
+@override_settings(DOCUMENT_JOBS_EAGER=True)
+class DigitalSignDocumentViewTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        key, cert = make_key_and_cert("Test signer")
+        self.pfx_path = os.path.join(self.media_root, "signer.pfx")
+        with open(self.pfx_path, "wb") as f:
+            f.write(serialization.pkcs12.serialize_key_and_certificates(
+                b"signer", key, cert, None, serialization.BestAvailableEncryption(b"secret")
+            ))
+        clear_signers()
+
+        self.owner = Account.objects.create_user(username="owner", password="pw")
+        self.signer_user = Account.objects.create_user(username="signer", password="pw")
+
+        doc = fitz.open()
+        doc.new_page()
+        self.client.force_login(self.owner)
+        self.client.post(
+            "/documents/upload/", {"file": SimpleUploadedFile("contract.pdf", doc.tobytes(), "application/pdf")}
+        )
+        self.document = Document.objects.get()
+        field = {
+            "page": 1, "assigned_user_id": str(self.signer_user.pk),
+            "x_pdf": 50, "y_pdf": 50, "width_pdf": 150, "height_pdf": 50,
+        }
+        response = self.client.post(
+            f"/documents/save_signatures/{self.document.pk}/", {"signatures": [field]}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 201)
+
+    def test_signs_pending_fields(self):
+        self.async_client.force_login(self.signer_user)
+
+        with override_settings(SIGNING_CERT_PATH=self.pfx_path, SIGNING_CERT_PASSPHRASE=b"secret"):
+            response = async_to_sync(self.async_client.post)(f"/documents/sign/{self.document.pk}/digital/")
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.document.refresh_from_db()
+        self.assertTrue(self.document.signed)
+        self.assertFalse(self.document.signature_fields.filter(signed=False).exists())
+        with open(self.document.file.path, "rb") as f:
+            self.assertEqual(len(PdfFileReader(f).embedded_signatures), 1)
+
+    def test_requires_login(self):
+        response = async_to_sync(self.async_client.post)(f"/documents/sign/{self.document.pk}/digital/")
+        self.assertEqual(response.status_code, 401)
+
+
+def png(width, height):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "black").save(buffer, format="PNG")
+    return SimpleUploadedFile("signature.png", buffer.getvalue(), "image/png")
+
+
+class SignatureRenditionTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        self.user = Account.objects.create_user(username="signer", password="pw")
+        self.client.force_login(self.user)
+
+    def upload(self, width, height):
+        response = self.client.post("/signatures/upload/", {"image": png(width, height)})
+        self.assertEqual(response.status_code, 302)
+        return Signature.objects.get(user=self.user)
+
+    def test_replacing_the_image_invalidates_its_renditions(self):
+        wide = self.upload(600, 200)
+        self.assertEqual(get_signature_rendition(wide, 300, 100)[1:], (300, 100))
+        self.assertIs(get_signature_rendition(wide, 300, 100), get_signature_rendition(wide, 300, 100))
+
+        tall = self.upload(200, 600)
+
+        self.assertEqual(tall.version, wide.version + 1)
+        self.assertEqual(get_signature_rendition(tall, 300, 100)[1:], (33, 100))
+        # An instance loaded before the upload still names the old version, whose renditions are gone
+        png_bytes, width, height = get_signature_rendition(wide, 300, 100)
+        self.assertEqual((width, height), (33, 100))
+        with Image.open(io.BytesIO(png_bytes)) as image:
+            self.assertEqual(image.size, (33, 100))
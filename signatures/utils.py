@@ -1,7 +1,18 @@
+import io
 import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
 from django.conf import settings
 from .models import Signature
 
+# Process-wide LRU of prepared signature images, keyed by (signature id, version, box size)
+_renditions = OrderedDict()
+# Decoded source images, keyed by (signature id, version)
+_sources = OrderedDict()
+_renditions_lock = threading.Lock()
+
 
 def get_user_signature_path(user):
     """Return the path of the user's signature image for PyHanko"""
@@ -14,3 +25,68 @@ def get_user_signature_path(user):
     except Signature.DoesNotExist:
         return None
     return None
+
+
+def _cache_get(cache, key):
+    with _renditions_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache, key, value, limit):
+    with _renditions_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+
+def _get_source(signature):
+    key = (signature.pk, signature.version)
+    image = _cache_get(_sources, key)
+    if image is None:
+        with Image.open(signature.signature_path) as source:
+            source.load()
+            image = source.copy()
+        _cache_put(_sources, key, image, settings.SIGNATURE_SOURCE_CACHE_SIZE)
+    return image
+
+
+def get_signature_rendition(signature, max_width, max_height):
+    """
+    Returns the signature image scaled to fit a max_width x max_height box, encoded as PNG.
+
+    Renditions are cached per process and shared by every field and request that needs the same
+    box size, so the image is decoded and encoded once per distinct size rather than once per field.
+
+    Returns:
+        A (png_bytes, width, height) tuple.
+    """
+    key = (signature.pk, signature.version, float(max_width), float(max_height))
+    rendition = _cache_get(_renditions, key)
+    if rendition is not None:
+        return rendition
+
+    img = _get_source(signature)
+    img_width, img_height = img.size
+
+    scale_factor = min(max_width / img_width, max_height / img_height) if img_width and img_height else 1
+    scaled_width = int(img_width * scale_factor)
+    scaled_height = int(img_height * scale_factor)
+
+    img_bytes = io.BytesIO()
+    img.resize((scaled_width, scaled_height)).save(img_bytes, format="PNG")
+
+    rendition = (img_bytes.getvalue(), scaled_width, scaled_height)
+    _cache_put(_renditions, key, rendition, settings.SIGNATURE_RENDITION_CACHE_SIZE)
+    return rendition
+
+
+def invalidate_signature_renditions(signature):
+    """Drops every cached rendition of a signature, e.g. after its image was replaced."""
+    with _renditions_lock:
+        for cache in (_renditions, _sources):
+            for key in [key for key in cache if key[0] == signature.pk]:
+                del cache[key]
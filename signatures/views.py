@@ -4,6 +4,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.files.storage import default_storage
 from .models import Signature
 from .forms import SignatureUploadForm
+from .utils import invalidate_signature_renditions
 import os
 
 
@@ -23,7 +24,9 @@ class SignatureUploadView(LoginRequiredMixin, FormView):
                 if os.path.exists(old_path):
                     default_storage.delete(old_path)  # Delete old file
             old_signature.image = image  # Replace with new file
+            old_signature.version += 1  # Invalidates renditions prepared from the old image
             old_signature.save()
+            invalidate_signature_renditions(old_signature)
         else:
             Signature.objects.create(user=user, image=image)
 